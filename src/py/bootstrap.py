@@ -0,0 +1,72 @@
+import numpy as np
+from scipy.stats import rankdata
+
+# Bootstrap confidence intervals of the per class AUC, sensitivity and specificity (one vs rest).
+# The resamples are drawn as a [chunk, n] index matrix and every metric is computed for all the rows of the chunk at once,
+# the AUC with the rank formula (Mann-Whitney U) so there is no sort per resample. Memory is bounded by chunk*n.
+
+def auc_rank(y_true, y_score):
+    # y_true [B, n] bool, y_score [B, n] -> [B], nan when a resample has a single class
+    ranks = rankdata(y_score, axis=1)
+    pos = y_true.sum(axis=1)
+    neg = y_true.shape[1] - pos
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (np.where(y_true, ranks, 0).sum(axis=1) - pos*(pos + 1)/2.0)/(pos*neg)
+
+def sensitivity_specificity(y_true, y_pred):
+    # y_true, y_pred [B, n] bool -> [B], [B]
+    pos = y_true.sum(axis=1)
+    neg = y_true.shape[1] - pos
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (y_true & y_pred).sum(axis=1)/pos, (~y_true & ~y_pred).sum(axis=1)/neg
+
+def score_columns(labels, num_columns):
+    # Column of y_scores of every label, the model outputs have one column per class index
+    columns = np.asarray(labels)
+    if not np.issubdtype(columns.dtype, np.integer) or np.any(columns < 0) or np.any(columns >= num_columns):
+        raise ValueError("The labels must be the class indices of the score columns, in [0, " + str(num_columns) + ")")
+    return columns
+
+def bootstrap_metrics(y_true, y_pred, y_scores=None, labels=None, n_boot=2000, chunk=200, seed=0):
+    # Metrics of every resample, {"sensitivity": [n_boot, K], "specificity": [n_boot, K], "auc": [n_boot, K]}
+    # The AUC of label l uses the column l of y_scores [n, C]
+    y_true = np.asarray(y_true)
+    y_pred = np.asarray(y_pred)
+    if labels is None:
+        labels = np.unique(np.concatenate([y_true, y_pred]))
+
+    rng = np.random.default_rng(seed)
+    n = len(y_true)
+
+    metrics = {"sensitivity": [], "specificity": []}
+    if y_scores is not None:
+        metrics["auc"] = []
+        columns = score_columns(labels, y_scores.shape[1])
+
+    for start in range(0, n_boot, chunk):
+        idx = rng.integers(0, n, size=(min(chunk, n_boot - start), n))
+        y_true_b = y_true[idx]
+        y_pred_b = y_pred[idx]
+
+        sens, spec, auc = [], [], []
+        for i, l in enumerate(labels):
+            s, p = sensitivity_specificity(y_true_b == l, y_pred_b == l)
+            sens.append(s)
+            spec.append(p)
+            if y_scores is not None:
+                auc.append(auc_rank(y_true_b == l, y_scores[:, columns[i]][idx]))
+
+        metrics["sensitivity"].append(np.stack(sens, axis=1))
+        metrics["specificity"].append(np.stack(spec, axis=1))
+        if y_scores is not None:
+            metrics["auc"].append(np.stack(auc, axis=1))
+
+    return {k: np.concatenate(v) for k, v in metrics.items()}
+
+def confidence_intervals(metrics, ci=0.95):
+    # Percentile intervals, {metric: ([K] low, [K] high)}, the resamples where a metric is undefined are ignored
+    alpha = (1.0 - ci)/2.0
+    out = {}
+    for k, v in metrics.items():
+        out[k] = (np.nanpercentile(v, 100*alpha, axis=0), np.nanpercentile(v, 100*(1.0 - alpha), axis=0))
+    return out
@@ -9,6 +9,7 @@ import torch
 from torch.utils.data import DataLoader
 
 from nets import classification
+from slim_checkpoint import load_model
 from loaders.tt_dataset import TTDataset
 
 from sklearn.utils import class_weight
@@ -47,7 +48,7 @@ def main(args):
     #     model = EfficientnetV2s(args, out_features=args.out_features).load_from_checkpoint(args.model)
 
     NN = getattr(classification, args.nn)
-    model = NN.load_from_checkpoint(args.model)
+    model = load_model(NN, args.model)
 
     model.eval()
     model.cuda()
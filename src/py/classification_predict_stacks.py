@@ -8,7 +8,10 @@ import torch
 from torch.utils.data import DataLoader
 
 from nets.classification import EfficientnetV2sStacks, MobileNetV2Stacks, EfficientnetV2sStacksDot
-from loaders.tt_dataset import TTDatasetStacks
+from loaders.tt_dataset import TTDatasetStacks, TTDatasetStacksPacked, stack_to_float
+from utils import compile_regions
+from onnx_backend import get_backend, get_device
+from slim_checkpoint import load_model
 
 from tqdm import tqdm
 import pickle
@@ -24,21 +27,31 @@ def main(args):
     
     df_test = pd.read_csv(test_fn)    
     
-    test_ds = TTDatasetStacks(df_test, mount_point=args.mount_point, img_column=img_column, class_column=class_column)
+    if args.packed:
+        test_ds = TTDatasetStacksPacked(df_test, class_column=class_column)
+    else:
+        test_ds = TTDatasetStacks(df_test, mount_point=args.mount_point, img_column=img_column, class_column=class_column)
     test_data = DataLoader(test_ds, shuffle=False, batch_size=args.batch_size, num_workers=args.num_workers, persistent_workers=True, pin_memory=True)    
 
     if args.nn == "efficientnet_v2s_stacks":
-        model = EfficientnetV2sStacks(args, out_features=args.out_features, features=True).load_from_checkpoint(args.model)
+        model = load_model(EfficientnetV2sStacks, args.model)
         model.features = True
     elif args.nn == "efficientnet_v2s_stacks_dot":
-        model = EfficientnetV2sStacksDot(args, out_features=args.out_features, features=True).load_from_checkpoint(args.model)
+        model = load_model(EfficientnetV2sStacksDot, args.model)
         model.features = True
     elif args.nn == "mobilenet_v2_stacks":
-        model = MobileNetV2Stacks(args, out_features=args.out_features, features=True).load_from_checkpoint(args.model)
+        model = load_model(MobileNetV2Stacks, args.model)
         model.features = True
     
+    device = get_device(args)
+
     model.eval()
-    model.cuda()
+    model.to(device)
+
+    if args.compile:
+        compile_regions(model)
+
+    model = get_backend(model, args, transform=model.test_transform)
 
     probs = []
     features = []
@@ -48,7 +61,7 @@ def main(args):
 
     with torch.no_grad():        
         for idx, (X, Y) in enumerate(tqdm(test_data, total=len(test_data))):
-            X = X.cuda()
+            X = stack_to_float(X.to(device, non_blocking=True))
             x, x_a, x_s, x_v, x_v_p = model(X)
             probs.append(x)       
             features.append(x_a)
@@ -86,7 +99,12 @@ if __name__ == '__main__':
     parser.add_argument('--mount_point', help='Dataset mount directory', type=str, default="./")
     parser.add_argument('--num_workers', help='Number of workers for loading', type=int, default=4)
     parser.add_argument('--batch_size', help='Batch size', type=int, default=32)
+    parser.add_argument('--packed', help='The csv is an index written by pack_stacks.py', type=int, default=0)
     parser.add_argument('--nn', help='Type of neural network', type=str, default="efficientnet_v2s_stacks")    
+    parser.add_argument('--backend', type=str, help='Inference backend, onnx runs the graph exported with export_onnx.py on the ONNX Runtime CPU provider', default="torch", choices=["torch", "onnx"])
+    parser.add_argument('--onnx', type=str, help='Stack classifier exported with export_onnx.py for --backend onnx', default=None)
+    parser.add_argument('--onnx_threads', type=int, help='ONNX Runtime intra op threads, 0 uses the default', default=0)
+    parser.add_argument('--compile', type=int, default=0, help='Compile the feature extractor and attention/prediction head of the model with torch.compile')
     
 
 
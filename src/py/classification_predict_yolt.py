@@ -8,12 +8,16 @@ from monai.data.utils import pad_list_data_collate
 
 import torch
 from torch import nn
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, SequentialSampler
 import monai
 
 from nets import classification
-from loaders.tt_dataset import TTDatasetSeg, TrainTransformsFullSeg, EvalTransformsFullSeg
+from loaders.tt_dataset import TTDatasetSeg, TrainTransformsFullSeg, EvalTransformsFullSeg, BucketBatchSampler, get_image_sizes
 import pickle
+from prediction_writer import PredictionWriter
+from utils import compile_regions
+from onnx_backend import get_backend, get_device
+from slim_checkpoint import load_model
 
 from tqdm import tqdm
 
@@ -23,52 +27,110 @@ def replace_last(str, old, new):
     idx = str.rfind(old)
     return str[:idx] + new + str[idx+len(old):]
 
-def main(args):
+def get_loader(df, args):
+    # Images with similar sizes are batched together, the batches hold the row positions in df
+    eval_transform = EvalTransformsFullSeg()
 
-    if(os.path.splitext(args.csv_test)[1] == ".csv"):        
-        df_test = pd.read_csv(args.csv_test)
-    else:        
-        df_test = pd.read_parquet(args.csv_test)
+    test_ds = monai.data.Dataset(TTDatasetSeg(df, mount_point=args.mount_point, img_column=args.img_column, seg_column=args.seg_column, class_column=args.class_column), transform=eval_transform)
 
-    NN = getattr(classification, args.nn)
+    sizes = get_image_sizes(df, mount_point=args.mount_point, img_column=args.img_column)
+    batch_sampler = BucketBatchSampler(SequentialSampler(test_ds), sizes, args.batch_size, bucket_size=max(len(test_ds), 1), shuffle=False)
 
-    model = NN.load_from_checkpoint(args.model)
-    model.cuda()
-    model.eval()
-    
-    eval_transform = EvalTransformsFullSeg()
+    test_loader = DataLoader(test_ds, batch_sampler=batch_sampler, num_workers=args.num_workers, pin_memory=False, collate_fn=pad_list_data_collate)
 
-    test_ds = monai.data.Dataset(TTDatasetSeg(df_test, mount_point=args.mount_point, img_column=args.img_column, seg_column=args.seg_column, class_column=args.class_column), transform=eval_transform)
+    return list(batch_sampler), test_loader
 
-    test_loader = DataLoader(test_ds, batch_size=1, num_workers=args.num_workers,pin_memory=False, drop_last=True, collate_fn=pad_list_data_collate)
+def predict(model, df_test, args):
+    # Only pred and probs are kept (on the CPU), the features are written by predict_stream
 
-    pred,  features, features_v = [], [], []
+    batches, test_loader = get_loader(df_test, args)
+    order = [idx for batch_idx in batches for idx in batch_idx]
+
+    pred = []
     probs = []
-    softmax = nn.Softmax()
+    softmax = nn.Softmax(dim=1)
+    device = next(model.parameters()).device
 
     with torch.no_grad():
         for idx, batch in tqdm(enumerate(test_loader), total=len(test_loader)):
             for k in batch:
-                batch[k] = batch[k].cuda(non_blocking=True)
-            x, _, x_a, x_v = model(batch)
+                batch[k] = batch[k].to(device, non_blocking=True)
+            x = model(batch)[0]
 
-            x = x.detach().squeeze()
-            features.append(x_a)
-            features_v.append(x_v)
+            pred.extend(torch.argmax(x, dim=1).cpu().numpy())
+            probs.extend(softmax(x).cpu().numpy())
 
-            pred.append(torch.argmax(x).cpu().numpy())
-            probs.append(softmax(x).cpu().numpy())
+    # Back to the csv order
+    inverse = np.argsort(order)
+    pred = [pred[i] for i in inverse]
+    probs = [probs[i] for i in inverse]
 
-    features = torch.cat(features, dim=0).cpu().numpy()
-    features_v = torch.cat(features_v, dim=0).cpu().numpy()
+    return pred, probs
 
-    df_test["pred"] = pred
+def predict_stream(model, df_test, args, out_name):
+    # Writes every batch as soon as it is computed, rows already written by a previous run are skipped
+
+    writer = PredictionWriter(out_name, len(df_test), flush_every=args.flush_every)
+
+    rows = np.setdiff1d(np.arange(len(df_test)), writer.written_rows())
+    print("Rows to predict:", len(rows), "of", len(df_test))
+
+    if len(rows) > 0:
+        batches, test_loader = get_loader(df_test.iloc[rows].reset_index(drop=True), args)
+
+        softmax = nn.Softmax(dim=1)
+        device = next(model.parameters()).device
+
+        with torch.no_grad():
+            for batch_idx, batch in tqdm(zip(batches, test_loader), total=len(batches)):
+                for k in batch:
+                    batch[k] = batch[k].to(device, non_blocking=True)
+                x, _, x_a, x_v = model(batch)
+
+                writer.write(rows[batch_idx], torch.argmax(x, dim=1).cpu().numpy(), softmax(x).cpu().numpy(), x_a.cpu().numpy(), [v.cpu().numpy() for v in x_v])
+
+    writer.close()
+
+    df_pred = writer.read()
+    prob_columns = [c for c in df_pred.columns if c.startswith("prob_")]
+
+    return list(df_pred["pred"].values), list(df_pred[prob_columns].values.astype(np.float32))
+
+def main(args):
+
+    if(os.path.splitext(args.csv_test)[1] == ".csv"):        
+        df_test = pd.read_csv(args.csv_test)
+    else:        
+        df_test = pd.read_parquet(args.csv_test)
+
+    NN = getattr(classification, args.nn)
+
+    model = load_model(NN, args.model)
+    model.to(get_device(args))
+    model.eval()
+
+    if args.compile:
+        compile_regions(model)
+
+    if args.backend == "onnx":
+        # The bounding box crop and the patch extraction stay in torch, the graph runs the head
+        if not hasattr(model, "head"):
+            raise ValueError(args.nn + " has no head module, --backend onnx needs a YOLT model with a head (EfficientNetV2SYOLTv2)")
+        model.head = get_backend(model.head, args)
 
     out_name = os.path.join(os.path.basename(os.path.dirname(args.model)), os.path.splitext(os.path.basename(args.csv_test))[0] + "_" + os.path.splitext(os.path.basename(args.model))[0] + "_prediction")
     out_name = os.path.join(args.out, out_name)
     out_dir = os.path.dirname(out_name)
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
+
+    if args.stream:
+        pred, probs = predict_stream(model, df_test, args, out_name)
+    else:
+        pred, probs = predict(model, df_test, args)
+
+    df_test["pred"] = pred
+
     print("Writing:", out_name)
     df_test.to_csv(out_name + ".csv", index=False)
     pickle.dump(probs, open(out_name + ".pickle", 'wb'))
@@ -84,6 +146,7 @@ if __name__ == '__main__':
     input_group.add_argument('--model', help='Model for inference', type=str, required=True)
     input_group.add_argument('--mount_point', help='Dataset mount directory', type=str, default="./")    
     input_group.add_argument('--num_workers', help='Number of workers for loading', type=int, default=4)
+    input_group.add_argument('--batch_size', help='Batch size, images with similar sizes are batched together', type=int, default=1)
     input_group.add_argument('--csv_test', required=True, type=str, help='Test CSV')
     input_group.add_argument('--img_column', type=str, default="img_path", help='Name of image column in csv')
     input_group.add_argument('--seg_column', type=str, default="seg_path", help='Name of segmentation column in csv')
@@ -92,9 +155,15 @@ if __name__ == '__main__':
     hparams_group = parser.add_argument_group('Hyperparameters')
 
     hparams_group.add_argument('--nn', help='Type of PL neural network', type=str, default="MobileYOLT")
+    hparams_group.add_argument('--backend', type=str, help='Inference backend, onnx runs the graph exported with export_onnx.py on the ONNX Runtime CPU provider', default="torch", choices=["torch", "onnx"])
+    hparams_group.add_argument('--onnx', type=str, help='YOLT head exported with export_onnx.py for --backend onnx', default=None)
+    hparams_group.add_argument('--onnx_threads', type=int, help='ONNX Runtime intra op threads, 0 uses the default', default=0)
+    hparams_group.add_argument('--compile', type=int, default=0, help='Compile the feature extractor and attention/prediction head of the model with torch.compile')
 
     output_group = parser.add_argument_group('Output')
     output_group.add_argument('--out', help='Output directory', type=str, default='./out')
+    output_group.add_argument('--stream', help='Write the predictions and features incrementally (parquet parts and npy memmaps), an interrupted run resumes from the last flushed row. Without it only the csv with pred and the pickle with probs are written, kept in memory until the end', type=int, default=0)
+    output_group.add_argument('--flush_every', help='Number of rows between flushes in stream mode', type=int, default=1024)
 
     args = parser.parse_args()
     
@@ -86,7 +86,7 @@ def main(args):
         args_params['class_weights'] = unique_class_weights
     
 
-    ttdata = TTDataModule(df_train, df_val, df_test, batch_size=args.batch_size, num_workers=args.num_workers, img_column=args.img_column, class_column=args.class_column, mount_point=args.mount_point)
+    ttdata = TTDataModule(df_train, df_val, df_test, batch_size=args.batch_size, num_workers=args.num_workers, img_column=args.img_column, class_column=args.class_column, mount_point=args.mount_point, pad=args.pad_batch, pin_memory=args.pin_memory, pin_pool=args.pin_pool)
 
 
     checkpoint_callback = ModelCheckpoint(
@@ -100,6 +100,9 @@ def main(args):
 
     NN = getattr(classification, args.nn)
     model = NN(**args_params)    
+
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
     
     early_stop_callback = EarlyStopping(monitor="val_loss", min_delta=0.00, patience=args.patience, verbose=True, mode="min")
 
@@ -136,10 +139,11 @@ def main(args):
         logger=logger,
         max_epochs=args.epochs,
         callbacks=[ checkpoint_callback, early_stop_callback],
-        devices=torch.cuda.device_count(), 
-        accelerator="gpu", 
+        devices=torch.cuda.device_count() if args.accelerator == "gpu" else 1, 
+        accelerator=args.accelerator, 
         strategy=DDPStrategy(find_unused_parameters=False),
-        log_every_n_steps=args.log_every_n_steps
+        log_every_n_steps=args.log_every_n_steps,
+        precision=args.precision
     )
     trainer.fit(model, datamodule=ttdata, ckpt_path=args.model)
 
@@ -162,6 +166,9 @@ if __name__ == '__main__':
     input_group.add_argument('--model', help='Model path to continue training', type=str, default=None)
     input_group.add_argument('--mount_point', help='Dataset mount directory', type=str, default="./")
     input_group.add_argument('--num_workers', help='Number of workers for loading', type=int, default=4)
+    input_group.add_argument('--pad_batch', help='Pad the images of a batch to the largest one, 0 expects images of the same size', type=int, default=1)
+    input_group.add_argument('--pin_memory', help='Collate the batches in pinned memory', type=int, default=0)
+    input_group.add_argument('--pin_pool', help='With --pin_memory and --num_workers 0, reuse a pool of this many pinned batches, a batch is overwritten that many batches later', type=int, default=0)
 
     input_group.add_argument('--img_column', help='image column name in csv', type=str, default="img")
     input_group.add_argument('--class_column', help='class column name in csv', type=str, default="class")
@@ -183,6 +190,10 @@ if __name__ == '__main__':
     hparams_group.add_argument('--patience', help='Max number of patience steps for EarlyStopping', type=int, default=30)
     hparams_group.add_argument('--feature_size', help='dimension of feature space', type=int, default=1536)
     hparams_group.add_argument('--dropout', help='dropout', type=float, default=0.2)
+    hparams_group.add_argument('--precision', type=str, default="32", choices=["32", "16-mixed", "bf16-mixed"], help='Trainer precision, the mixed modes run the forward under autocast and keep the losses in float32')
+    hparams_group.add_argument('--channels_last', type=int, default=0, help='Train with the channels last memory format')
+    hparams_group.add_argument('--accelerator', type=str, default="gpu", choices=["gpu", "cpu"], help='Trainer accelerator, cpu runs a single device, e.g., to check --precision bf16-mixed')
+    hparams_group.add_argument('--batch_aug', help='Draw the train augmentation parameters per sample and run them batched on the device', type=int, default=0)
 
     logger_group = parser.add_argument_group('Logger')
     logger_group.add_argument('--log_every_n_steps', help='Log every n steps', type=int, default=50)    
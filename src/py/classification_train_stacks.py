@@ -9,6 +9,7 @@ import torch
 
 from nets.classification import EfficientnetV2s, EfficientnetV2sStacks, EfficientnetV2sStacksDot, EfficientnetV2sStacksSigDot, MobileNetV2, MobileNetV2Stacks
 from loaders.tt_dataset import TTDataModuleStacks
+from utils import compile_regions
 
 from pytorch_lightning import Trainer
 from pytorch_lightning.callbacks.early_stopping import EarlyStopping
@@ -32,6 +33,12 @@ def main(args):
     valid_fn = os.path.join(args.mount_point, 'Analysis_Set_202208', 'trachoma_bsl_mtss_besrat_field_train_202208_stacks_eval.csv')
     test_fn = os.path.join(args.mount_point, 'Analysis_Set_202208', 'trachoma_bsl_mtss_besrat_field_train_202208_stacks_eval.csv')
 
+    if args.packed:
+        # Index files written by pack_stacks.py
+        train_fn = os.path.splitext(train_fn)[0] + "_packed.csv"
+        valid_fn = os.path.splitext(valid_fn)[0] + "_packed.csv"
+        test_fn = os.path.splitext(test_fn)[0] + "_packed.csv"
+
     class_column = "class"
     img_column = "image"
     df_train = pd.read_csv(train_fn)    
@@ -52,7 +59,7 @@ def main(args):
     df_test = pd.read_csv(test_fn)
     df_test[class_column] = df_test[class_column].replace(class_replace).astype(int)
     
-    ttdata = TTDataModuleStacks(df_train, df_val, df_test, batch_size=args.batch_size, num_workers=args.num_workers, img_column=img_column, class_column=class_column)
+    ttdata = TTDataModuleStacks(df_train, df_val, df_test, batch_size=args.batch_size, num_workers=args.num_workers, img_column=img_column, class_column=class_column, packed=args.packed)
 
 
     checkpoint_callback = ModelCheckpoint(
@@ -88,6 +95,12 @@ def main(args):
     elif args.nn == "mobilenet_v2_stacks":
         model = MobileNetV2Stacks(args, out_features=unique_classes.shape[0], class_weights=unique_class_weights, model_patches=model_patches)
 
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+
+    if args.compile:
+        compile_regions(model)
+
     early_stop_callback = EarlyStopping(monitor="val_loss", min_delta=0.00, patience=30, verbose=True, mode="min")
 
     if args.tb_dir:
@@ -97,10 +110,11 @@ def main(args):
         logger=logger,
         max_epochs=args.epochs,
         callbacks=[early_stop_callback, checkpoint_callback],
-        devices=torch.cuda.device_count(), 
-        accelerator="gpu", 
+        devices=torch.cuda.device_count() if args.accelerator == "gpu" else 1, 
+        accelerator=args.accelerator, 
         strategy=DDPStrategy(find_unused_parameters=False),
-        log_every_n_steps=args.log_every_n_steps
+        log_every_n_steps=args.log_every_n_steps,
+        precision=args.precision
     )
     trainer.fit(model, datamodule=ttdata, ckpt_path=args.model)
 
@@ -118,7 +132,14 @@ if __name__ == '__main__':
     parser.add_argument('--mount_point', help='Dataset mount directory', type=str, default="./")
     parser.add_argument('--num_workers', help='Number of workers for loading', type=int, default=4)
     parser.add_argument('--batch_size', help='Batch size', type=int, default=64)
+    parser.add_argument('--packed', help='Read the uint8 stacks packed with pack_stacks.py', type=int, default=0)
     parser.add_argument('--nn', help='Type of neural network', type=str, default="efficientnet_v2s_stacks")    
+    parser.add_argument('--batch_aug', help='Draw the train augmentation parameters per stack and run them batched on the device', type=int, default=0)
+    parser.add_argument('--batch_aug_per_frame', help='Draw the batched augmentation parameters per frame instead of per stack', type=int, default=0)
+    parser.add_argument('--precision', type=str, default="32", choices=["32", "16-mixed", "bf16-mixed"], help='Trainer precision, the mixed modes run the forward under autocast and keep the losses in float32')
+    parser.add_argument('--channels_last', type=int, default=0, help='Train with the channels last memory format')
+    parser.add_argument('--accelerator', type=str, default="gpu", choices=["gpu", "cpu"], help='Trainer accelerator, cpu runs a single device, e.g., to check --precision bf16-mixed')
+    parser.add_argument('--compile', type=int, default=0, help='Compile the feature extractor and attention/prediction head of the model with torch.compile')
     parser.add_argument('--tb_dir', help='Tensorboard output dir', type=str, default=None)
     parser.add_argument('--tb_name', help='Tensorboard experiment name', type=str, default="classification_efficientnet_v2s")
 
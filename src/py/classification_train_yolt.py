@@ -10,7 +10,7 @@ import torch
 torch.set_float32_matmul_precision('medium')
 
 from nets import classification
-from loaders.tt_dataset import TTDataModuleSeg, TrainTransformsFullSeg, EvalTransformsFullSeg
+from loaders.tt_dataset import TTDataModuleSeg, TrainTransformsFullSeg, TrainTransformsFullSegGPU, EvalTransformsFullSeg
 
 from pytorch_lightning import Trainer
 from pytorch_lightning.callbacks.early_stopping import EarlyStopping
@@ -22,6 +22,7 @@ from pytorch_lightning import loggers as pl_loggers
 from sklearn.utils import class_weight
 
 from callbacks.logger import StackImageLogger
+from utils import compile_regions
 
 
 def replace_last(str, old, new):
@@ -70,7 +71,16 @@ def main(args):
             for param in model_feat.parameters():
                 param.requires_grad = False
         model.set_feat_model(model_feat)
-    train_transform = TrainTransformsFullSeg()
+
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+
+    if args.compile:
+        compile_regions(model)
+    if args.gpu_aug:
+        train_transform = TrainTransformsFullSegGPU()
+    else:
+        train_transform = TrainTransformsFullSeg()
     eval_transform = EvalTransformsFullSeg()
 
 
@@ -81,7 +91,7 @@ def main(args):
         g_val = df_val.groupby(args.class_column)
         df_val = g_val.apply(lambda x: x.sample(g_val.size().min())).reset_index(drop=True).sample(frac=1).reset_index(drop=True)
     
-    ttdata = TTDataModuleSeg(df_train, df_val, df_test, batch_size=args.batch_size, num_workers=args.num_workers, img_column=args.img_column, seg_column=args.seg_column, class_column=args.class_column, mount_point=args.mount_point, train_transform=train_transform, valid_transform=eval_transform, test_transform=eval_transform, drop_last=True)
+    ttdata = TTDataModuleSeg(df_train, df_val, df_test, batch_size=args.batch_size, num_workers=args.num_workers, img_column=args.img_column, seg_column=args.seg_column, class_column=args.class_column, mount_point=args.mount_point, train_transform=train_transform, valid_transform=eval_transform, test_transform=eval_transform, drop_last=True, cache=args.cache, cache_dir=args.cache_dir, bucket=args.bucket, bucket_size=args.bucket_size)
 
 
     checkpoint_callback = ModelCheckpoint(
@@ -117,12 +127,13 @@ def main(args):
         logger=logger,
         max_epochs=args.epochs,
         callbacks=[early_stop_callback, checkpoint_callback],
-        devices=torch.cuda.device_count(), 
-        accelerator="gpu", 
+        devices=torch.cuda.device_count() if args.accelerator == "gpu" else 1, 
+        accelerator=args.accelerator, 
         strategy=DDPStrategy(find_unused_parameters=False),
         log_every_n_steps=args.log_every_n_steps,
         accumulate_grad_batches=args.accumulate_grad_batches,
-        reload_dataloaders_every_n_epochs=1
+        reload_dataloaders_every_n_epochs=1,
+        precision=args.precision
     )
     trainer.fit(model, datamodule=ttdata, ckpt_path=args.model)
     
@@ -146,6 +157,10 @@ def get_argparse():
     input_group.add_argument('--seg_column', type=str, default="seg_path", help='Name of segmentation column in csv')
     input_group.add_argument('--class_column', type=str, default="class", help='Name of class column in csv')
     input_group.add_argument('--balanced', type=int, default=0, help='Balance the dataframes')
+    input_group.add_argument('--cache', type=str, default="off", choices=["off", "ram", "disk"], help='Cache the decoded images and segmentations as memory mapped shards')
+    input_group.add_argument('--cache_dir', type=str, default=None, help='Cache directory, defaults to /dev/shm for ram and the temp directory for disk')
+    input_group.add_argument('--bucket', type=int, default=0, help='Batch images with similar sizes together')
+    input_group.add_argument('--bucket_size', type=int, default=32, help='Number of batches sorted together when bucketing')
 
     weight_group = input_group.add_mutually_exclusive_group()
     weight_group.add_argument('--balanced_weights', type=int, default=0, help='Compute weights for balancing the data')
@@ -164,6 +179,11 @@ def get_argparse():
     hparams_group.add_argument('--accumulate_grad_batches', help='Accumulate gradient steps', type=int, default=1)
     hparams_group.add_argument('--pad', help='Pad the bounding box', type=float, default=0.1)
     hparams_group.add_argument('--square_pad', help='how to pad the image', type=int, default=0)
+    hparams_group.add_argument('--gpu_aug', help='Run the intensity augmentation on the device for the whole batch', type=int, default=0)
+    hparams_group.add_argument('--precision', type=str, default="32", choices=["32", "16-mixed", "bf16-mixed"], help='Trainer precision, the mixed modes run the forward under autocast and keep the losses in float32')
+    hparams_group.add_argument('--channels_last', type=int, default=0, help='Train with the channels last memory format')
+    hparams_group.add_argument('--accelerator', type=str, default="gpu", choices=["gpu", "cpu"], help='Trainer accelerator, cpu runs a single device, e.g., to check --precision bf16-mixed')
+    hparams_group.add_argument('--compile', type=int, default=0, help='Compile the feature extractor and attention/prediction head of the model with torch.compile')
     
     logger_group = parser.add_argument_group('Logger')
     logger_group.add_argument('--log_every_n_steps', help='Log every n steps', type=int, default=10)
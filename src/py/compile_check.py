@@ -0,0 +1,65 @@
+import argparse
+import sys
+
+import torch
+
+from nets.classification import EfficientNetV2SYOLTv2, EfficientnetV2sStacksDot
+from nets.segmentation import TTUNet
+from utils import explain_regions
+
+# Checks that the regions compiled with --compile have no graph breaks.
+# The models are built with random weights and called once on random inputs, the graph breaks of every region are printed
+# and the exit code is 1 if there is any.
+
+def check_yolt(args, device):
+    model = EfficientNetV2SYOLTv2(out_features=2, lr=1e-4, pad=0.1, num_patches=5, patch_size=(256, 256), square_pad=0).to(device).eval()
+
+    seg = torch.zeros(args.batch_size, 1, args.image_size, args.image_size, device=device)
+    seg[:, :, args.image_size//4:args.image_size//2, args.image_size//8:-args.image_size//8] = 3
+    X = {"img": torch.rand(args.batch_size, 3, args.image_size, args.image_size, device=device), "seg": seg}
+
+    return explain_regions(model, lambda: model(X))
+
+def check_stacks_dot(args, device):
+    model = EfficientnetV2sStacksDot(argparse.Namespace(lr=1e-4), out_features=2).to(device).eval()
+
+    x = torch.rand(args.batch_size, 4, 3, 448, 448, device=device)
+
+    return explain_regions(model, lambda: model(x))
+
+def check_unet(args, device):
+    model = TTUNet(out_channels=4, lr=1e-4).to(device).eval()
+
+    x = torch.rand(args.batch_size, 3, 512, 512, device=device)
+
+    return explain_regions(model, lambda: model(x))
+
+def main(args):
+
+    device = torch.device(args.device)
+
+    checks = {"EfficientNetV2SYOLTv2": check_yolt, "EfficientnetV2sStacksDot": check_stacks_dot, "TTUNet": check_unet}
+
+    num_breaks = 0
+    for nn_name in args.nn:
+        for region, (count, reasons) in checks[nn_name](args, device).items():
+            print(nn_name, region, "graph breaks:", count)
+            for reason in reasons:
+                print("   ", reason)
+            num_breaks += count
+
+    if num_breaks > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Report the graph breaks of the compiled regions')
+    parser.add_argument('--nn', help='Models to check', type=str, nargs='+', default=["EfficientNetV2SYOLTv2", "EfficientnetV2sStacksDot", "TTUNet"], choices=["EfficientNetV2SYOLTv2", "EfficientnetV2sStacksDot", "TTUNet"])
+    parser.add_argument('--batch_size', help='Batch size of the random inputs', type=int, default=2)
+    parser.add_argument('--image_size', help='Size of the random YOLT images', type=int, default=1024)
+    parser.add_argument('--device', help='Device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+
+    args = parser.parse_args()
+
+    main(args)
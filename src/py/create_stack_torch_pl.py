@@ -4,11 +4,17 @@ import argparse
 from collections import namedtuple
 
 import torch
+from torch.utils.data import Dataset, DataLoader
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import multiprocessing as mp
+from tqdm import tqdm
 
 from nets.segmentation import TTUNet
 from loaders.tt_dataset import InTransformsSeg, OutTransformsSeg
 
 import resample
+import resample_torch
 import poly_fit as pf
 import os
 import sys
@@ -19,6 +25,8 @@ import pickle
 
 from sklearn.metrics import classification_report
 from nets.classification import EfficientnetV2sStacksDot
+from onnx_backend import get_backend, get_device
+from slim_checkpoint import load_model
 
 import glob
 
@@ -34,17 +42,7 @@ class bcolors:
     UNDERLINE = '\033[4m'
 
 
-def create_stack(img, model_seg, args):
-
-    if torch.cuda.is_available():
-        device = torch.device("cuda")
-    else:
-        device = torch.device("cpu")
-
-    transforms_in = InTransformsSeg()
-
-    transforms_out = OutTransformsSeg()
-
+def get_resample_in_args():
     resample_obj = {}
     resample_obj["size"] = [512, 512]
     resample_obj["fit_spacing"] = True
@@ -55,9 +53,34 @@ def create_stack(img, model_seg, args):
     resample_obj["spacing"] = None
     resample_obj["origin"] = None
 
-    resample_args = namedtuple("resample_args", resample_obj.keys())(*resample_obj.values())
+    return namedtuple("resample_args", resample_obj.keys())(*resample_obj.values())
 
-    img_resampled = resample.resample_fn(img, resample_args)
+def get_resample_out_args(size, spacing, origin):
+    resample_obj = {}
+    resample_obj["size"] = size
+    resample_obj["fit_spacing"] = False
+    resample_obj["iso_spacing"] = False
+    resample_obj["image_dimension"] = 2
+    resample_obj["pixel_dimension"] = 1
+    resample_obj["center"] = False  
+    resample_obj["linear"] = False
+    resample_obj["spacing"] = spacing
+    resample_obj["origin"] = origin
+
+    return namedtuple("resample_args", resample_obj.keys())(*resample_obj.values())
+
+def create_stack(img, model_seg, args):
+
+    if torch.cuda.is_available():
+        device = torch.device("cuda")
+    else:
+        device = torch.device("cpu")
+
+    transforms_in = InTransformsSeg()
+
+    transforms_out = OutTransformsSeg()
+
+    img_resampled = resample.resample_fn(img, get_resample_in_args())
 
     img_resampled_np = sitk.GetArrayFromImage(img_resampled)
     
@@ -69,22 +92,8 @@ def create_stack(img, model_seg, args):
     seg_resampled = sitk.GetImageFromArray(seg_resampled_np, isVector=True)
     seg_resampled.SetSpacing(img_resampled.GetSpacing())
     seg_resampled.SetOrigin(img_resampled.GetOrigin())
-    
-    resample_obj = {}
-    resample_obj["size"] = img.GetSize()
-    resample_obj["fit_spacing"] = False
-    resample_obj["iso_spacing"] = False
-    resample_obj["image_dimension"] = 2
-    resample_obj["pixel_dimension"] = 1
-    resample_obj["center"] = False  
-    resample_obj["linear"] = False
-    resample_obj["spacing"] = img.GetSpacing()
-    resample_obj["origin"] = img.GetOrigin()
 
-    resample_args = namedtuple("resample_args", resample_obj.keys())(*resample_obj.values())
-    
-
-    seg = resample.resample_fn(seg_resampled, resample_args)
+    seg = resample.resample_fn(seg_resampled, get_resample_out_args(img.GetSize(), img.GetSpacing(), img.GetOrigin()))
     
     seg_np = sitk.GetArrayFromImage(seg)
     img_np = sitk.GetArrayFromImage(img)    
@@ -97,6 +106,197 @@ def create_stack(img, model_seg, args):
 
     return out_stack, seg
 
+def scale_intensity(x):
+    # Same as the ScaleIntensity in InTransformsSeg for a batch [B, C, H, W]
+    x = x.to(torch.float32)
+    x_min = torch.amin(x, dim=(1, 2, 3), keepdim=True)
+    x_max = torch.amax(x, dim=(1, 2, 3), keepdim=True)
+    return (x - x_min)/torch.clamp(x_max - x_min, min=1e-8)
+
+def create_stacks_torch(imgs_t, spacings, origins, model_seg, args):
+    # Device version of create_stack, the images [H, W, 3] uint8 never leave the device.
+    # Downsample, segment the batch, upsample the label maps and poly fit with torch ops.
+    resample_in_args = get_resample_in_args()
+
+    x = []
+    resampled_meta = []
+    for img_t, spacing, origin in zip(imgs_t, spacings, origins):
+        x_t, x_spacing, x_origin = resample_torch.resample_fn(img_t.permute(2, 0, 1).unsqueeze(0), resample_in_args, spacing, origin)
+        x.append(x_t)
+        resampled_meta.append((x_spacing, x_origin))
+
+    seg_resampled_t = model_seg(scale_intensity(torch.cat(x)))
+
+    out_stacks = []
+    segs = []
+    for img_t, spacing, origin, seg_r_t, (x_spacing, x_origin) in zip(imgs_t, spacings, origins, seg_resampled_t, resampled_meta):
+        size = [img_t.shape[1], img_t.shape[0]]
+        seg_t, _, _ = resample_torch.resample_fn(seg_r_t, get_resample_out_args(size, spacing, origin), x_spacing, x_origin)
+        seg_t = seg_t[0].to(torch.uint8)
+
+        out_stacks.append(pf.poly_fit_torch(img_t, seg_t, 3, args.stack_size, args.stack_samples))
+        segs.append(seg_t)
+
+    return out_stacks, segs
+
+def create_stack_torch(img, model_seg, args, device):
+
+    img_t = torch.from_numpy(sitk.GetArrayFromImage(img)).to(device)
+
+    with torch.inference_mode():
+        out_stacks, segs = create_stacks_torch([img_t], [img.GetSpacing()], [img.GetOrigin()], model_seg, args)
+
+    out_stack = sitk.GetImageFromArray(out_stacks[0].cpu().numpy(), isVector=True)
+
+    seg = sitk.GetImageFromArray(segs[0].unsqueeze(-1).cpu().numpy(), isVector=True)
+    seg.SetSpacing(img.GetSpacing())
+    seg.SetOrigin(img.GetOrigin())
+
+    return out_stack, seg
+
+def write_image(img, fn):
+    writer = sitk.ImageFileWriter()
+    writer.SetFileName(fn)
+    writer.UseCompressionOn()
+    writer.Execute(img)
+
+class ResampledImageDataset(Dataset):
+    # Reads and resamples the images to the segmentation size in the DataLoader workers
+    def __init__(self, img_out):
+        self.img_out = img_out
+        self.transforms_in = InTransformsSeg()
+
+    def __len__(self):
+        return len(self.img_out)
+
+    def __getitem__(self, idx):
+        obj = self.img_out[idx]
+        try:
+            img = sitk.ReadImage(obj["img"])
+            img_resampled = resample.resample_fn(img, get_resample_in_args())
+            img_t = self.transforms_in(sitk.GetArrayFromImage(img_resampled))[0]
+        except Exception as e:
+            print(bcolors.FAIL, obj["img"], e, bcolors.ENDC, file=sys.stderr)
+            return None
+
+        return img_t, {"obj": obj, "spacing": img_resampled.GetSpacing(), "origin": img_resampled.GetOrigin()}
+
+class ImageDataset(Dataset):
+    # Reads the full resolution images, the resampling happens on the device with resample_torch
+    def __init__(self, img_out):
+        self.img_out = img_out
+
+    def __len__(self):
+        return len(self.img_out)
+
+    def __getitem__(self, idx):
+        obj = self.img_out[idx]
+        try:
+            img = sitk.ReadImage(obj["img"])
+            img_t = torch.from_numpy(sitk.GetArrayFromImage(img))
+        except Exception as e:
+            print(bcolors.FAIL, obj["img"], e, bcolors.ENDC, file=sys.stderr)
+            return None
+
+        return img_t, {"obj": obj, "spacing": img.GetSpacing(), "origin": img.GetOrigin()}
+
+def collate_images(batch):
+    batch = [b for b in batch if b is not None]
+    if len(batch) == 0:
+        return [], []
+    img_t, meta = zip(*batch)
+    return list(img_t), list(meta)
+
+def collate_resampled(batch):
+    batch = [b for b in batch if b is not None]
+    if len(batch) == 0:
+        return None, []
+    img_t, meta = zip(*batch)
+    return torch.stack(img_t), list(meta)
+
+def post_process_stack(seg_resampled_np, meta, stack_size, stack_samples):
+    # Upsample the label map to the original image, poly fit and write the outputs. Runs in the post-processing pool.
+    obj = meta["obj"]
+
+    img = sitk.ReadImage(obj["img"])
+
+    seg_resampled = sitk.GetImageFromArray(seg_resampled_np, isVector=True)
+    seg_resampled.SetSpacing(meta["spacing"])
+    seg_resampled.SetOrigin(meta["origin"])
+
+    seg = resample.resample_fn(seg_resampled, get_resample_out_args(img.GetSize(), img.GetSpacing(), img.GetOrigin()))
+
+    out_np_stack = pf.poly_fit(sitk.GetArrayFromImage(img), sitk.GetArrayFromImage(seg), 3, stack_size, stack_samples)
+    out_stack = sitk.GetImageFromArray(out_np_stack, isVector=True)
+
+    if obj["out_seg"] is not None:
+        write_image(seg, obj["out_seg"])
+    write_image(out_stack, obj["out"])
+
+    return obj["out"]
+
+def write_stack(out_np_stack, seg_np, meta):
+    # Writes the outputs of create_stacks_torch. Runs in the post-processing pool.
+    obj = meta["obj"]
+
+    if obj["out_seg"] is not None:
+        seg = sitk.GetImageFromArray(seg_np, isVector=True)
+        seg.SetSpacing(meta["spacing"])
+        seg.SetOrigin(meta["origin"])
+        write_image(seg, obj["out_seg"])
+
+    write_image(sitk.GetImageFromArray(out_np_stack, isVector=True), obj["out"])
+
+    return obj["out"]
+
+def create_stacks_pipelined(img_out, model_seg, args, device):
+    # Reader pool (DataLoader workers) -> batched U-Net -> post-processing pool (upsample, poly fit, nrrd writes)
+    # With --torch_resample the resampling and the poly fit run on the device and the pool only writes the outputs
+
+    img_out = [obj for obj in img_out if args.ow or not os.path.exists(obj["out"])]
+
+    if args.torch_resample:
+        loader = DataLoader(ImageDataset(img_out), batch_size=args.batch_size, num_workers=args.num_workers, collate_fn=collate_images, pin_memory=device.type == "cuda")
+    else:
+        loader = DataLoader(ResampledImageDataset(img_out), batch_size=args.batch_size, num_workers=args.num_workers, collate_fn=collate_resampled, pin_memory=device.type == "cuda")
+
+    autocast_dtype = torch.float16 if device.type == "cuda" else torch.bfloat16
+    max_pending = 4*args.post_workers
+    pending = set()
+
+    def drain(futures):
+        for f in futures:
+            try:
+                print(bcolors.SUCCESS, "Writing:", f.result(), bcolors.ENDC)
+            except Exception as e:
+                print(bcolors.FAIL, e, bcolors.ENDC, file=sys.stderr)
+
+    with ProcessPoolExecutor(max_workers=args.post_workers, mp_context=mp.get_context("spawn")) as pool:
+        with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=autocast_dtype, enabled=bool(args.amp)):
+            for img_t, meta in tqdm(loader, total=len(loader)):
+                if len(meta) == 0:
+                    continue
+
+                if args.torch_resample:
+                    imgs_t = [x.to(device, non_blocking=True) for x in img_t]
+                    out_stacks, segs = create_stacks_torch(imgs_t, [m["spacing"] for m in meta], [m["origin"] for m in meta], model_seg, args)
+
+                    for out_stack_t, seg_t, m in zip(out_stacks, segs, meta):
+                        pending.add(pool.submit(write_stack, out_stack_t.cpu().numpy(), seg_t.unsqueeze(-1).cpu().numpy(), m))
+                else:
+                    seg_t = model_seg(img_t.to(device, non_blocking=True))
+                    seg_np = seg_t.permute(0, 2, 3, 1).to(torch.uint8).cpu().numpy()
+
+                    for seg_resampled_np, m in zip(seg_np, meta):
+                        pending.add(pool.submit(post_process_stack, seg_resampled_np, m, args.stack_size, args.stack_samples))
+
+                if len(pending) > max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    drain(done)
+
+        done, pending = wait(pending)
+        drain(done)
+
 # def create_stack_inferer(img, model_seg, args):
 
 #     device = torch.device("cuda:0")
@@ -138,20 +338,20 @@ def create_stack(img, model_seg, args):
 
 def main(args): 
 
-    if torch.cuda.is_available():
-        device = torch.device("cuda")
-    else:
-        device = torch.device("cpu")
+    device = get_device(args)
 
-    model_seg = TTUNet.load_from_checkpoint(args.seg_model, strict=False)
-    model_seg.eval()
-    model_seg.to(device)
+    if args.backend == "onnx":
+        model_seg = get_backend(None, args)
+    else:
+        model_seg = load_model(TTUNet, args.seg_model, strict=False)
+        model_seg.eval()
+        model_seg.to(device)
 
     img_out = []
 
     model_predict = None
     if args.predict_model:
-        model_predict = EfficientnetV2sStacksDot.load_from_checkpoint(args.predict_model)
+        model_predict = load_model(EfficientnetV2sStacksDot, args.predict_model)
         model_predict.eval()
         model_predict.to(device)
 
@@ -215,7 +415,7 @@ def main(args):
         df.to_csv(out_csv, index=False)
         
     else:
-        img_out.append({'img': args.img, 'out': args.out})
+        img_out.append({'img': args.img, 'out': args.out, 'out_seg': args.out_seg})
 
     probs = []
     # features = []
@@ -223,28 +423,28 @@ def main(args):
     # features_v = []
     # features_v_p = []
 
+    if args.pipelined:
+        create_stacks_pipelined(img_out, model_seg, args, device)
+
     for obj in img_out:
 
-        if args.ow or not os.path.exists(obj["out"]):
+        if not args.pipelined and (args.ow or not os.path.exists(obj["out"])):
 
             try:
                 print(bcolors.INFO, "Reading:", obj["img"], bcolors.ENDC)
                 img = sitk.ReadImage(obj["img"])  
 
-                out_stack, seg = create_stack(img, model_seg, args)
+                if args.torch_resample:
+                    out_stack, seg = create_stack_torch(img, model_seg, args, device)
+                else:
+                    out_stack, seg = create_stack(img, model_seg, args)
 
                 if obj["out_seg"] is not None:
                     print(bcolors.SUCCESS, "Writing:", obj["out_seg"], bcolors.ENDC)
-                    writer = sitk.ImageFileWriter()
-                    writer.SetFileName(obj["out_seg"])
-                    writer.UseCompressionOn()
-                    writer.Execute(seg)
+                    write_image(seg, obj["out_seg"])
 
                 print(bcolors.SUCCESS, "Writing:", obj["out"], bcolors.ENDC)
-                writer = sitk.ImageFileWriter()
-                writer.SetFileName(obj["out"])
-                writer.UseCompressionOn()
-                writer.Execute(out_stack)
+                write_image(out_stack, obj["out"])
             except Exception as e:
                 print(bcolors.FAIL, e, bcolors.ENDC, file=sys.stderr)
 
@@ -311,6 +511,19 @@ if __name__ == '__main__':
 
     parser.add_argument('--stack_size', type=int, help='Size w/h of the image stacks/frames', default=768)  
     parser.add_argument('--stack_samples', type=int, help='Stack samples', default=16)  
+    parser.add_argument('--torch_resample', type=int, help='Resample, segment and poly fit on the device with torch instead of SimpleITK', default=0)
+
+    pipeline_group = parser.add_argument_group('Pipelined mode')
+    pipeline_group.add_argument('--pipelined', type=int, help='Read, segment and post process the images in parallel pools', default=0)
+    pipeline_group.add_argument('--batch_size', type=int, help='Segmentation batch size', default=8)
+    pipeline_group.add_argument('--num_workers', type=int, help='Number of reader workers', default=4)
+    pipeline_group.add_argument('--post_workers', type=int, help='Number of post processing workers (upsample, poly fit and writes)', default=4)
+    pipeline_group.add_argument('--amp', type=int, help='Run the segmentation under autocast', default=0)
+
+    backend_group = parser.add_argument_group('Inference backend')
+    backend_group.add_argument('--backend', type=str, help='Inference backend, onnx runs the graph exported with export_onnx.py on the ONNX Runtime CPU provider', default="torch", choices=["torch", "onnx"])
+    backend_group.add_argument('--onnx', type=str, help='Segmentation model exported with export_onnx.py for --backend onnx', default=None)
+    backend_group.add_argument('--onnx_threads', type=int, help='ONNX Runtime intra op threads, 0 uses the default', default=0)
 
     output_group = parser.add_argument_group('Output parameters')
     output_group.add_argument('--out_seg', type=str, help='Output seg dir', default=None) 
@@ -1,6 +1,7 @@
 import os
 import dash
-from dash import Dash, html, dcc, Input, Output, State, dash_table
+from dash import Dash, html, dcc, Input, Output, State, dash_table, Patch
+from dash.exceptions import PreventUpdate
 from dash.dash_table.Format import Format, Scheme, Trim
 
 import plotly.express as px
@@ -10,7 +11,6 @@ import plotly.io as pio
 
 import numpy as np
 import pandas as pd
-from sklearn.decomposition import PCA
 import pickle
 import SimpleITK as sitk
 
@@ -20,6 +20,9 @@ from sklearn.metrics import classification_report
 
 from argparse import ArgumentParser
 
+from image_cache import ImageCache
+from embeddings import write_embeddings, load_embeddings, project, viewport_points
+
 pio.renderers.default = "chrome"
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
@@ -55,57 +58,115 @@ test_df[sev_col] = (test_df[sev_col] >= 1).astype(int)
 # with open(csv_path_stacks.replace(".csv", "_25042022_prediction.pickle"), 'rb') as f:
     # results_epi = pickle.load(f)
 
-with open(csv_path.replace(".csv", "_stacks_features.pickle"), 'rb') as f:
-    results_epi = pickle.load(f)
+# Memory mapped features and precomputed PCA, written on the first run or with python embeddings.py --features <csv>_stacks_features.pickle
+embeddings_dir = csv_path.replace(".csv", "_stacks_embeddings")
+if not os.path.exists(os.path.join(embeddings_dir, "projection.npz")):
+    write_embeddings(csv_path.replace(".csv", "_stacks_features.pickle"), embeddings_dir)
+emb = load_embeddings(embeddings_dir)
 
-x, x_a, x_s, x_v, x_v_p = results_epi
+x_s = emb.x_s
+x_v = emb.x_v
+x_v_p = emb.x_v_p
 
-x_s = np.max(x_s, axis=-1)
+test_df["pca_0"] = emb.pca[:,0]
+test_df["pca_1"] = emb.pca[:,1]
+test_df["pred"] = emb.pred
 
-pca_epi = PCA(n_components=2)
-pca_epi_fit = pca_epi.fit_transform(x_a)
-test_df["pca_0"] = pca_epi_fit[:,0]
-test_df["pca_1"] = pca_epi_fit[:,1]
-test_df["pred"] = np.argmax(x, axis=1)
+# Points drawn in the studies scatter, the rest are thinned by viewport_points
+max_points = 20000
 
-@app.callback(
-    Output('studies-img', 'figure'),    
-    Input('studies-img', 'clickData'),
-    Input('studies-img', 'figure'),
-    Input('colorby-dropdown', 'value'),
-    Input("studies-search", "value"))
-def studies_img(dict_points, fig, color_by, studies_search):
+# Decoded images and thumbnails, python image_cache.py --csv <csv_path> --thumb_dir <thumb_dir> --mount_point <mount_dir> --dirs <segmentation, stacks and cam dirs> --strip hinashah/
+thumb_dir = os.path.join(mount_dir, "hinashah/Analysis_Set_202208/thumbnails")
+image_cache = ImageCache(thumb_dir=thumb_dir if os.path.exists(thumb_dir) else None)
 
-    if fig is None:
-        fig = go.Figure()
-        fig.add_trace(go.Scatter(x=test_df["pca_0"], y=test_df["pca_1"], mode='markers', showlegend=False, marker=dict(size=(test_df["pred"] + 1)*5, colorscale='sunset', showscale=True, opacity=1, line=dict(color='red', width=1)
-        )))
-        fig.add_trace(go.Scatter(mode='markers', showlegend=False, marker=dict(line=dict(color='red', width=1))))
-    else:
-        fig = go.Figure(fig)
+def studies_color(points, color_by):
+    if color_by == 'max':
+        return emb.score_max[points]
+    return test_df[sev_col].values[points]
 
-    if dict_points is not None and dict_points["points"] is not None and len(dict_points["points"]) > 0 and dict_points["points"][0]["curveNumber"] == 0:        
+def studies_opacity(points, studies_search):
+    if studies_search is not None and studies_search != '':
+        return test_df[id_col].iloc[points].astype(str).str.match(studies_search).astype(float).values
+    return 1
+
+def studies_text(points):
+    return ['s: {:f}, c: {:f}, p: {:f}'.format(s, c, p) for s, c, p in zip(emb.score_max[points], test_df[sev_col].values[points], test_df['pred'].values[points])]
+
+def studies_figure(points):
+    fig = go.Figure()
+    fig.add_trace(go.Scattergl(x=emb.pca[points, 0], y=emb.pca[points, 1], customdata=points, text=studies_text(points), mode='markers', showlegend=False, marker=dict(size=(test_df["pred"].values[points] + 1)*5, color=studies_color(points, 'class'), colorscale='sunset', showscale=True, opacity=1, line=dict(color='red', width=1)
+    )))
+    fig.add_trace(go.Scattergl(mode='markers', showlegend=False, marker=dict(line=dict(color='red', width=1))))
+    # Keeps the zoom when the traces are patched
+    fig.update_layout(autosize=True, uirevision='studies')
+    return fig
+
+def relayout_ranges(relayout):
+    # Axis ranges of a zoom/pan, None for an autorange, PreventUpdate for the relayouts that do not move the axes
+    if relayout is None or not any(k.startswith('xaxis.') or k.startswith('yaxis.') for k in relayout):
+        raise PreventUpdate
+    ranges = []
+    for axis in ['xaxis', 'yaxis']:
+        if axis + '.range[0]' in relayout:
+            ranges.append((relayout[axis + '.range[0]'], relayout[axis + '.range[1]']))
+        elif axis + '.range' in relayout:
+            ranges.append(tuple(relayout[axis + '.range']))
+        else:
+            ranges.append(None)
+    return ranges
+
+@app.callback(
+    Output('studies-img', 'figure', allow_duplicate=True),
+    Output('studies-points', 'data'),
+    Input('studies-img', 'relayoutData'),
+    State('colorby-dropdown', 'value'),
+    State("studies-search", "value"),
+    prevent_initial_call=True)
+def studies_viewport(relayout, color_by, studies_search):
+    # Points of the new viewport, only the data of the studies trace is sent
+    x_range, y_range = relayout_ranges(relayout)
+    points = viewport_points(emb.pca, x_range, y_range, max_points)
+
+    fig = Patch()
+    fig['data'][0]['x'] = emb.pca[points, 0]
+    fig['data'][0]['y'] = emb.pca[points, 1]
+    fig['data'][0]['customdata'] = points
+    fig['data'][0]['text'] = studies_text(points)
+    fig['data'][0]['marker']['size'] = (test_df["pred"].values[points] + 1)*5
+    fig['data'][0]['marker']['color'] = studies_color(points, color_by)
+    fig['data'][0]['marker']['opacity'] = studies_opacity(points, studies_search)
+    return fig, points.tolist()
 
-        idx = dict_points["points"][0]["pointIndex"]
+@app.callback(
+    Output('studies-img', 'figure', allow_duplicate=True),
+    Input('colorby-dropdown', 'value'),
+    Input("studies-search", "value"),
+    State('studies-points', 'data'),
+    prevent_initial_call=True)
+def studies_style(color_by, studies_search, points):
+    points = np.array(points, dtype=int)
+
+    fig = Patch()
+    fig['data'][0]['marker']['color'] = studies_color(points, color_by)
+    fig['data'][0]['marker']['opacity'] = studies_opacity(points, studies_search)
+    return fig
 
-        fig.data[1]['x'] = [test_df.loc[idx]["pca_0"]]
-        fig.data[1]['y'] = [test_df.loc[idx]["pca_1"]]
+@app.callback(
+    Output('studies-img', 'figure', allow_duplicate=True),
+    Input('studies-img', 'clickData'),
+    prevent_initial_call=True)
+def studies_select(dict_points):
 
-        if(color_by == 'class'):
-            color = test_df[sev_col]
-        elif(color_by == 'max'):            
-            color = np.max(x_s, axis=1).reshape(-1)
+    if dict_points is not None and dict_points["points"] is not None and len(dict_points["points"]) > 0 and dict_points["points"][0]["curveNumber"] == 0:
 
-        fig.data[0]['marker']['color'] = color
-        fig.data[0]['text'] = ['s: {:f}, c: {:f}, p: {:f}'.format(s, c, p) for s, c, p in zip(np.max(x_s, axis=1).reshape(-1), test_df[sev_col], test_df['pred'])]        
-    
-    if studies_search is not None and studies_search != '':
-        fig.data[0]['marker']['opacity'] = (test_df[id_col].astype(str).str.match(studies_search).astype(float))
-    else:
-        fig.data[0]['marker']['opacity'] = 1
+        idx = dict_points["points"][0]["customdata"]
 
-    fig.update_layout(autosize=True)
-    return fig
+        fig = Patch()
+        fig['data'][1]['x'] = [test_df.loc[idx]["pca_0"]]
+        fig['data'][1]['y'] = [test_df.loc[idx]["pca_1"]]
+        return fig
+
+    raise PreventUpdate
 
 
 
@@ -124,7 +185,7 @@ def update_study(dict_points, fig_study, dict_points_study, frame_id):
     if fig_study is None:    
         fig_study = go.Figure()
         fig_study.add_trace(
-            go.Scatter(mode='markers', showlegend=False, marker=dict(showscale=True, size=10, cmin=np.min(x_v_p), cmax=np.max(x_v_p), colorscale='sunset', line=dict(color='red', width=1)))
+            go.Scatter(mode='markers', showlegend=False, marker=dict(showscale=True, size=10, cmin=emb.x_v_p_range[0], cmax=emb.x_v_p_range[1], colorscale='sunset', line=dict(color='red', width=1)))
             )
 
         fig_study.add_trace(go.Scatter(mode='markers', marker=dict(size=10, line=dict(color='magenta', width=2)), showlegend=False))
@@ -133,10 +194,9 @@ def update_study(dict_points, fig_study, dict_points_study, frame_id):
     
     if dict_points is not None and dict_points["points"] is not None and len(dict_points["points"]) > 0 and dict_points["points"][0]["curveNumber"] == 0:        
 
-        idx = dict_points["points"][0]["pointIndex"]
+        idx = dict_points["points"][0]["customdata"]
         
-        x_feat_idx = np.array(x_v[idx]).reshape(-1, 1536)
-        x_feat_idx_pca = pca_epi.transform(x_feat_idx)
+        x_feat_idx_pca = project(emb, x_v[idx])
 
         df_idx = pd.DataFrame({
             "pca_0": x_feat_idx_pca[:,0],
@@ -149,8 +209,8 @@ def update_study(dict_points, fig_study, dict_points_study, frame_id):
         fig_study.data[0]['y'] = df_idx["pca_1"]
         fig_study.data[0]['text'] = ['idx: {:d}, s: {:f}, p: {:f}'.format(i, s, p) for i, s, p in zip(range(len(df_idx)), df_idx['score'], df_idx['pred'])]
         fig_study.data[0]['marker']['color'] = df_idx["score"]
-        fig_study.data[0]['marker']['cmin'] = np.min(x_s)
-        fig_study.data[0]['marker']['cmax'] = np.max(x_s)
+        fig_study.data[0]['marker']['cmin'] = emb.x_s_range[0]
+        fig_study.data[0]['marker']['cmax'] = emb.x_s_range[1]
 
         if dict_points_study is not None and dict_points_study["points"] is not None and len(dict_points_study["points"]) > 0 and dict_points_study["points"][0]["curveNumber"] == 0:
                 fig_study.data[1]['x'] = [df_idx["pca_0"][frame_id]]
@@ -182,7 +242,7 @@ def update_img(dict_points, opacity, size):
     idx = -1
     if dict_points is not None and dict_points["points"] is not None and len(dict_points["points"]) > 0 and dict_points["points"][0]["curveNumber"] == 0:
         
-        idx = dict_points["points"][0]["pointIndex"]
+        idx = dict_points["points"][0]["customdata"]
         
         if "id" in test_df.columns:
             study_id = test_df.loc[idx]["id"]
@@ -192,13 +252,13 @@ def update_img(dict_points, opacity, size):
         img_path = os.path.join(mount_dir, test_df.loc[idx]["image"]).replace(os.sep,"/")
         
 
-        img_np = sitk.GetArrayFromImage(sitk.ReadImage(img_path)).astype(np.ubyte)
+        img_np = image_cache.get(img_path, size).astype(np.ubyte)
 
         fig_img = px.imshow(img_np, binary_string=True, binary_compression_level=5, binary_backend='pil')
 
         # img_path = os.path.join("/work/jprieto/data/remote/EGower/hinashah/Analyses_Set_20220321_Images_seg/", test_df.loc[idx]["image"].replace(".jpg", ".nrrd"))        
         img_path = os.path.join(mount_dir, "hinashah_organized/Data/Segmentations_Pred", test_df.loc[idx]["image"].replace("hinashah/", "").replace(".jpg", ".nrrd")).replace(os.sep, "/")
-        img_np = sitk.GetArrayFromImage(sitk.ReadImage(img_path)).astype(np.ubyte)
+        img_np = image_cache.get(img_path, size).astype(np.ubyte)
         
         fig_img.add_trace(go.Heatmap(z=img_np, opacity=opacity, colorscale='rdbu'))
 
@@ -221,20 +281,15 @@ def update_frames(idx, frame_id, opacity):
 
     if idx >= 0:
         img_path = os.path.join(mount_dir, "hinashah_organized/Data/Images_Stacks", test_df.loc[idx]["image"].replace("hinashah/","").replace(".jpg", ".nrrd")).replace(os.sep,"/")        
-        img_np = sitk.GetArrayFromImage(sitk.ReadImage(img_path)).astype(np.ubyte)        
-        
-        t, xs, ys, _ = img_np.shape
-        xo = (xs - 448)//2
-        yo = (ys - 448)//2
-        img_np = img_np[:,xo:xo + 448, yo:yo + 448,:]
+        img_np = image_cache.get_frame(img_path, frame_id, crop=448).astype(np.ubyte)
 
-        fig_frames = px.imshow(img_np[frame_id], binary_string=True, binary_compression_level=5)
+        fig_frames = px.imshow(img_np, binary_string=True, binary_compression_level=5)
 
         img_path_explain = os.path.join(mount_dir, "hinashah/Analysis_Set_202208/cam/hinashah_organized/Data/Images_Stacks", test_df.loc[idx]["image"].replace("hinashah/","").replace(".jpg", ".nrrd")).replace(os.sep, "/")
         
         if os.path.exists(img_path_explain):
-            img_explain_np = sitk.GetArrayFromImage(sitk.ReadImage(img_path_explain))
-            fig_frames.add_trace(go.Heatmap(z=img_explain_np[frame_id,:,:], zmin=0, zmax=1, opacity=opacity, colorscale='jet'))
+            img_explain_np = image_cache.get_frame(img_path_explain, frame_id)
+            fig_frames.add_trace(go.Heatmap(z=img_explain_np[:,:], zmin=0, zmax=1, opacity=opacity, colorscale='jet'))
         
         return fig_frames
     else: 
@@ -300,7 +355,8 @@ app.layout = html.Div(children=[
                 [
                 html.Div([dcc.Input(id="studies-search", type="search", placeholder="Search study")]),
                 html.Div([dcc.Dropdown(options=['class', 'max'], value='class', id='colorby-dropdown')]),
-                html.Div([dcc.Graph(id='studies-img')])],
+                html.Div([dcc.Graph(id='studies-img', figure=studies_figure(viewport_points(emb.pca, max_points=max_points)))]),
+                dcc.Store(id='studies-points', data=viewport_points(emb.pca, max_points=max_points).tolist())],
                 className='six columns'
             ),            
             html.Div(
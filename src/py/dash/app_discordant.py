@@ -17,6 +17,8 @@ from sklearn.metrics import confusion_matrix
 from sklearn.metrics import roc_curve, auc
 from sklearn.metrics import classification_report
 
+from image_cache import ImageCache
+
 pio.renderers.default = "chrome"
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
@@ -56,6 +58,10 @@ test_df["pca_0"] = pca_epi_fit[:,0]
 test_df["pca_1"] = pca_epi_fit[:,1]
 test_df["pred"] = np.argmax(x, axis=1)
 
+# Decoded images and thumbnails, python image_cache.py --csv <csv_path> --thumb_dir <thumb_dir> --mount_point <dir> --dirs <seg, stacks and rise dirs>
+thumb_dir = "hinashah/hinashah_applist/jimma_tis_may_2022_discordant_NOTT_thumbnails"
+image_cache = ImageCache(thumb_dir=thumb_dir if os.path.exists(thumb_dir) else None)
+
 @app.callback(
     Output('studies-img', 'figure'),    
     Input('studies-img', 'clickData'),
@@ -160,13 +166,13 @@ def update_img(dict_points, opacity, size):
         img_path = os.path.join("/work/jprieto/data/remote/EGower/jprieto/", study_id)
         
 
-        img_np = sitk.GetArrayFromImage(sitk.ReadImage(img_path)).astype(np.ubyte)
+        img_np = image_cache.get(img_path, size).astype(np.ubyte)
 
         fig_img = px.imshow(img_np, binary_string=True, binary_compression_level=5, binary_backend='pil')
 
         # img_path = os.path.join("/work/jprieto/data/remote/EGower/hinashah/Analyses_Set_20220321_Images_seg/", test_df.loc[idx]["image"].replace(".jpg", ".nrrd"))        
         img_path = os.path.join("hinashah/hinashah_applist/jimma_tis_may_2022_discordant_NOTT_seg", test_df.loc[idx]["image"].replace(".jpg", ".nrrd"))        
-        img_np = sitk.GetArrayFromImage(sitk.ReadImage(img_path)).astype(np.ubyte)
+        img_np = image_cache.get(img_path, size).astype(np.ubyte)
         
         fig_img.add_trace(go.Heatmap(z=img_np, opacity=opacity, colorscale='rdbu'))
 
@@ -195,21 +201,15 @@ def update_frames(idx, dict_points, frame_id, explain_class, opacity):
     if idx >= 0:
         # img_path = os.path.join("/work/jprieto/data/remote/EGower/hinashah/Analyses_Set_20220321_Images_stacks/", test_df.loc[idx]["image"].replace(".jpg", ".nrrd"))        
         img_path = os.path.join("hinashah/hinashah_applist/jimma_tis_may_2022_discordant_NOTT_stacks", test_df.loc[idx]["image"].replace(".jpg", ".nrrd"))        
-        img_np = sitk.GetArrayFromImage(sitk.ReadImage(img_path)).astype(np.ubyte)        
-        
-        t, xs, ys, _ = img_np.shape
-        xo = (xs - 448)//2
-        yo = (ys - 448)//2
-        img_np = img_np[:,xo:xo + 448, yo:yo + 448,:]
+        img_np = image_cache.get_frame(img_path, frame_id, crop=448).astype(np.ubyte)
 
-        fig_frames = px.imshow(img_np[frame_id], binary_string=True, binary_compression_level=5)
+        fig_frames = px.imshow(img_np, binary_string=True, binary_compression_level=5)
 
         img_path_explain = os.path.join("hinashah/hinashah_applist/jimma_tis_may_2022_discordant_NOTT_rise_explainability", test_df.loc[idx]["image"].replace(".jpg", ".nrrd"))
         
         if os.path.exists(img_path_explain):
-            img_explain_np = sitk.GetArrayFromImage(sitk.ReadImage(img_path_explain))
-            print(img_explain_np.shape)
-            fig_frames.add_trace(go.Heatmap(z=img_explain_np[frame_id,:,:,explain_class], zmin=0, zmax=1, opacity=opacity, colorscale='rdbu'))
+            img_explain_np = image_cache.get_frame(img_path_explain, frame_id)
+            fig_frames.add_trace(go.Heatmap(z=img_explain_np[:,:,explain_class], zmin=0, zmax=1, opacity=opacity, colorscale='rdbu'))
 
         # sliders = [dict(
         #     active=frame_idx
@@ -0,0 +1,87 @@
+import os
+import argparse
+import pickle
+from types import SimpleNamespace
+
+import numpy as np
+from sklearn.decomposition import PCA
+
+# Embeddings of the Dash app, written once from the <csv>_stacks_features.pickle of classification_predict_stacks.py.
+# <out_dir>/x.npy, x_a.npy, x_v.npy, x_v_p.npy   outputs of the stack model, memory mapped by the app
+# <out_dir>/x_s.npy                              max of the attention scores over the last axis, [N, T]
+# <out_dir>/projection.npz                       2D PCA of x_a (components and mean to project the frame features x_v),
+#                                                projected studies, prediction, max score and the value ranges of the color scales
+
+def write_array(fn, v):
+    out = np.lib.format.open_memmap(fn, mode="w+", dtype=np.float32, shape=v.shape)
+    out[:] = v
+    out.flush()
+
+def write_embeddings(features_fn, out_dir):
+    with open(features_fn, 'rb') as f:
+        x, x_a, x_s, x_v, x_v_p = pickle.load(f)
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    x_s = np.max(np.asarray(x_s, dtype=np.float32), axis=-1)
+
+    arrays = {"x": x, "x_a": x_a, "x_s": x_s, "x_v": x_v, "x_v_p": x_v_p}
+    for k, v in arrays.items():
+        write_array(os.path.join(out_dir, k + ".npy"), np.asarray(v, dtype=np.float32))
+
+    pca = PCA(n_components=2)
+    pca_fit = pca.fit_transform(np.asarray(x_a, dtype=np.float32))
+
+    np.savez(os.path.join(out_dir, "projection.npz"),
+        components=pca.components_.astype(np.float32),
+        mean=pca.mean_.astype(np.float32),
+        pca=pca_fit.astype(np.float32),
+        pred=np.argmax(x, axis=1),
+        score_max=np.max(x_s, axis=1),
+        x_s_range=np.array([np.min(x_s), np.max(x_s)]),
+        x_v_p_range=np.array([np.min(x_v_p), np.max(x_v_p)]))
+
+def load_embeddings(out_dir):
+    emb = SimpleNamespace(**{k: np.load(os.path.join(out_dir, k + ".npy"), mmap_mode="r") for k in ["x", "x_a", "x_s", "x_v", "x_v_p"]})
+    projection = np.load(os.path.join(out_dir, "projection.npz"))
+    for k in projection.files:
+        setattr(emb, k, projection[k])
+    return emb
+
+def project(emb, features):
+    # Same as PCA.transform, features [n, D] -> [n, 2]
+    features = np.asarray(features, dtype=np.float32).reshape(-1, emb.components.shape[1])
+    return (features - emb.mean) @ emb.components.T
+
+def viewport_points(xy, x_range=None, y_range=None, max_points=20000):
+    # Indices of the points inside the viewport, when there are more than max_points only the first point of each
+    # cell of a sqrt(max_points) x sqrt(max_points) grid is kept, the dense regions are thinned and the outliers stay visible
+    x_range = x_range if x_range is not None else (np.min(xy[:, 0]), np.max(xy[:, 0]))
+    y_range = y_range if y_range is not None else (np.min(xy[:, 1]), np.max(xy[:, 1]))
+
+    points = np.where((xy[:, 0] >= x_range[0]) & (xy[:, 0] <= x_range[1]) & (xy[:, 1] >= y_range[0]) & (xy[:, 1] <= y_range[1]))[0]
+
+    if len(points) > max_points:
+        g = int(np.sqrt(max_points))
+        cx = np.clip(((xy[points, 0] - x_range[0])/max(x_range[1] - x_range[0], 1e-12)*g).astype(int), 0, g - 1)
+        cy = np.clip(((xy[points, 1] - y_range[0])/max(y_range[1] - y_range[0], 1e-12)*g).astype(int), 0, g - 1)
+        _, first = np.unique(cx*g + cy, return_index=True)
+        points = points[np.sort(first)]
+
+    return points
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Memory mapped embeddings and 2D projection for the Dash app')
+    parser.add_argument('--features', type=str, help='Features pickle, <csv>_stacks_features.pickle', required=True)
+    parser.add_argument('--out', type=str, help='Output directory, defaults to <csv>_stacks_embeddings', default=None)
+
+    args = parser.parse_args()
+
+    out = args.out
+    if out is None:
+        out = args.features.replace("_features.pickle", "_embeddings")
+
+    write_embeddings(args.features, out)
@@ -0,0 +1,202 @@
+import os
+import argparse
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+from PIL import Image
+
+from tqdm import tqdm
+
+# Server side cache of the Dash review apps.
+# ImageCache keeps the decoded arrays in a LRU bounded in bytes, keyed by path and mtime so a rewritten file is read again.
+# The thumbnails are downscaled copies of the photos, label maps, stacks frames and explainability maps at a few levels (max side in pixels)
+# <thumb_dir>/<level>/<path>.webp|.jpg   RGB uint8 photos and frames
+# <thumb_dir>/<level>/<path>.npy         label maps and heatmaps, nearest neighbor
+# Stacks and explainability maps have one file per frame, <path>_f<frame>. Missing thumbnails are computed from the full resolution
+# array and kept in the LRU. Running this file precomputes the thumbnails of a csv.
+
+def is_rgb(img_np):
+    return img_np.dtype == np.uint8 and img_np.ndim == 3 and img_np.shape[-1] == 3
+
+def is_stack(img_np):
+    # [T, H, W, 3] frames or [T, H, W] / [T, H, W, C] explainability maps
+    return img_np.ndim == 4 or (img_np.ndim == 3 and img_np.shape[-1] not in (1, 3, 4))
+
+def center_crop(img_np, crop):
+    # Crop of the frames of a stack like the review apps, [T, H, W, ...]
+    xs, ys = img_np.shape[1:3]
+    xo = (xs - crop)//2
+    yo = (ys - crop)//2
+    return img_np[:, xo:xo + crop, yo:yo + crop]
+
+def level_shape(shape, level):
+    scale = min(1.0, level/max(shape[0], shape[1]))
+    return max(1, int(round(shape[0]*scale))), max(1, int(round(shape[1]*scale)))
+
+def downscale(img_np, level):
+    # Max side of the image is level, bilinear for RGB and nearest neighbor for labels/heatmaps so both stay aligned pixel to pixel
+    h, w = level_shape(img_np.shape, level)
+    if (h, w) == tuple(img_np.shape[0:2]):
+        return img_np
+    if is_rgb(img_np):
+        return np.array(Image.fromarray(img_np).resize((w, h), Image.BILINEAR))
+    rows = (np.arange(h)*img_np.shape[0]/h).astype(int)
+    cols = (np.arange(w)*img_np.shape[1]/w).astype(int)
+    return img_np[rows][:, cols]
+
+class ImageCache:
+    def __init__(self, max_bytes=2*1024**3, thumb_dir=None, levels=(256, 512, 1024), ext=".webp"):
+        self.max_bytes = max_bytes
+        self.thumb_dir = thumb_dir
+        self.levels = sorted(levels)
+        self.ext = ext
+        self.lock = threading.Lock()
+        self.arrays = OrderedDict()
+        self.nbytes = 0
+
+    def cached(self, key, fn):
+        with self.lock:
+            if key in self.arrays:
+                self.arrays.move_to_end(key)
+                return self.arrays[key]
+
+        img_np = fn()
+
+        with self.lock:
+            if key not in self.arrays:
+                self.arrays[key] = img_np
+                self.nbytes += img_np.nbytes
+                while self.nbytes > self.max_bytes and len(self.arrays) > 1:
+                    _, v = self.arrays.popitem(last=False)
+                    self.nbytes -= v.nbytes
+        return img_np
+
+    def read(self, path):
+        # Full resolution array
+        return self.cached((path, os.path.getmtime(path)), lambda: sitk.GetArrayFromImage(sitk.ReadImage(path)))
+
+    def level_for(self, size):
+        # Smallest level that covers size pixels, None for the full resolution
+        if size is None:
+            return None
+        for level in self.levels:
+            if level >= size:
+                return level
+        return None
+
+    def thumbnail_path(self, path, level, frame=None, rgb=True):
+        rel = os.path.splitdrive(os.path.abspath(path))[1].lstrip(os.sep).replace(os.sep, "/")
+        if frame is not None:
+            rel = rel + "_f{:02d}".format(frame)
+        return os.path.join(self.thumb_dir, str(level), rel + (self.ext if rgb else ".npy"))
+
+    def read_thumbnail(self, path, level, frame=None):
+        # Thumbnails older than the file are stale, e.g., a segmentation computed again, and are ignored
+        if self.thumb_dir is None:
+            return None
+        mtime = os.path.getmtime(path)
+        for rgb in [True, False]:
+            fn = self.thumbnail_path(path, level, frame, rgb)
+            if os.path.exists(fn) and os.path.getmtime(fn) >= mtime:
+                if rgb:
+                    return np.array(Image.open(fn).convert("RGB"))
+                return np.load(fn)
+        return None
+
+    def get(self, path, size=None):
+        # Image or label map at the smallest level covering size
+        level = self.level_for(size)
+        if level is None:
+            return self.read(path)
+
+        def fn():
+            img_np = self.read_thumbnail(path, level)
+            if img_np is None:
+                img_np = downscale(self.read(path), level)
+            return img_np
+
+        return self.cached((path, os.path.getmtime(path), level), fn)
+
+    def get_frame(self, path, frame, size=None, crop=None):
+        # One frame of a stack or explainability map, cropped like the apps before downscaling
+        level = self.level_for(size) if size is not None else self.levels[-1]
+
+        def fn():
+            img_np = None
+            if level is not None:
+                img_np = self.read_thumbnail(path, level, frame)
+            if img_np is None:
+                img_np = self.read(path)
+                if crop is not None:
+                    img_np = center_crop(img_np, crop)
+                img_np = img_np[frame]
+                if level is not None:
+                    img_np = downscale(img_np, level)
+            return img_np
+
+        return self.cached((path, os.path.getmtime(path), level, frame, crop), fn)
+
+    def write_thumbnails(self, path, crop=None):
+        # All the levels of an image, label map or stack
+        img_np = sitk.GetArrayFromImage(sitk.ReadImage(path))
+
+        if is_stack(img_np):
+            if crop is not None and img_np.dtype == np.uint8 and img_np.ndim == 4:
+                img_np = center_crop(img_np, crop)
+            frames = list(enumerate(img_np))
+        else:
+            frames = [(None, img_np)]
+
+        for level in self.levels:
+            for frame, frame_np in frames:
+                frame_np = downscale(frame_np, level)
+                rgb = is_rgb(frame_np)
+                fn = self.thumbnail_path(path, level, frame, rgb)
+                if not os.path.exists(os.path.dirname(fn)):
+                    os.makedirs(os.path.dirname(fn), exist_ok=True)
+                if rgb:
+                    Image.fromarray(frame_np).save(fn, quality=90)
+                else:
+                    np.save(fn, frame_np)
+
+def main(args):
+    df = pd.read_csv(args.csv)
+
+    cache = ImageCache(thumb_dir=args.thumb_dir, levels=args.levels, ext=args.ext)
+
+    for img in tqdm(df[args.img_column], total=len(df)):
+        # The photo and the files with the same name in the segmentation/stacks/explainability directories
+        paths = [os.path.join(args.mount_point, img)]
+
+        for strip in args.strip:
+            img = img.replace(strip, "")
+        for d in args.dirs:
+            paths.append(os.path.join(args.mount_point, d, os.path.splitext(img)[0] + ".nrrd"))
+
+        for path in paths:
+            if os.path.exists(path):
+                try:
+                    cache.write_thumbnails(path, crop=args.crop)
+                except Exception as e:
+                    print("Error:", path, e)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Precompute the thumbnails of the Dash review apps')
+    parser.add_argument('--csv', type=str, help='CSV with the images', required=True)
+    parser.add_argument('--img_column', type=str, help='Image column name', default="image")
+    parser.add_argument('--mount_point', type=str, help='Dataset mount directory', default="./")
+    parser.add_argument('--dirs', type=str, nargs='+', help='Directories with the segmentations, stacks and explainability maps of the images as nrrd', default=[])
+    parser.add_argument('--strip', type=str, nargs='+', help='Strings removed from the image column to build the paths in --dirs, e.g., hinashah/', default=[])
+    parser.add_argument('--crop', type=int, help='Center crop of the stack frames', default=448)
+    parser.add_argument('--levels', type=int, nargs='+', help='Max side of the thumbnails', default=[256, 512, 1024])
+    parser.add_argument('--ext', type=str, help='Thumbnail format', default=".webp", choices=[".webp", ".jpg"])
+    parser.add_argument('--thumb_dir', type=str, help='Output directory', required=True)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -20,6 +20,8 @@ import itertools
 from scipy import interp
 import pickle 
 
+from bootstrap import bootstrap_metrics, confidence_intervals, sensitivity_specificity
+
 import plotly.graph_objects as go
 import plotly.express as px
 
@@ -77,9 +79,6 @@ def remove_labels(df, args):
 def main(args):
 
 
-  y_true_arr = [] 
-  y_pred_arr = []
-
   if(os.path.splitext(args.csv)[1] == ".csv"):        
       df = pd.read_csv(args.csv)
   else:        
@@ -95,9 +94,8 @@ def main(args):
   class_names.sort()
 
 
-  for idx, row in df.iterrows():
-    y_true_arr.append(row[args.csv_true_column])
-    y_pred_arr.append(row[args.csv_prediction_column])
+  y_true_arr = df[args.csv_true_column].values
+  y_pred_arr = df[args.csv_prediction_column].values
 
   report = classification_report(y_true_arr, y_pred_arr, output_dict=True)
   print(json.dumps(report, indent=2))
@@ -193,7 +191,34 @@ def main(args):
 
     report["macro avg"]["auc"] = np.average(auc) 
     report["weighted avg"]["auc"] = np.average(auc, weights=support) 
-        
+
+  if args.bootstrap > 0:
+    # Percentile CIs of the one vs rest metrics, the column l of y_scores is the probability of the label l
+    labels = np.unique(np.concatenate([y_true_arr, y_pred_arr]))
+    scores = None
+    if y_scores is not None:
+      if np.issubdtype(labels.dtype, np.integer) and labels.min() >= 0 and labels.max() < y_scores.shape[1]:
+        scores = y_scores
+      else:
+        print("The labels are not the class indices of the probability columns, skipping the AUC confidence intervals")
+    metrics = bootstrap_metrics(y_true_arr, y_pred_arr, y_scores=scores, labels=labels, n_boot=args.bootstrap, chunk=args.bootstrap_chunk, seed=args.seed)
+    ci = confidence_intervals(metrics, args.ci)
+
+    for i, l in enumerate(labels):
+      _, spec = sensitivity_specificity(np.expand_dims(y_true_arr == l, 0), np.expand_dims(y_pred_arr == l, 0))
+      report[str(l)]["specificity"] = spec[0]
+      for k, (low, high) in ci.items():
+        report[str(l)][k + "_ci_low"] = low[i]
+        report[str(l)][k + "_ci_high"] = high[i]
+
+    # Macro average of every resample
+    macro_ci = confidence_intervals({k: np.nanmean(v, axis=1, keepdims=True) for k, v in metrics.items()}, args.ci)
+    for k, (low, high) in macro_ci.items():
+      report["macro avg"][k + "_ci_low"] = low[0]
+      report["macro avg"][k + "_ci_high"] = high[0]
+
+    print(json.dumps({k: report[k] for k in [str(l) for l in labels] + ["macro avg"]}, indent=2, default=float))
+
   df_report = pd.DataFrame(report).transpose()
   report_filename = os.path.splitext(args.csv)[0] + "_classification_report.csv"
   df_report.to_csv(report_filename)
@@ -212,6 +237,11 @@ def get_argparse():
   parser.add_argument('--drop_labels', type=str, default=None, nargs='+', help='drop labels in dataframe')
   parser.add_argument('--concat_labels', type=str, default=None, nargs='+', help='concat labels in dataframe')
 
+  parser.add_argument('--bootstrap', type=int, help='Number of bootstrap resamples for the confidence intervals of the AUC, sensitivity and specificity, 0 to skip, e.g., 2000', default=0)
+  parser.add_argument('--bootstrap_chunk', type=int, help='Resamples computed at once, bounds the memory to chunk*rows', default=200)
+  parser.add_argument('--ci', type=float, help='Confidence level', default=0.95)
+  parser.add_argument('--seed', type=int, help='Seed of the resamples', default=0)
+
 
   return parser
 
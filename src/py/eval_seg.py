@@ -7,10 +7,7 @@ from datetime import datetime, time
 import json
 import glob
 import time
-from sklearn.metrics import confusion_matrix
 from sklearn.metrics import roc_curve, auc
-from sklearn.metrics import classification_report
-from sklearn.metrics import jaccard_score
 import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
@@ -20,6 +17,7 @@ import pandas as pd
 import SimpleITK as sitk
 import seaborn as sns
 import pickle 
+from multiprocessing import Pool
 
 def plot_confusion_matrix(cm, classes,
                           normalize=False,
@@ -58,63 +56,100 @@ def plot_confusion_matrix(cm, classes,
   return cm
 
 
+def read_labels(fn, downsample=1):
+  img_np = sitk.GetArrayFromImage(sitk.ReadImage(fn))
+  # Nearest neighbor subsampling of the label map or of the probabilities before the argmax
+  img_np = img_np[::downsample, ::downsample]
+  if img_np.ndim == 3 and img_np.shape[-1] > 1:
+    img_np = np.argmax(img_np, axis=-1)
+  return np.reshape(img_np, -1).astype(np.int64)
+
+def confusion_matrix_bincount(y_true, y_pred, num_classes):
+  # K x K confusion matrix with a single pass over the pixels, rows are the true labels
+  if y_true.max(initial=0) >= num_classes or y_pred.max(initial=0) >= num_classes:
+    raise ValueError("Labels must be in [0, " + str(num_classes) + "), use --num_classes")
+  return np.bincount(num_classes*y_true + y_pred, minlength=num_classes*num_classes).reshape(num_classes, num_classes)
+
+def cm_metrics(cm):
+  # Per class dice, iou, precision and recall, nan for the classes that are not in y_true nor y_pred
+  tp = np.diag(cm).astype(float)
+  support = cm.sum(axis=1)
+  predicted = cm.sum(axis=0)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    return {
+      "dice": 2.0*tp/(support + predicted),
+      "iou": tp/(support + predicted - tp),
+      "precision": tp/predicted,
+      "recall": tp/support
+    }
+
+def cm_classification_report(cm):
+  # Same dictionary as sklearn classification_report(y_true, y_pred, output_dict=True)
+  labels = np.where((cm.sum(axis=0) + cm.sum(axis=1)) > 0)[0]
+  m = cm_metrics(cm)
+  precision = np.nan_to_num(m["precision"][labels])
+  recall = np.nan_to_num(m["recall"][labels])
+  with np.errstate(divide='ignore', invalid='ignore'):
+    f1 = np.nan_to_num(2.0*precision*recall/(precision + recall))
+  support = cm.sum(axis=1)[labels]
+  total = support.sum()
+
+  report = {}
+  for idx, l in enumerate(labels):
+    report[str(l)] = {"precision": precision[idx], "recall": recall[idx], "f1-score": f1[idx], "support": int(support[idx])}
+  report["accuracy"] = np.trace(cm)/total
+  report["macro avg"] = {"precision": np.mean(precision), "recall": np.mean(recall), "f1-score": np.mean(f1), "support": int(total)}
+  report["weighted avg"] = {"precision": np.average(precision, weights=support), "recall": np.average(recall, weights=support), "f1-score": np.average(f1, weights=support), "support": int(total)}
+  return report
+
+def eval_image(task):
+  seg_fn, pred_fn, num_classes, downsample = task
+  y_true = read_labels(seg_fn, downsample)
+  y_pred = read_labels(pred_fn, downsample)
+  return confusion_matrix_bincount(y_true, y_pred, num_classes)
+
 def main(args):
   df = pd.read_csv(args.csv)
 
-  y_pred_arr = []
-  y_true_arr = []
   dice_arr = []
   cnf_matrix_arr = []
   cl_report_arr = []
 
-  fpr_arr = []
-  tpr_arr = []
-  roc_auc_arr = []
-  iou_arr = []
-
-  abs_diff_arr = []
-  mse_arr = []
-
-  fpr_obj = {}
-  tpr_obj = {}
-  roc_auc_obj = {}
-
-  for i, row in df.iterrows():
+  out_csv = args.csv.replace('.csv', '_dice.csv')
+  if os.path.exists(out_csv):
+    os.remove(out_csv)
 
-    print("Reading:", row[args.seg_column])
-    y_true = sitk.GetArrayFromImage(sitk.ReadImage(row[args.seg_column]))
-    print("Reading:", row[args.pred_column])
-    y_pred = sitk.GetArrayFromImage(sitk.ReadImage(row[args.pred_column]))
-    if y_pred.shape[-1] == 4:
-      y_pred = np.argmax(y_pred, axis=-1)
+  tasks = [(row[args.seg_column], row[args.pred_column], args.num_classes, args.downsample) for i, row in df.iterrows()]
 
-    y_pred = np.reshape(y_pred, -1)
-    y_true = np.reshape(y_true, -1)
+  with Pool(args.num_workers) as pool:
+    # imap keeps the order of the csv, each row is written as soon as its image is done
+    for i, cm in enumerate(pool.imap(eval_image, tasks)):
 
-    cnf_matrix = confusion_matrix(y_true, y_pred)
-    cnf_matrix = cnf_matrix.astype('float') / cnf_matrix.sum(axis=1)[:, np.newaxis]
-    cnf_matrix_arr.append(cnf_matrix)
+      print("Evaluated:", tasks[i][1])
 
-    print(cnf_matrix)
+      with np.errstate(divide='ignore', invalid='ignore'):
+        cnf_matrix = cm.astype('float') / cm.sum(axis=1)[:, np.newaxis]
+      cnf_matrix_arr.append(cnf_matrix)
 
-    cl_report = classification_report(y_true, y_pred, output_dict=True)
-    cl_report_arr.append(cl_report)
+      cl_report_arr.append(cm_classification_report(cm))
 
-    print(cl_report)
-
-    # y_pred_arr.extend(np.array(y_pred).astype(np.byte))
-    # y_true_arr.extend(np.array(y_true).astype(np.byte))
-
-    jaccard = jaccard_score(y_true, y_pred, average=None)
-    dice = 2.0*jaccard/(1.0 + jaccard)
-    if(len(dice) == 4):
+      m = cm_metrics(cm)
+      dice = m["dice"]
       print(dice)
-      dice_arr.append(dice)
-    else:
-      print("WTF!")
+      if np.all(np.isfinite(dice)):
+        dice_arr.append(dice)
+      else:
+        print("Missing classes in", tasks[i][1])
+
+      out_row = df.iloc[[i]].reset_index(drop=True)
+      for c in range(args.num_classes):
+        out_row[str(c)] = dice[c]
+      for k in ["iou", "precision", "recall"]:
+        for c in range(args.num_classes):
+          out_row[k + "_" + str(c)] = m[k][c]
+      out_row.to_csv(out_csv, mode='a', header=(i == 0), index=False)
 
 
-  
   # FP = cnf_matrix.sum(axis=0) - np.diag(cnf_matrix)  
   # FN = cnf_matrix.sum(axis=1) - np.diag(cnf_matrix)
   # TP = np.diag(cnf_matrix)
@@ -170,8 +205,6 @@ def main(args):
   violin_filename = os.path.splitext(args.csv)[0] + "_violin_plot.png"
   fig3.savefig(violin_filename)
 
-  df = pd.concat([df, pd.DataFrame(dice_arr)], axis=1)
-  df.to_csv(args.csv.replace('.csv', '_dice.csv'), index=False)
 
   # roc_fig = plt.figure()
   # lw = 3
@@ -221,6 +254,9 @@ if __name__ == "__main__":
   input_param_group.add_argument('--csv', type=str, help='csv file columns seg,prediction', required=True)
   input_param_group.add_argument('--seg_column', type=str, help='column name for segmentation', default='seg')
   input_param_group.add_argument('--pred_column', type=str, help='column name for prediction', default='pred')
+  input_param_group.add_argument('--num_classes', type=int, help='number of labels of the segmentation', default=4)
+  input_param_group.add_argument('--downsample', type=int, help='evaluate every n-th pixel in each dimension, 1 for the full resolution', default=1)
+  input_param_group.add_argument('--num_workers', type=int, help='number of processes evaluating the images', default=4)
 
   args = parser.parse_args()
   main(args)
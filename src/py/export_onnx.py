@@ -0,0 +1,96 @@
+import argparse
+
+import os
+
+import torch
+
+from nets import classification
+from nets.segmentation import TTUNet
+from onnx_backend import OnnxModule, StacksExport, HeadExport
+from slim_checkpoint import load_model
+
+# Exports TTUNet, the patch classifier, the stack classifiers and the head of the YOLT models to ONNX
+# with dynamic batch, frame/patch and spatial axes. The graphs are run with --backend onnx in
+# create_stack_torch_pl.py, classification_predict_stacks.py and classification_predict_yolt.py
+
+def get_export(args):
+    # Module to export, example input, input/output names and dynamic axes
+    if args.nn == "TTUNet":
+        model = load_model(TTUNet, args.model, strict=False)
+        x = torch.rand(1, 3, 512, 512)
+        return model, x, ["img"], ["seg"], {"img": {0: "batch", 2: "height", 3: "width"}, "seg": {0: "batch", 2: "height", 3: "width"}}
+
+    NN = getattr(classification, args.nn)
+    model = load_model(NN, args.model)
+
+    if "YOLT" in args.nn and not hasattr(model, "head"):
+        raise ValueError(args.nn + " has no head module to export, only the YOLT models with a head (EfficientNetV2SYOLTv2) can be exported")
+
+    if hasattr(model, "head"):
+        x = torch.rand(1, args.num_patches, 3, args.size, args.size)
+        axes = {"patches": {0: "batch", 1: "patches", 3: "height", 4: "width"}, "x": {0: "batch"}, "x_a": {0: "batch"}, "x_v": {0: "batch", 1: "patches"}}
+        return HeadExport(model), x, ["patches"], ["x", "x_a", "x_v"], axes
+
+    if hasattr(model, "A"):
+        x = torch.rand(1, args.num_patches, 3, args.size, args.size)
+        axes = {"stack": {0: "batch", 1: "frames", 3: "height", 4: "width"}, "x": {0: "batch"}, "x_a": {0: "batch"}, "x_s": {0: "batch", 1: "frames"}, "x_v": {0: "batch", 1: "frames"}, "x_v_p": {0: "batch", 1: "frames"}}
+        return StacksExport(model), x, ["stack"], ["x", "x_a", "x_s", "x_v", "x_v_p"], axes
+
+    model.features = True
+    x = torch.rand(1, 3, args.size, args.size)
+    axes = {"img": {0: "batch", 2: "height", 3: "width"}, "x": {0: "batch"}, "x_f": {0: "batch"}}
+    return model, x, ["img"], ["x", "x_f"], axes
+
+def main(args):
+
+    model, x, input_names, output_names, dynamic_axes = get_export(args)
+    model.eval()
+
+    out = args.out
+    if out is None:
+        out = os.path.splitext(args.model)[0] + ".onnx"
+
+    with torch.no_grad():
+        torch.onnx.export(model, (x,), out,
+            export_params=True,
+            do_constant_folding=True,
+            opset_version=args.opset,
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes)
+
+    print("Writing:", out)
+
+    if args.check:
+        # Compare with torch on an input with a different batch and size than the traced one
+        shape = list(x.shape)
+        shape[0] = 2
+        shape[-2:] = [s + args.check_pad for s in shape[-2:]]
+        x = torch.rand(shape)
+
+        with torch.no_grad():
+            out_t = model(x)
+        out_o = OnnxModule(out)(x)
+
+        if not isinstance(out_t, tuple):
+            out_t, out_o = (out_t,), (out_o,)
+
+        for name, t, o in zip(output_names, out_t, out_o):
+            print(name, tuple(o.shape), "max abs diff:", torch.max(torch.abs(t.to(torch.float32) - o.to(torch.float32))).item())
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Export a model to ONNX with dynamic axes')
+    parser.add_argument('--model', help='Model checkpoint', type=str, required=True)
+    parser.add_argument('--nn', help='Type of PL neural network, TTUNet or a class in nets.classification', type=str, default="TTUNet")
+    parser.add_argument('--size', help='Height/width of the example patches, frames or images', type=int, default=448)
+    parser.add_argument('--num_patches', help='Number of patches or frames of the example input', type=int, default=4)
+    parser.add_argument('--opset', help='ONNX opset', type=int, default=17)
+    parser.add_argument('--check', help='Compare the ONNX Runtime outputs with torch', type=int, default=1)
+    parser.add_argument('--check_pad', help='Size increase of the check input, the TTUNet input must stay a multiple of 64', type=int, default=64)
+    parser.add_argument('--out', help='Output onnx file, defaults to the checkpoint name', type=str, default=None)
+
+    args = parser.parse_args()
+
+    main(args)
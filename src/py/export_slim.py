@@ -0,0 +1,50 @@
+import argparse
+
+import os
+
+import torch
+
+from nets import classification, segmentation
+from slim_checkpoint import save_slim, load_slim
+
+# Writes the weights of a lightning checkpoint without the optimizer state as a slim checkpoint, <out>.json + <out>.bin.
+# The prediction scripts load the .json file in place of the .ckpt file.
+
+def get_nn(name):
+    for module in [classification, segmentation]:
+        if hasattr(module, name):
+            return getattr(module, name)
+    raise ValueError("Unknown model class " + name)
+
+def main(args):
+
+    NN = get_nn(args.nn)
+
+    ckpt = torch.load(args.model, map_location="cpu")
+
+    out = args.out
+    if out is None:
+        out = os.path.splitext(args.model)[0]
+
+    save_slim(NN, ckpt.get("hyper_parameters", {}), ckpt["state_dict"], out)
+    print("Writing:", out + ".json", out + ".bin")
+
+    if args.check:
+        # Build the model from the slim checkpoint and compare the weights
+        model = load_slim(out + ".json", NN, strict=False)
+        state_dict = model.state_dict()
+        diff = max([torch.max(torch.abs(state_dict[k].to(torch.float32) - v.to(torch.float32))).item() for k, v in ckpt["state_dict"].items() if k in state_dict and v.numel() > 0] + [0])
+        print("Tensors:", len(ckpt["state_dict"]), "max abs diff:", diff)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Export a lightning checkpoint to a slim weights only checkpoint')
+    parser.add_argument('--model', help='Model checkpoint', type=str, required=True)
+    parser.add_argument('--nn', help='Class of the model in nets.classification or nets.segmentation, e.g., TTUNet, EfficientnetV2sStacksDot', type=str, required=True)
+    parser.add_argument('--check', help='Load the slim checkpoint and compare the weights', type=int, default=1)
+    parser.add_argument('--out', help='Output name without extension, defaults to the checkpoint name', type=str, default=None)
+
+    args = parser.parse_args()
+
+    main(args)
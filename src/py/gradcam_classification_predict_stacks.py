@@ -1,15 +1,19 @@
 import argparse
 
 import os
+import queue
+import threading
 import pandas as pd
 import numpy as np 
 
 import SimpleITK as sitk
 
 import torch
+import torch.nn.functional as F
 from torch.utils.data import DataLoader
 
 from nets.classification import EfficientnetV2s, EfficientnetV2sStacks, TimeDistributed
+from slim_checkpoint import load_model
 from loaders.tt_dataset import TTDatasetStacks
 
 from torchvision import transforms
@@ -29,6 +33,147 @@ from pytorch_grad_cam import GradCAM, \
     LayerCAM, \
     FullGrad
 
+def projection_sign(projection, cam_sum):
+    # The sign of the first singular vector depends on the SVD driver, the projection of each frame is flipped
+    # to correlate positively with the Grad-CAM without eigen smooth, sum over K of the weighted activations. [N, h, w] -> [N]
+    dot = (projection*cam_sum).reshape(projection.shape[0], -1).sum(1)
+    if isinstance(dot, torch.Tensor):
+        return torch.where(dot < 0, -1.0, 1.0).to(projection.dtype)
+    return np.where(dot < 0, -1.0, 1.0).astype(projection.dtype)
+
+class SignedGradCAM(GradCAM):
+    # pytorch_grad_cam GradCAM with the sign of the eigen smoothed CAM fixed like BatchGradCAM
+    def get_cam_image(self, input_tensor, target_layer, targets, activations, grads, eigen_smooth=False):
+        cam = super().get_cam_image(input_tensor, target_layer, targets, activations, grads, eigen_smooth)
+        if eigen_smooth:
+            cam_sum = super().get_cam_image(input_tensor, target_layer, targets, activations, grads, False)
+            cam = cam*projection_sign(cam, cam_sum).reshape(-1, 1, 1)
+        return cam
+
+def grad_cam_stack(cam, X):
+    # Frame by frame CAMs of one stack X [T, 3, H, W] -> [T, H, W, 1]
+    tt_cam = []
+    for x_frame in X:
+        grayscale_cam = cam(input_tensor=x_frame.unsqueeze(dim=0), targets=None, eigen_smooth=True)
+        tt_cam.append(np.expand_dims(grayscale_cam.transpose((1, 2, 0)), axis=0))
+    return np.concatenate(tt_cam, axis=0)
+
+class BatchGradCAM:
+    # Grad-CAM of all the frames of several stacks with one forward/backward of model_patches.
+    # Same output as SignedGradCAM(targets=None, eigen_smooth=True) called frame by frame, see test_gradcam_stacks.py
+    def __init__(self, model, target_layer, eigen_smooth=True):
+        self.model = model
+        self.eigen_smooth = eigen_smooth
+        self.activations = None
+        target_layer.register_forward_hook(self.save_activations)
+
+    def save_activations(self, module, input, output):
+        # The activations become a leaf of the graph, the backward pass only goes through the layers after the target layer
+        self.activations = output.detach().requires_grad_(True)
+        return self.activations
+
+    def projection(self, cam):
+        # First principal component of the weighted activations [N, K, h, w] -> [N, h, w]
+        N, K, h, w = cam.shape
+        cam = torch.nan_to_num(cam)
+        cam_sum = cam.sum(dim=1)
+        cam = cam.reshape(N, K, h*w).transpose(1, 2)
+        cam = cam - cam.mean(dim=1, keepdim=True)
+        _, _, VT = torch.linalg.svd(cam, full_matrices=False)
+        projection = (cam @ VT[:, 0, :].unsqueeze(-1)).reshape(N, h, w)
+        return projection*projection_sign(projection, cam_sum).reshape(-1, 1, 1)
+
+    def scale(self, cam, size=None):
+        cam = cam - cam.flatten(1).min(dim=1)[0].reshape(-1, 1, 1)
+        cam = cam/(1e-7 + cam.flatten(1).max(dim=1)[0].reshape(-1, 1, 1))
+        if size is not None:
+            cam = F.interpolate(cam.unsqueeze(1), size=size, mode="bilinear", align_corners=False).squeeze(1)
+        return cam
+
+    def __call__(self, x):
+        # x [N, 3, H, W] -> [N, H, W]
+        with torch.enable_grad():
+            out = self.model(x)
+            # Highest scoring output of each frame
+            score = out.gather(1, torch.argmax(out, dim=1, keepdim=True)).sum()
+            grads = torch.autograd.grad(score, self.activations)[0]
+
+        with torch.no_grad():
+            A = self.activations.to(torch.float32)
+            weights = grads.to(torch.float32).mean(dim=(2, 3), keepdim=True)
+
+            if self.eigen_smooth:
+                cam = self.projection(weights*A)
+            else:
+                cam = (weights*A).sum(dim=1)
+
+            cam = self.scale(torch.clamp(cam, min=0), size=x.shape[-2:])
+            cam = self.scale(torch.clamp(cam, min=0))
+
+        self.activations = None
+        return cam
+
+class ImageWriter:
+    # Writes the images in a background thread while the next batch is computed.
+    # The thread keeps consuming the queue after an error, the first error is raised in the main thread by write/close
+    def __init__(self, max_queue=16):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            img_np, out_fn = item
+            try:
+                out_dir = os.path.dirname(out_fn)
+                if not os.path.exists(out_dir):
+                    os.makedirs(out_dir, exist_ok=True)
+                sitk.WriteImage(sitk.GetImageFromArray(img_np, isVector=True), out_fn)
+            except Exception as e:
+                print("Error writing:", out_fn, e)
+                if self.error is None:
+                    self.error = e
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, img_np, out_fn):
+        self.raise_error()
+        self.queue.put((img_np, out_fn))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
+
+def main_grad_cam(args, df_test, test_data, model, test_transform):
+    # Frame by frame with pytorch_grad_cam
+    model_patches = model.model_patches
+    target_layers = [model_patches[1]]
+
+    cam = SignedGradCAM(model=model_patches, target_layers=target_layers, use_cuda=True)
+
+    for idx, (X, Y) in enumerate(tqdm(test_data, total=len(test_data))):
+        
+        out_fn = os.path.join(args.out, df_test.loc[idx][args.img_column])
+
+        X = X.cuda(non_blocking=True).contiguous()
+        X = test_transform(X)
+
+        tt_cam = grad_cam_stack(cam, X[0])
+
+        out_dir = os.path.dirname(out_fn)
+
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir
+                )
+        sitk.WriteImage(sitk.GetImageFromArray(tt_cam, isVector=True), out_fn)
+
 def main(args):
     
     test_fn = os.path.join(args.mount_point, args.csv)
@@ -39,10 +184,11 @@ def main(args):
     df_test = pd.read_csv(test_fn)    
     
     test_ds = TTDatasetStacks(df_test, mount_point=args.mount_point, img_column=img_column, class_column=class_column)
-    test_data = DataLoader(test_ds, shuffle=False, batch_size=1, num_workers=args.num_workers, persistent_workers=True, pin_memory=True)    
+    batch_size = 1 if args.engine == "grad_cam" else args.batch_size
+    test_data = DataLoader(test_ds, shuffle=False, batch_size=batch_size, num_workers=args.num_workers, persistent_workers=True, pin_memory=True)    
 
     if args.nn == "efficientnet_v2s_stacks":
-        model = EfficientnetV2sStacks(args, out_features=args.out_features, features=True).load_from_checkpoint(args.model)
+        model = load_model(EfficientnetV2sStacks, args.model)
         model.features = True
     
     model.eval()
@@ -53,34 +199,35 @@ def main(args):
     ))
     test_transform.cuda()
 
+    if args.engine == "grad_cam":
+        main_grad_cam(args, df_test, test_data, model, test_transform)
+        return
+
     model_patches = model.model_patches
-    target_layers = [model_patches[1]]
+    for param in model_patches.parameters():
+        param.requires_grad = False
 
-    cam = GradCAM(model=model_patches, target_layers=target_layers, use_cuda=True)
+    cam = BatchGradCAM(model_patches, model_patches[1])
+    writer = ImageWriter()
 
-    
-    for idx, (X, Y) in enumerate(tqdm(test_data, total=len(test_data))):
-        
-        out_fn = os.path.join(args.out, df_test.loc[idx][img_column])
+    row = 0
+    for X, Y in tqdm(test_data, total=len(test_data)):
 
         X = X.cuda(non_blocking=True).contiguous()
         X = test_transform(X)
 
-        tt_cam = []
-        for x_frame in X[0]:
-            
-            grayscale_cam = cam(input_tensor=x_frame.unsqueeze(dim=0), targets=None, eigen_smooth=True)
-            tt_cam.append(np.expand_dims(grayscale_cam.transpose((1, 2, 0)), axis=0))
-        tt_cam = np.concatenate(tt_cam, axis=0)
+        # All the frames of the stacks in the batch
+        B, T = X.shape[0:2]
+        with torch.autocast(device_type="cuda", enabled=bool(args.amp)):
+            tt_cam = cam(X.reshape(B*T, *X.shape[2:]))
+        tt_cam = tt_cam.reshape(B, T, *tt_cam.shape[1:], 1).cpu().numpy()
 
-        out_dir = os.path.dirname(out_fn)
+        for b in range(B):
+            writer.write(tt_cam[b], os.path.join(args.out, df_test.loc[row][img_column]))
+            row += 1
 
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir
-                )
-        sitk.WriteImage(sitk.GetImageFromArray(tt_cam, isVector=True), out_fn)
+    writer.close()
 
-    
 
 if __name__ == '__main__':
 
@@ -95,6 +242,9 @@ if __name__ == '__main__':
     parser.add_argument('--num_workers', help='Number of workers for loading', type=int, default=4)    
     parser.add_argument('--nn', help='Type of neural network', type=str, default="efficientnet_v2s_stacks")    
     parser.add_argument('--out', help='Output directory', type=str, default="./cam")
+    parser.add_argument('--engine', help='batched computes the CAMs of all the frames of --batch_size stacks at once, grad_cam runs pytorch_grad_cam frame by frame', type=str, default="batched", choices=["batched", "grad_cam"])
+    parser.add_argument('--batch_size', help='Number of stacks per batch with the batched engine', type=int, default=2)
+    parser.add_argument('--amp', help='Run the forward pass under autocast with the batched engine', type=int, default=0)
     
 
 
@@ -1,10 +1,12 @@
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
 import pandas as pd
 import numpy as np
 import SimpleITK as sitk
 import nrrd
 import os
 import math
+import hashlib
+import tempfile
 import torch
 import lightning.pytorch as pl
 from torchvision import transforms
@@ -22,6 +24,7 @@ from monai.transforms import (
     ToNumpy,
     AddChanneld,
     AsChannelLastd,
+    CastToTyped,
     CenterSpatialCropd,
     EnsureChannelFirstd,
     Lambdad,
@@ -38,21 +41,128 @@ from monai.transforms import (
 
 from monai.data.utils import pad_list_data_collate
 
+from utils import random_affine_theta, affine_transform, color_jitter, random_grayscale, random_gaussian_blur, sample_mask, where_samples
+
+class TTSegCache:
+    # Decodes each (img, seg) pair once and keeps the arrays as uint8 .npy shards that are memory mapped on read (copy on write).
+    # Shards are keyed by path and mtime, so an edited image gets a new entry. 'ram' keeps the shards in shared memory (/dev/shm),
+    # 'disk' in cache_dir. Writes go through a temporary file and os.replace, so DataLoader workers can fill the cache concurrently.
+    def __init__(self, backend="disk", cache_dir=None):
+        self.backend = backend
+        if cache_dir is None:
+            if backend == "ram" and os.path.isdir("/dev/shm"):
+                cache_dir = os.path.join("/dev/shm", "tt_cache")
+            else:
+                cache_dir = os.path.join(tempfile.gettempdir(), "tt_cache")
+        self.cache_dir = cache_dir
+
+    def key(self, img_path, seg_path):
+        h = hashlib.sha1()
+        for path in (img_path, seg_path):
+            h.update(os.path.abspath(path).encode())
+            h.update(str(os.stat(path).st_mtime_ns).encode())
+        return h.hexdigest()
+
+    def shard(self, key, name):
+        return os.path.join(self.cache_dir, key[:2], key + "_" + name + ".npy")
+
+    def write(self, fn, arr):
+        if arr.dtype != np.uint8 and (arr.min() < 0 or arr.max() > 255):
+            raise ValueError("The cache stores uint8 images, " + fn + " has values outside [0, 255], use cache off")
+        arr = arr.astype(np.uint8, copy=False)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        tmp_fn = fn + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_fn, "wb") as f:
+            np.save(f, arr)
+        os.replace(tmp_fn, fn)
+
+    def __call__(self, img_path, seg_path):
+        key = self.key(img_path, seg_path)
+        img_fn = self.shard(key, "img")
+        seg_fn = self.shard(key, "seg")
+
+        if not os.path.exists(img_fn) or not os.path.exists(seg_fn):
+            self.write(img_fn, np.squeeze(sitk.GetArrayFromImage(sitk.ReadImage(img_path))))
+            self.write(seg_fn, np.squeeze(sitk.GetArrayFromImage(sitk.ReadImage(seg_path))))
+
+        return np.load(img_fn, mmap_mode="c"), np.load(seg_fn, mmap_mode="c")
+
+def get_seg_cache(cache="off", cache_dir=None):
+    if cache is None or cache == "off":
+        return None
+    if cache not in ("ram", "disk"):
+        raise ValueError("Unknown cache backend: " + str(cache))
+    return TTSegCache(backend=cache, cache_dir=cache_dir)
+
+def read_image_size(path):
+    # (height, width) from the image header without decoding the pixels
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    size = reader.GetSize()
+    return (size[1], size[0])
+
+def get_image_sizes(df, mount_point="./", img_column="img_path", cache=None):
+    # Image sizes in the row order of df, cache is a dict path -> size reused between calls
+    if cache is None:
+        cache = {}
+    sizes = []
+    for img in df[img_column]:
+        path = os.path.join(mount_point, img)
+        if path not in cache:
+            cache[path] = read_image_size(path)
+        sizes.append(cache[path])
+    return sizes
+
+class BucketBatchSampler(BatchSampler):
+    # Batches of images with similar sizes. The indices of the sampler are taken in chunks of bucket_size batches,
+    # sorted by size inside every chunk and cut in batches. The batch order is shuffled if shuffle is set.
+    # The sampler is the first argument so lightning can swap it for a DistributedSampler.
+    def __init__(self, sampler, sizes, batch_size, drop_last=False, bucket_size=32, shuffle=True):
+        super().__init__(sampler, batch_size, drop_last)
+        self.sizes = sizes
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        indices = list(self.sampler)
+        chunk_size = self.batch_size*self.bucket_size
+
+        batches = []
+        for i in range(0, len(indices), chunk_size):
+            chunk = sorted(indices[i:i + chunk_size], key=lambda idx: (max(self.sizes[idx]), self.sizes[idx]))
+            batches.extend(chunk[j:j + self.batch_size] for j in range(0, len(chunk), self.batch_size))
+
+        if self.drop_last:
+            batches = [b for b in batches if len(b) == self.batch_size]
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+
+        return iter(batches)
+
 class TTDatasetSeg(Dataset):
-    def __init__(self, df, mount_point="./", img_column="img_path", seg_column="seg_path", class_column=None):
+    def __init__(self, df, mount_point="./", img_column="img_path", seg_column="seg_path", class_column=None, cache=None):
         self.df = df        
         self.mount_point = mount_point
         self.img_column = img_column
         self.seg_column = seg_column
         self.class_column = class_column
+        self.cache = cache
     def __len__(self):
         return len(self.df.index)
     def __getitem__(self, idx):
         row = self.df.loc[idx]
         img = os.path.join(self.mount_point, row[self.img_column])
         seg = os.path.join(self.mount_point, row[self.seg_column])
-        img_t = torch.tensor(np.squeeze(sitk.GetArrayFromImage(sitk.ReadImage(img)).copy())).to(torch.float32)
-        seg_t = torch.tensor(np.squeeze(sitk.GetArrayFromImage(sitk.ReadImage(seg)).copy())).to(torch.float32)
+        if self.cache is not None:
+            # uint8 views of the memory mapped shards, the Seg transforms cast them to float32 in their first step
+            img_np, seg_np = self.cache(img, seg)
+            img_t = torch.from_numpy(img_np)
+            seg_t = torch.from_numpy(seg_np)
+        else:
+            img_t = torch.tensor(np.squeeze(sitk.GetArrayFromImage(sitk.ReadImage(img)).copy())).to(torch.float32)
+            seg_t = torch.tensor(np.squeeze(sitk.GetArrayFromImage(sitk.ReadImage(seg)).copy())).to(torch.float32)
 
         d = {"img": img_t, "seg": seg_t}
 
@@ -127,8 +237,55 @@ class TTDatasetStacks(Dataset):
 
         return img
 
+class TTDatasetStacksPacked(Dataset):
+    # Reads the stacks written by pack_stacks.py. Samples are uint8 views of the packed file (memory mapped copy on write, nothing is
+    # copied until the batch is collated) with shape [frames, channels, H, W], the conversion to float and the /255 rescale happen
+    # on the device (see stack_to_float). pack_stacks.py --check compares the samples with TTDatasetStacks.
+    def __init__(self, df, class_column=None, transform=None, pack_column="pack"):
+        self.df = df
+        self.transform = transform
+        self.class_column = class_column
+        self.pack_column = pack_column
+        self.packs = {}
+
+    def __len__(self):
+        return len(self.df.index)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["packs"] = {}
+        return state
+
+    def get_pack(self, pack_fn):
+        if pack_fn not in self.packs:
+            self.packs[pack_fn] = np.memmap(pack_fn, dtype=np.uint8, mode="c")
+        return self.packs[pack_fn]
+
+    def __getitem__(self, idx):
+
+        row = self.df.iloc[idx]
+
+        shape = (int(row["pack_frames"]), int(row["pack_height"]), int(row["pack_width"]), int(row["pack_channels"]))
+        offset = int(row["pack_offset"])
+
+        pack = self.get_pack(row[self.pack_column])
+        img = torch.from_numpy(pack[offset:offset + int(np.prod(shape))].reshape(shape)).permute((0, 3, 1, 2))
+
+        if self.transform:
+            img = self.transform(img)
+
+        if self.class_column:
+            return img, torch.tensor(row[self.class_column]).to(torch.long)
+
+        return img
+
+def stack_to_float(x):
+    if x.dtype == torch.uint8:
+        return x.to(torch.float32).div_(255.0)
+    return x
+
 class TTDataModuleSeg(pl.LightningDataModule):
-    def __init__(self, df_train, df_val, df_test, mount_point="./", batch_size=256, num_workers=4, img_column="img_path", seg_column="seg_path", class_column=None, balanced=False, train_transform=None, valid_transform=None, test_transform=None, drop_last=False):
+    def __init__(self, df_train, df_val, df_test, mount_point="./", batch_size=256, num_workers=4, img_column="img_path", seg_column="seg_path", class_column=None, balanced=False, train_transform=None, valid_transform=None, test_transform=None, drop_last=False, cache="off", cache_dir=None, bucket=False, bucket_size=32):
         super().__init__()
 
         self.df_train = df_train
@@ -145,33 +302,132 @@ class TTDataModuleSeg(pl.LightningDataModule):
         self.valid_transform = valid_transform
         self.test_transform = test_transform
         self.drop_last=drop_last
+        self.cache = get_seg_cache(cache, cache_dir)
+        self.bucket = bucket
+        self.bucket_size = bucket_size
+        self.img_sizes = {}
 
     def setup(self, stage=None):
 
         # Assign train/val datasets for use in dataloaders
-        self.train_ds = monai.data.Dataset(data=TTDatasetSeg(self.df_train, mount_point=self.mount_point, img_column=self.img_column, seg_column=self.seg_column, class_column=self.class_column), transform=self.train_transform)
+        self.train_ds = monai.data.Dataset(data=TTDatasetSeg(self.df_train, mount_point=self.mount_point, img_column=self.img_column, seg_column=self.seg_column, class_column=self.class_column, cache=self.cache), transform=self.train_transform)
+
+        self.val_ds = monai.data.Dataset(TTDatasetSeg(self.df_val, mount_point=self.mount_point, img_column=self.img_column, seg_column=self.seg_column, class_column=self.class_column, cache=self.cache), transform=self.valid_transform)
+        self.test_ds = monai.data.Dataset(TTDatasetSeg(self.df_test, mount_point=self.mount_point, img_column=self.img_column, seg_column=self.seg_column, class_column=self.class_column, cache=self.cache), transform=self.test_transform)
 
-        self.val_ds = monai.data.Dataset(TTDatasetSeg(self.df_val, mount_point=self.mount_point, img_column=self.img_column, seg_column=self.seg_column, class_column=self.class_column), transform=self.valid_transform)
-        self.test_ds = monai.data.Dataset(TTDatasetSeg(self.df_test, mount_point=self.mount_point, img_column=self.img_column, seg_column=self.seg_column, class_column=self.class_column), transform=self.test_transform)
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # Transforms with a batch_transform run part of the augmentation on the device for the whole batch
+        if self.trainer is not None and self.trainer.training and hasattr(self.train_transform, "batch_transform"):
+            batch = self.train_transform.batch_transform(batch)
+        return batch
 
     def train_dataloader(self):
 
+        df_train = self.df_train
         if self.balanced: 
             g = self.df_train.groupby(self.class_column)
             df_train = g.apply(lambda x: x.sample(g.size().min())).reset_index(drop=True).sample(frac=1).reset_index(drop=True)
-            self.train_ds = monai.data.Dataset(data=TTDatasetSeg(df_train, mount_point=self.mount_point, img_column=self.img_column, seg_column=self.seg_column, class_column=self.class_column), transform=self.train_transform)            
+            self.train_ds = monai.data.Dataset(data=TTDatasetSeg(df_train, mount_point=self.mount_point, img_column=self.img_column, seg_column=self.seg_column, class_column=self.class_column, cache=self.cache), transform=self.train_transform)            
+
+        if self.bucket:
+            sizes = get_image_sizes(df_train, mount_point=self.mount_point, img_column=self.img_column, cache=self.img_sizes)
+            batch_sampler = BucketBatchSampler(RandomSampler(self.train_ds), sizes, self.batch_size, drop_last=self.drop_last, bucket_size=self.bucket_size)
+            return DataLoader(self.train_ds, batch_sampler=batch_sampler, num_workers=self.num_workers, pin_memory=True, collate_fn=pad_list_data_collate, prefetch_factor=4)
 
         return DataLoader(self.train_ds, batch_size=self.batch_size, num_workers=self.num_workers, pin_memory=True, drop_last=self.drop_last, collate_fn=pad_list_data_collate, shuffle=True, prefetch_factor=4)
 
     def val_dataloader(self):
+        if self.bucket:
+            sizes = get_image_sizes(self.df_val, mount_point=self.mount_point, img_column=self.img_column, cache=self.img_sizes)
+            batch_sampler = BucketBatchSampler(SequentialSampler(self.val_ds), sizes, self.batch_size, drop_last=self.drop_last, bucket_size=self.bucket_size, shuffle=False)
+            return DataLoader(self.val_ds, batch_sampler=batch_sampler, num_workers=self.num_workers, collate_fn=pad_list_data_collate)
+
         return DataLoader(self.val_ds, batch_size=self.batch_size, num_workers=self.num_workers, drop_last=self.drop_last, collate_fn=pad_list_data_collate)
 
     def test_dataloader(self):
         return DataLoader(self.test_ds, batch_size=self.batch_size, num_workers=self.num_workers, drop_last=self.drop_last)
 
 
+class BatchCollate:
+    # Collates (img, label) samples into one preallocated batch, the images are copied in place.
+    # pad=True pads the images to the largest height/width of the batch, pad=False expects images of the same size.
+    # In the DataLoader workers the batch is allocated in shared memory like default_collate does.
+    # With pin_memory in the main process (num_workers=0) every batch is a new pinned tensor. pool_size > 0 reuses a round robin
+    # pool of pool_size pinned buffers per batch shape instead, a batch is overwritten pool_size batches later so it must not be
+    # kept (e.g. outputs kept for the epoch end metrics).
+    def __init__(self, pad=True, pin_memory=False, pool_size=0):
+        self.pad = pad
+        self.pin_memory = pin_memory
+        self.pool_size = pool_size
+        self.pool = {}
+        self.pool_idx = {}
+        if pin_memory and pool_size > 0:
+            print("BatchCollate: the pinned batches are reused after", pool_size, "batches, do not keep references to them")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["pool"] = {}
+        state["pool_idx"] = {}
+        return state
+
+    def allocate(self, elem, shape):
+        if torch.utils.data.get_worker_info() is not None:
+            storage = elem._typed_storage()._new_shared(math.prod(shape), device=elem.device)
+            return elem.new(storage).resize_(shape)
+
+        if self.pin_memory and torch.cuda.is_available():
+            if self.pool_size <= 0:
+                return torch.empty(shape, dtype=elem.dtype).pin_memory()
+
+            key = (shape, elem.dtype)
+            if key not in self.pool:
+                # At most 8 batch shapes, the oldest one is dropped
+                if len(self.pool) >= 8:
+                    oldest = next(iter(self.pool))
+                    del self.pool[oldest]
+                    del self.pool_idx[oldest]
+                self.pool[key] = []
+                self.pool_idx[key] = 0
+            buffers = self.pool[key]
+            idx = self.pool_idx[key]
+            if len(buffers) < self.pool_size:
+                buffers.append(torch.empty(shape, dtype=elem.dtype).pin_memory())
+            self.pool_idx[key] = (idx + 1) % self.pool_size
+            return buffers[idx]
+
+        return torch.empty(shape, dtype=elem.dtype)
+
+    def __call__(self, batch):
+        if isinstance(batch[0], (tuple, list)):
+            imgs, labels = zip(*batch)
+        else:
+            imgs, labels = batch, None
+
+        channels = imgs[0].shape[0]
+        max_height = max(img.shape[1] for img in imgs)
+        max_width = max(img.shape[2] for img in imgs)
+
+        same_size = all(img.shape[1] == max_height and img.shape[2] == max_width for img in imgs)
+        if not same_size and not self.pad:
+            raise ValueError("Images of different sizes in the batch, use pad=True to pad them")
+
+        out = self.allocate(imgs[0], (len(imgs), channels, max_height, max_width))
+        if not same_size:
+            out.zero_()
+
+        for idx, img in enumerate(imgs):
+            out[idx, :, :img.shape[1], :img.shape[2]].copy_(img)
+
+        if labels is None:
+            return out
+
+        if isinstance(labels[0], torch.Tensor):
+            return out, torch.stack(labels)
+        return out, torch.tensor(labels)
+
+
 class TTDataModule(pl.LightningDataModule):
-    def __init__(self, df_train, df_val, df_test, mount_point="./", batch_size=256, num_workers=4, img_column="img_path", class_column=None, train_transform=None, valid_transform=None, test_transform=None, drop_last=False):
+    def __init__(self, df_train, df_val, df_test, mount_point="./", batch_size=256, num_workers=4, img_column="img_path", class_column=None, train_transform=None, valid_transform=None, test_transform=None, drop_last=False, pad=True, pin_memory=False, pin_pool=0):
         super().__init__()
 
         self.df_train = df_train
@@ -186,6 +442,10 @@ class TTDataModule(pl.LightningDataModule):
         self.valid_transform = valid_transform
         self.test_transform = test_transform
         self.drop_last=drop_last
+        self.pin_memory = pin_memory
+        # The workers allocate the batches in shared memory and the DataLoader pins them, without workers the collate pins them,
+        # from a pool of pin_pool reused buffers if pin_pool > 0
+        self.custom_collate_fn = BatchCollate(pad=pad, pin_memory=pin_memory and num_workers == 0, pool_size=pin_pool)
 
     def setup(self, stage=None):
 
@@ -195,26 +455,17 @@ class TTDataModule(pl.LightningDataModule):
         self.test_ds = TTDataset(self.df_test, self.mount_point, img_column=self.img_column, class_column=self.class_column, transform=self.valid_transform)
 
     def train_dataloader(self):
-        return DataLoader(self.train_ds, batch_size=self.batch_size, num_workers=self.num_workers, persistent_workers=True, collate_fn=self.custom_collate_fn, pin_memory=False, drop_last=self.drop_last)
+        return DataLoader(self.train_ds, batch_size=self.batch_size, num_workers=self.num_workers, persistent_workers=self.num_workers > 0, collate_fn=self.custom_collate_fn, pin_memory=self.pin_memory and self.num_workers > 0, drop_last=self.drop_last)
 
     def val_dataloader(self):
-        return DataLoader(self.val_ds, batch_size=self.batch_size, num_workers=self.num_workers, persistent_workers=True, collate_fn=self.custom_collate_fn, pin_memory=False, drop_last=self.drop_last)
+        return DataLoader(self.val_ds, batch_size=self.batch_size, num_workers=self.num_workers, persistent_workers=self.num_workers > 0, collate_fn=self.custom_collate_fn, pin_memory=self.pin_memory and self.num_workers > 0, drop_last=self.drop_last)
 
     def test_dataloader(self):
-        return DataLoader(self.test_ds, batch_size=self.batch_size, num_workers=self.num_workers, persistent_workers=True, collate_fn=self.custom_collate_fn, pin_memory=False, drop_last=self.drop_last)
-
-    def custom_collate_fn(self,batch):
-        imgs, labels = zip(*batch)
-
-        max_height = max([img.shape[1] for img in imgs])
-        max_width = max([img.shape[2] for img in imgs])
-        padded_imgs = [torch.nn.functional.pad(img, (0, max_width - img.shape[2], 0, max_height - img.shape[1])) for img in imgs]
-    
-        return torch.stack(padded_imgs), torch.tensor(labels)
+        return DataLoader(self.test_ds, batch_size=self.batch_size, num_workers=self.num_workers, persistent_workers=self.num_workers > 0, collate_fn=self.custom_collate_fn, pin_memory=self.pin_memory and self.num_workers > 0, drop_last=self.drop_last)
 
 
 class TTDataModuleStacks(pl.LightningDataModule):
-    def __init__(self, df_train, df_val, df_test, mount_point="./", batch_size=32, num_workers=4, img_column="img_path", class_column=None, train_transform=None, valid_transform=None, test_transform=None, drop_last=False):
+    def __init__(self, df_train, df_val, df_test, mount_point="./", batch_size=32, num_workers=4, img_column="img_path", class_column=None, train_transform=None, valid_transform=None, test_transform=None, drop_last=False, packed=False):
         super().__init__()
 
         self.df_train = df_train
@@ -229,13 +480,25 @@ class TTDataModuleStacks(pl.LightningDataModule):
         self.valid_transform = valid_transform
         self.test_transform = test_transform
         self.drop_last=drop_last
+        self.packed = packed
 
     def setup(self, stage=None):
 
         # Assign train/val datasets for use in dataloaders
-        self.train_ds = TTDatasetStacks(self.df_train, self.mount_point, img_column=self.img_column, class_column=self.class_column, transform=self.train_transform)
-        self.val_ds = TTDatasetStacks(self.df_val, self.mount_point, img_column=self.img_column, class_column=self.class_column, transform=self.valid_transform)
-        self.test_ds = TTDatasetStacks(self.df_test, self.mount_point, img_column=self.img_column, class_column=self.class_column, transform=self.valid_transform)
+        if self.packed:
+            self.train_ds = TTDatasetStacksPacked(self.df_train, class_column=self.class_column, transform=self.train_transform)
+            self.val_ds = TTDatasetStacksPacked(self.df_val, class_column=self.class_column, transform=self.valid_transform)
+            self.test_ds = TTDatasetStacksPacked(self.df_test, class_column=self.class_column, transform=self.valid_transform)
+        else:
+            self.train_ds = TTDatasetStacks(self.df_train, self.mount_point, img_column=self.img_column, class_column=self.class_column, transform=self.train_transform)
+            self.val_ds = TTDatasetStacks(self.df_val, self.mount_point, img_column=self.img_column, class_column=self.class_column, transform=self.valid_transform)
+            self.test_ds = TTDatasetStacks(self.df_test, self.mount_point, img_column=self.img_column, class_column=self.class_column, transform=self.valid_transform)
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # Packed stacks arrive as uint8, rescale them once they are on the device
+        if isinstance(batch, (list, tuple)):
+            return [stack_to_float(batch[0])] + list(batch[1:])
+        return stack_to_float(batch)
 
     def train_dataloader(self):
         return DataLoader(self.train_ds, batch_size=self.batch_size, num_workers=self.num_workers, persistent_workers=True, pin_memory=True, drop_last=self.drop_last)
@@ -404,6 +667,7 @@ class TrainTransformsSeg:
         color_jitter = transforms.ColorJitter(brightness=[.5, 1.8], contrast=[0.5, 1.8], saturation=[.5, 1.8], hue=[-.2, .2])
         self.train_transform = Compose(
             [
+                CastToTyped(keys=["img", "seg"], dtype=torch.float32),
                 EnsureChannelFirstd(strict_check=False, keys=["img"], channel_dim=2),
                 EnsureChannelFirstd(strict_check=False, keys=["seg"], channel_dim='no_channel'),
                 LabelMapCrop(img_key="img", seg_key="seg", prob=0.5),
@@ -425,6 +689,7 @@ class TrainTransformsFullSeg:
         color_jitter = transforms.ColorJitter(brightness=[.5, 1.8], contrast=[0.5, 1.8], saturation=[.5, 1.8], hue=[-.2, .2])
         self.train_transform = Compose(
             [
+                CastToTyped(keys=["img", "seg"], dtype=torch.float32),
                 EnsureChannelFirstd(strict_check=False, keys=["img"], channel_dim=2),
                 EnsureChannelFirstd(strict_check=False, keys=["seg"], channel_dim='no_channel'),
                 SquarePad(keys=["img", "seg"]),
@@ -437,10 +702,61 @@ class TrainTransformsFullSeg:
     def __call__(self, inp):
         return self.train_transform(inp)
 
+class TrainTransformsSegGPU:
+    # TrainTransformsSeg split in two, the workers only crop, resize and scale and
+    # batch_transform does the zoom, flip, rotation and color jitter on the device for the whole batch
+    def __init__(self):
+        self.train_transform = Compose(
+            [
+                CastToTyped(keys=["img", "seg"], dtype=torch.float32),
+                EnsureChannelFirstd(strict_check=False, keys=["img"], channel_dim=2),
+                EnsureChannelFirstd(strict_check=False, keys=["seg"], channel_dim='no_channel'),
+                LabelMapCrop(img_key="img", seg_key="seg", prob=0.5),
+                Resized(keys=["img", "seg"], spatial_size=[512, 512], mode=['area', 'nearest']),
+                ScaleIntensityd(keys=["img"]),
+                ToTensord(keys=["img", "seg"])
+            ]
+        )
+    def __call__(self, inp):
+        return self.train_transform(inp)
+
+    def batch_transform(self, X):
+        img = X["img"]
+        theta = random_affine_theta(img.shape[0], img.device, zoom=(0.5, 1.5), zoom_prob=0.5, rotate=math.pi/2.0, rotate_prob=0.5, hflip_prob=0.5)
+        X["img"] = color_jitter(affine_transform(img, theta, mode="bilinear"), brightness=(.5, 1.8), contrast=(.5, 1.8), saturation=(.5, 1.8), hue=(-.2, .2))
+        X["seg"] = affine_transform(X["seg"], theta, mode="nearest")
+        return X
+
+class TrainTransformsFullSegGPU:
+    # TrainTransformsFullSeg with RandomIntensity moved to batch_transform, on the device for the whole batch
+    def __init__(self):
+        self.train_transform = Compose(
+            [
+                CastToTyped(keys=["img", "seg"], dtype=torch.float32),
+                EnsureChannelFirstd(strict_check=False, keys=["img"], channel_dim=2),
+                EnsureChannelFirstd(strict_check=False, keys=["seg"], channel_dim='no_channel'),
+                SquarePad(keys=["img", "seg"]),
+                RandomLabelMapCrop(img_key="img", seg_key="seg", prob=0.5, pad=0.15),
+                ScaleIntensityd(keys=["img"]),
+                ToTensord(keys=["img", "seg"])
+            ]
+        )
+    def __call__(self, inp):
+        return self.train_transform(inp)
+
+    def batch_transform(self, X):
+        img = X["img"]
+        out = color_jitter(img, brightness=(0.6, 1.4), contrast=(0.6, 1.4), saturation=(0.6, 1.4), hue=(-0.1, 0.1), prob=0.8)
+        out = random_grayscale(out, prob=0.2)
+        out = random_gaussian_blur(out, sigma=(0.1, 2.0), prob=0.5)
+        X["img"] = where_samples(sample_mask(img.shape[0], 0.5, img.device), out, img)
+        return X
+
 class EvalTransformsFullSeg:
     def __init__(self):        
         self.eval_transform = Compose(
             [
+                CastToTyped(keys=["img", "seg"], dtype=torch.float32),
                 EnsureChannelFirstd(strict_check=False, keys=["img"], channel_dim=2),
                 EnsureChannelFirstd(strict_check=False, keys=["seg"], channel_dim='no_channel'),
                 SquarePad(keys=["img", "seg"]),
@@ -455,6 +771,7 @@ class EvalTransformsSeg:
     def __init__(self):
         self.eval_transform = Compose(
             [
+                CastToTyped(keys=["img", "seg"], dtype=torch.float32),
                 EnsureChannelFirstd(strict_check=False, keys=["img"], channel_dim=2),
                 EnsureChannelFirstd(strict_check=False, keys=["seg"], channel_dim='no_channel'),       
                 Resized(keys=["img", "seg"], spatial_size=[512, 512], mode=['area', 'nearest']),
@@ -1,4 +1,5 @@
 import math
+from collections import OrderedDict
 import numpy as np 
 
 from typing import Optional, Tuple
@@ -16,7 +17,8 @@ import monai
 
 import lightning.pytorch as pl
 from torchvision.ops import sigmoid_focal_loss
-from utils import mixup_img_seg, FocalLoss, mixup_img
+from utils import mixup_img_seg, FocalLoss, float32_loss, pretrained, mixup_img, compute_bb, extract_patches
+from utils import sample_uniform, sample_mask, where_samples, random_resized_crop_theta, random_affine_theta, compose_theta, affine_transform, adjust_brightness, adjust_contrast, adjust_saturation, adjust_hue, gaussian_blur
 
 from monai.transforms import (
     AsChannelLast,
@@ -54,6 +56,66 @@ class GaussianNoise(nn.Module):
     def forward(self, x):
         return x + torch.normal(mean=self.mean, std=self.std, size=x.size(), device=x.device)
 
+class BatchTransform(nn.Module):
+    # Batched version of the RandomResizedCrop, RandomHorizontalFlip, RandomRotation, ColorJitter, GaussianBlur and GaussianNoise train transforms.
+    # The random parameters are drawn for every sample of [B, C, H, W] and for every stack of [B, T, C, H, W], or for every frame with per_frame=True.
+    # Crop, flip and rotation are a single grid_sample, the ColorJitter ops are applied in a fixed order
+    def __init__(self, size=448, scale=(0.2, 1.0), degrees=90, hflip_prob=0.5, brightness=0.8, contrast=0.8, saturation=0.8, hue=0.2, jitter_prob=0.5, blur_sigma=(0.1, 2.0), blur_prob=0.5, noise_std=0.02, noise_prob=0.5, per_frame=False):
+        super(BatchTransform, self).__init__()
+        self.size = size
+        self.scale = scale
+        self.degrees = degrees
+        self.hflip_prob = hflip_prob
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+        self.jitter_prob = jitter_prob
+        self.blur_sigma = blur_sigma
+        self.blur_prob = blur_prob
+        self.noise_std = noise_std
+        self.noise_prob = noise_prob
+        self.per_frame = per_frame
+
+    def forward(self, x):
+        shape = x.shape
+        n = shape[0]
+        repeats = 1
+        if x.dim() == 5:
+            if self.per_frame:
+                n = shape[0]*shape[1]
+            else:
+                repeats = shape[1]
+            x = x.reshape(-1, *shape[2:])
+
+        device = x.device
+
+        def uniform(low, high):
+            return sample_uniform(n, low, high, device).repeat_interleave(repeats)
+
+        def mask(prob):
+            return sample_mask(n, prob, device).repeat_interleave(repeats)
+
+        theta = compose_theta(
+            random_resized_crop_theta(n, device, x.shape[-2:], scale=self.scale),
+            random_affine_theta(n, device, rotate=math.radians(self.degrees), rotate_prob=1.0, hflip_prob=self.hflip_prob))
+        x = affine_transform(x, theta.repeat_interleave(repeats, dim=0), size=(self.size, self.size))
+
+        if self.jitter_prob > 0:
+            x_j = adjust_brightness(x, uniform(max(0, 1 - self.brightness), 1 + self.brightness))
+            x_j = adjust_contrast(x_j, uniform(max(0, 1 - self.contrast), 1 + self.contrast))
+            x_j = adjust_saturation(x_j, uniform(max(0, 1 - self.saturation), 1 + self.saturation))
+            x_j = adjust_hue(x_j, uniform(-self.hue, self.hue))
+            x = where_samples(mask(self.jitter_prob), x_j, x)
+
+        if self.blur_prob > 0:
+            x = where_samples(mask(self.blur_prob), gaussian_blur(x, uniform(self.blur_sigma[0], self.blur_sigma[1])), x)
+
+        if self.noise_prob > 0:
+            x = where_samples(mask(self.noise_prob), x + torch.randn_like(x)*self.noise_std, x)
+
+        return x.reshape(*shape[:-2], self.size, self.size)
+
 class EfficientnetV2s(pl.LightningModule):
     def __init__(self, features=False, **kwargs):
     # def __init__(self, **kwargs):
@@ -67,7 +129,7 @@ class EfficientnetV2s(pl.LightningModule):
         if(self.class_weights is not None):
             self.class_weights = torch.tensor(self.class_weights).to(torch.float32)
             
-        self.loss = nn.CrossEntropyLoss(weight=self.class_weights)
+        self.loss = float32_loss(nn.CrossEntropyLoss(weight=self.class_weights))
         self.accuracy = torchmetrics.Accuracy(task='multiclass', num_classes=self.hparams.out_features)
 
         # self.model = nn.Sequential(
@@ -78,7 +140,7 @@ class EfficientnetV2s(pl.LightningModule):
         #     nn.Linear(in_features=1280, out_features=out_features, bias=True)
         #     )
         self.model = nn.Sequential(
-            models.efficientnet_v2_s(pretrained=True).features,
+            models.efficientnet_v2_s(weights=pretrained(models.EfficientNet_V2_S_Weights.IMAGENET1K_V1)).features,
             ops.Conv2dNormActivation(1280, self.hparams.feature_size),
             nn.AdaptiveAvgPool2d(1),
             nn.Flatten(start_dim=1),
@@ -103,6 +165,9 @@ class EfficientnetV2s(pl.LightningModule):
             transforms.CenterCrop(448)
         )
 
+        if self.hparams.get('batch_aug', False):
+            self.train_transform = BatchTransform(448)
+
     def configure_optimizers(self):
         optimizer = torch.optim.Adam(self.parameters(), lr=self.hparams.lr)
         return optimizer
@@ -171,10 +236,10 @@ class Resnet50(pl.LightningModule):
         if hasattr(self.hparams, "class_weights"):
             class_weights = torch.tensor(self.hparams.class_weights).to(torch.float32)
             
-        self.loss = nn.CrossEntropyLoss(weight=class_weights)
+        self.loss = float32_loss(nn.CrossEntropyLoss(weight=class_weights))
         self.accuracy = torchmetrics.Accuracy(task='multiclass', num_classes=self.hparams.out_features)
         
-        feat = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V2)
+        feat = models.resnet50(weights=pretrained(models.ResNet50_Weights.IMAGENET1K_V2))
         feat.fc = nn.Identity()
 
         # self.feat = TimeDistributed(feat)
@@ -265,10 +330,10 @@ class SEResNext101(pl.LightningModule):
         if hasattr(self.hparams, "class_weights"):
             class_weights = torch.tensor(self.hparams.class_weights).to(torch.float32)
             
-        self.loss = nn.CrossEntropyLoss(weight=class_weights)
+        self.loss = float32_loss(nn.CrossEntropyLoss(weight=class_weights))
         self.accuracy = torchmetrics.Accuracy(task='multiclass', num_classes=self.hparams.out_features)
         
-        feat = monai.networks.nets.SEResNext101(spatial_dims=2, in_channels=3, pretrained=True)
+        feat = monai.networks.nets.SEResNext101(spatial_dims=2, in_channels=3, pretrained=bool(pretrained(True)))
         feat.last_linear = nn.Identity()
 
         # self.feat = TimeDistributed(feat)
@@ -357,10 +422,10 @@ class SEResNext101_V2(pl.LightningModule):
         if hasattr(self.hparams, "class_weights"):
             class_weights = torch.tensor(self.hparams.class_weights).to(torch.float32)
             
-        self.loss = nn.CrossEntropyLoss(weight=class_weights)
+        self.loss = float32_loss(nn.CrossEntropyLoss(weight=class_weights))
         self.accuracy = torchmetrics.Accuracy(task='multiclass', num_classes=self.hparams.out_features)
         
-        feat = monai.networks.nets.SEResNext101(spatial_dims=2, in_channels=3, pretrained=True)
+        feat = monai.networks.nets.SEResNext101(spatial_dims=2, in_channels=3, pretrained=bool(pretrained(True)))
 
         # self.feat = TimeDistributed(feat)
         # self.pool = AveragePool1D(dim=1)
@@ -555,7 +620,7 @@ class EfficientnetV2sStacks(pl.LightningModule):
         if(class_weights is not None):
             class_weights = torch.tensor(class_weights).to(torch.float32)
             
-        self.loss = nn.CrossEntropyLoss(weight=class_weights)
+        self.loss = float32_loss(nn.CrossEntropyLoss(weight=class_weights))
 
         if(out_features==2):
             self.accuracy = torchmetrics.Accuracy(task='binary')
@@ -579,11 +644,17 @@ class EfficientnetV2sStacks(pl.LightningModule):
             transforms.RandomApply([GaussianNoise(0.0, 0.02)], p=0.5)
         )))
 
+        if getattr(args, 'batch_aug', False):
+            self.train_transform = torch.nn.Sequential(Rescale(), BatchTransform(448, per_frame=getattr(args, 'batch_aug_per_frame', False)))
+
         self.test_transform = torch.nn.Sequential(Rescale(), TimeDistributed(torch.nn.Sequential(
             transforms.CenterCrop(748),
             transforms.Resize(448)
         )))
 
+        # Submodules compiled by utils.compile_regions, they have no graph breaks
+        self.compiled_regions = ["F", "V", "A", "P"]
+
     def configure_optimizers(self):
         optimizer = torch.optim.AdamW(self.parameters(), lr=self.hparams.args.lr)
         return optimizer
@@ -674,7 +745,7 @@ class EfficientnetV2sStacksDot(pl.LightningModule):
         if(class_weights is not None):
             class_weights = torch.tensor(class_weights).to(torch.float32)
             
-        self.loss = nn.CrossEntropyLoss(weight=class_weights)
+        self.loss = float32_loss(nn.CrossEntropyLoss(weight=class_weights))
         self.accuracy = torchmetrics.Accuracy(task="multiclass", num_classes=self.hparams.out_features)
 
         self.F = TimeDistributed(self.model_patches)
@@ -695,12 +766,19 @@ class EfficientnetV2sStacksDot(pl.LightningModule):
             transforms.RandomApply([GaussianNoise(0.0, 0.02)], p=0.5)    
         ))
 
+        if getattr(args, 'batch_aug', False):
+            # The crop is resampled directly to 448
+            self.train_transform = BatchTransform(448, per_frame=getattr(args, 'batch_aug_per_frame', False))
+
         self.test_transform = TimeDistributed(torch.nn.Sequential(            
             transforms.CenterCrop(448)
             # transforms.CenterCrop(748),
             # transforms.Resize(448)
         ))
 
+        # Submodules compiled by utils.compile_regions, they have no graph breaks
+        self.compiled_regions = ["F", "V", "A", "P"]
+
     def configure_optimizers(self):
         optimizer = torch.optim.AdamW(self.parameters(), lr=self.hparams.args.lr)
         return optimizer
@@ -791,7 +869,7 @@ class EfficientnetV2sStacksSigDot(pl.LightningModule):
         if(class_weights is not None):
             class_weights = torch.tensor(class_weights).to(torch.float32)
             
-        self.loss = nn.CrossEntropyLoss(weight=class_weights)
+        self.loss = float32_loss(nn.CrossEntropyLoss(weight=class_weights))
         self.accuracy = torchmetrics.Accuracy()
 
         self.F = TimeDistributed(self.model_patches)
@@ -811,10 +889,16 @@ class EfficientnetV2sStacksSigDot(pl.LightningModule):
             transforms.RandomApply([transforms.GaussianBlur(5, sigma=(0.1, 2.0))], p=0.5)            
         ))
 
+        if getattr(args, 'batch_aug', False):
+            self.train_transform = BatchTransform(448, noise_prob=0, per_frame=getattr(args, 'batch_aug_per_frame', False))
+
         self.test_transform = TimeDistributed(torch.nn.Sequential(            
             transforms.CenterCrop(448)
         ))
 
+        # Submodules compiled by utils.compile_regions, they have no graph breaks
+        self.compiled_regions = ["F", "V", "A", "P"]
+
     def configure_optimizers(self):
         optimizer = torch.optim.Adam(self.parameters(), lr=self.hparams.args.lr)
         return optimizer
@@ -943,7 +1027,7 @@ class MobileNetV2(pl.LightningModule):
         if(class_weights is not None):
             class_weights = torch.tensor(class_weights).to(torch.float32)
             
-        self.loss = nn.CrossEntropyLoss(weight=class_weights)
+        self.loss = float32_loss(nn.CrossEntropyLoss(weight=class_weights))
         self.accuracy = torchmetrics.Accuracy()
 
         # self.model = nn.Sequential(
@@ -954,7 +1038,7 @@ class MobileNetV2(pl.LightningModule):
         #     nn.Linear(in_features=1280, out_features=out_features, bias=True)
         #     )
         self.model = nn.Sequential(            
-            models.mobilenet_v2(weights=models.MobileNet_V2_Weights.IMAGENET1K_V1).features,
+            models.mobilenet_v2(weights=pretrained(models.MobileNet_V2_Weights.IMAGENET1K_V1)).features,
             ops.Conv2dNormActivation(1280, 1536),
             nn.AdaptiveAvgPool2d(1),
             nn.Flatten(start_dim=1),
@@ -1040,7 +1124,7 @@ class MobileNetV2Stacks(pl.LightningModule):
         else:
 
             self.model_patches = nn.Sequential(
-                models.mobilenet_v2(weights=models.MobileNet_V2_Weights.IMAGENET1K_V1).features,
+                models.mobilenet_v2(weights=pretrained(models.MobileNet_V2_Weights.IMAGENET1K_V1)).features,
                 ops.Conv2dNormActivation(1280, 1536),
                 nn.AdaptiveAvgPool2d(1),
                 nn.Flatten(start_dim=1)
@@ -1050,7 +1134,7 @@ class MobileNetV2Stacks(pl.LightningModule):
         if(class_weights is not None):
             class_weights = torch.tensor(class_weights).to(torch.float32)
             
-        self.loss = nn.CrossEntropyLoss(weight=class_weights)
+        self.loss = float32_loss(nn.CrossEntropyLoss(weight=class_weights))
         self.accuracy = torchmetrics.Accuracy()
 
         self.F = TimeDistributed(self.model_patches)
@@ -1216,11 +1300,11 @@ class MobileYOLT(pl.LightningModule):
         if hasattr(self.hparams, "class_weights"):
             class_weights = torch.tensor(self.hparams.class_weights).to(torch.float32)
             
-        self.loss = nn.CrossEntropyLoss(weight=class_weights)
+        self.loss = float32_loss(nn.CrossEntropyLoss(weight=class_weights))
         self.accuracy = torchmetrics.Accuracy()
 
         self.model = nn.Sequential(
-            models.mobilenet_v2(weights=models.MobileNet_V2_Weights.IMAGENET1K_V1).features,            
+            models.mobilenet_v2(weights=pretrained(models.MobileNet_V2_Weights.IMAGENET1K_V1)).features,            
             nn.AdaptiveAvgPool2d(1),
             nn.Flatten(start_dim=1)
             )
@@ -1234,8 +1318,6 @@ class MobileYOLT(pl.LightningModule):
         
         self.softmax = nn.Softmax(dim=1)
 
-        self.resize = transforms.Resize(self.hparams.patch_size)
-
         self.train_transform = transforms.Compose(
             [
                 RandomRotate(degrees=90, keys=["img", "seg"], interpolation=[transforms.functional.InterpolationMode.NEAREST, transforms.functional.InterpolationMode.NEAREST], prob=0.5), 
@@ -1247,45 +1329,10 @@ class MobileYOLT(pl.LightningModule):
         optimizer = torch.optim.AdamW(self.parameters(), lr=self.hparams.lr)
         return optimizer
     
-    def compute_bb(self, seg, label=3, pad=0):
-    
-        shape = seg.shape[1:]
-        
-        ij = torch.argwhere(seg.squeeze() == label)
-
-        bb = torch.tensor([0, 0, 0, 0])# xmin, ymin, xmax, ymax
-
-        bb[0] = torch.clip(torch.min(ij[:,1]) - shape[1]*pad, 0, shape[1])
-        bb[1] = torch.clip(torch.min(ij[:,0]) - shape[0]*pad, 0, shape[0])
-        bb[2] = torch.clip(torch.max(ij[:,1]) + shape[1]*pad, 0, shape[1])
-        bb[3] = torch.clip(torch.max(ij[:,0]) + shape[0]*pad, 0, shape[0])
-        
-        return bb
-    
-    def extract_patches(self, img, bb, N=5):
-        # Calculate the dimensions of the region of interest
-        xmin, ymin, xmax, ymax = bb
-
-        width = xmax - xmin
-        height = ymax - ymin
-
-        # Calculate the dimensions of each patch
-        patch_width = torch.div(width, N, rounding_mode='floor')
-        patch_height = torch.div(height, N, rounding_mode='floor')
-        patches = []
-
-        # Slide a window over the region of interest and extract patches
-        for j in range(ymin, ymax-patch_height+1, patch_height):
-            for i in range(xmin, xmax-patch_width+1, patch_width): 
-                patch = img[:, j:j+patch_height, i:i+patch_width]
-                patches.append(patch)
-
-        return self.resize(torch.stack(patches))
-
     def forward(self, X):
         
-        x_bb = torch.stack([self.compute_bb(seg, pad=self.hparams.pad) for seg in X["seg"]])
-        X_patches = torch.stack([self.extract_patches(img, bb, N=self.hparams.num_patches) for img, bb in zip(X["img"], x_bb)])
+        x_bb = compute_bb(X["seg"], label=3, pad=self.hparams.pad)
+        X_patches = extract_patches(X["img"], x_bb, self.hparams.num_patches, self.hparams.num_patches, self.hparams.patch_size)
 
         x_f = self.F(X_patches)
         x_v = self.V(x_f)
@@ -1344,11 +1391,11 @@ class EffnetYOLT(pl.LightningModule):
         if hasattr(self.hparams, "class_weights"):
             class_weights = torch.tensor(self.hparams.class_weights).to(torch.float32)
             
-        self.loss = nn.CrossEntropyLoss(weight=class_weights)
+        self.loss = float32_loss(nn.CrossEntropyLoss(weight=class_weights))
         self.accuracy = torchmetrics.Accuracy()
 
         self.model = nn.Sequential(
-            models.efficientnet_v2_s(weights=models.EfficientNet_V2_S_Weights.IMAGENET1K_V1).features,
+            models.efficientnet_v2_s(weights=pretrained(models.EfficientNet_V2_S_Weights.IMAGENET1K_V1)).features,
             nn.AdaptiveAvgPool2d(1),
             nn.Flatten(start_dim=1)
             )
@@ -1362,8 +1409,6 @@ class EffnetYOLT(pl.LightningModule):
         
         self.softmax = nn.Softmax(dim=1)
 
-        self.resize = transforms.Resize(self.hparams.patch_size)
-
         self.train_transform = transforms.Compose(
             [
                 RandomRotate(degrees=90, keys=["img", "seg"], interpolation=[transforms.functional.InterpolationMode.NEAREST, transforms.functional.InterpolationMode.NEAREST], prob=0.5), 
@@ -1375,45 +1420,10 @@ class EffnetYOLT(pl.LightningModule):
         optimizer = torch.optim.AdamW(self.parameters(), lr=self.hparams.lr)
         return optimizer
     
-    def compute_bb(self, seg, label=3, pad=0):
-    
-        shape = seg.shape[1:]
-        
-        ij = torch.argwhere(seg.squeeze() == label)
-
-        bb = torch.tensor([0, 0, 0, 0])# xmin, ymin, xmax, ymax
-
-        bb[0] = torch.clip(torch.min(ij[:,1]) - shape[1]*pad, 0, shape[1])
-        bb[1] = torch.clip(torch.min(ij[:,0]) - shape[0]*pad, 0, shape[0])
-        bb[2] = torch.clip(torch.max(ij[:,1]) + shape[1]*pad, 0, shape[1])
-        bb[3] = torch.clip(torch.max(ij[:,0]) + shape[0]*pad, 0, shape[0])
-        
-        return bb
-    
-    def extract_patches(self, img, bb, N=5):
-        # Calculate the dimensions of the region of interest
-        xmin, ymin, xmax, ymax = bb
-
-        width = xmax - xmin
-        height = ymax - ymin
-
-        # Calculate the dimensions of each patch
-        patch_width = torch.div(width, N, rounding_mode='floor')
-        patch_height = torch.div(height, N, rounding_mode='floor')
-        patches = []
-
-        # Slide a window over the region of interest and extract patches
-        for j in range(ymin, ymax-patch_height+1, patch_height):
-            for i in range(xmin, xmax-patch_width+1, patch_width): 
-                patch = img[:, j:j+patch_height, i:i+patch_width]
-                patches.append(patch)
-
-        return self.resize(torch.stack(patches))
-
     def forward(self, X):
         
-        x_bb = torch.stack([self.compute_bb(seg, pad=self.hparams.pad) for seg in X["seg"]])
-        X_patches = torch.stack([self.extract_patches(img, bb, N=self.hparams.num_patches) for img, bb in zip(X["img"], x_bb)])
+        x_bb = compute_bb(X["seg"], label=3, pad=self.hparams.pad)
+        X_patches = extract_patches(X["img"], x_bb, self.hparams.num_patches, self.hparams.num_patches, self.hparams.patch_size)
 
         x_f = self.F(X_patches)
         x_v = self.V(x_f)
@@ -1472,10 +1482,10 @@ class ResnetYOLT(pl.LightningModule):
         if hasattr(self.hparams, "class_weights"):
             class_weights = torch.tensor(self.hparams.class_weights).to(torch.float32)
             
-        self.loss = nn.CrossEntropyLoss(weight=class_weights)
+        self.loss = float32_loss(nn.CrossEntropyLoss(weight=class_weights))
         self.accuracy = torchmetrics.Accuracy(task='multiclass', num_classes=self.hparams.out_features)
 
-        self.model = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V2)
+        self.model = models.resnet50(weights=pretrained(models.ResNet50_Weights.IMAGENET1K_V2))
         self.model.fc = nn.Identity()
         self.F = TimeDistributed(self.model)
         
@@ -1487,8 +1497,6 @@ class ResnetYOLT(pl.LightningModule):
         
         self.softmax = nn.Softmax(dim=1)
 
-        self.resize = transforms.Resize(self.hparams.patch_size)
-
         self.train_transform = transforms.Compose(
             [
                 RandomRotate(degrees=90, keys=["img", "seg"], interpolation=[transforms.functional.InterpolationMode.NEAREST, transforms.functional.InterpolationMode.NEAREST], prob=0.5), 
@@ -1500,45 +1508,10 @@ class ResnetYOLT(pl.LightningModule):
         optimizer = torch.optim.AdamW(self.parameters(), lr=self.hparams.lr)
         return optimizer
     
-    def compute_bb(self, seg, label=3, pad=0):
-    
-        shape = seg.shape[1:]
-        
-        ij = torch.argwhere(seg.squeeze() == label)
-
-        bb = torch.tensor([0, 0, 0, 0])# xmin, ymin, xmax, ymax
-
-        bb[0] = torch.clip(torch.min(ij[:,1]) - shape[1]*pad, 0, shape[1])
-        bb[1] = torch.clip(torch.min(ij[:,0]) - shape[0]*pad, 0, shape[0])
-        bb[2] = torch.clip(torch.max(ij[:,1]) + shape[1]*pad, 0, shape[1])
-        bb[3] = torch.clip(torch.max(ij[:,0]) + shape[0]*pad, 0, shape[0])
-        
-        return bb
-    
-    def extract_patches(self, img, bb, N=5):
-        # Calculate the dimensions of the region of interest
-        xmin, ymin, xmax, ymax = bb
-
-        width = xmax - xmin
-        height = ymax - ymin
-
-        # Calculate the dimensions of each patch
-        patch_width = torch.div(width, N, rounding_mode='floor')
-        patch_height = torch.div(height, N, rounding_mode='floor')
-        patches = []
-
-        # Slide a window over the region of interest and extract patches
-        for j in range(ymin, ymax-patch_height+1, patch_height):
-            for i in range(xmin, xmax-patch_width+1, patch_width): 
-                patch = img[:, j:j+patch_height, i:i+patch_width]
-                patches.append(patch)
-
-        return self.resize(torch.stack(patches))
-
     def forward(self, X):
         
-        x_bb = torch.stack([self.compute_bb(seg, pad=self.hparams.pad) for seg in X["seg"]])
-        X_patches = torch.stack([self.extract_patches(img, bb, N=self.hparams.num_patches) for img, bb in zip(X["img"], x_bb)])
+        x_bb = compute_bb(X["seg"], label=3, pad=self.hparams.pad)
+        X_patches = extract_patches(X["img"], x_bb, self.hparams.num_patches, self.hparams.num_patches, self.hparams.patch_size)
 
         x_f = self.F(X_patches)
         x_v = self.V(x_f)
@@ -1597,10 +1570,10 @@ class ResnetSigDotYOLT(pl.LightningModule):
         if hasattr(self.hparams, "class_weights"):
             class_weights = torch.tensor(self.hparams.class_weights).to(torch.float32)
             
-        self.loss = nn.CrossEntropyLoss(weight=class_weights)
+        self.loss = float32_loss(nn.CrossEntropyLoss(weight=class_weights))
         self.accuracy = torchmetrics.Accuracy(task='multiclass', num_classes=self.hparams.out_features)
 
-        self.model = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V2)
+        self.model = models.resnet50(weights=pretrained(models.ResNet50_Weights.IMAGENET1K_V2))
         self.model.fc = nn.Identity()
         self.F = TimeDistributed(self.model)
         
@@ -1610,8 +1583,6 @@ class ResnetSigDotYOLT(pl.LightningModule):
         
         self.softmax = nn.Softmax(dim=1)
 
-        self.resize = transforms.Resize(self.hparams.patch_size)
-
         self.train_transform = transforms.Compose(
             [
                 RandomRotate(degrees=90, keys=["img", "seg"], interpolation=[transforms.functional.InterpolationMode.NEAREST, transforms.functional.InterpolationMode.NEAREST], prob=0.5), 
@@ -1625,45 +1596,10 @@ class ResnetSigDotYOLT(pl.LightningModule):
         optimizer = torch.optim.AdamW(self.parameters(), lr=self.hparams.lr)
         return optimizer
     
-    def compute_bb(self, seg, label=3, pad=0):
-    
-        shape = seg.shape[1:]
-        
-        ij = torch.argwhere(seg.squeeze() == label)
-
-        bb = torch.tensor([0, 0, 0, 0])# xmin, ymin, xmax, ymax
-
-        bb[0] = torch.clip(torch.min(ij[:,1]) - shape[1]*pad, 0, shape[1])
-        bb[1] = torch.clip(torch.min(ij[:,0]) - shape[0]*pad, 0, shape[0])
-        bb[2] = torch.clip(torch.max(ij[:,1]) + shape[1]*pad, 0, shape[1])
-        bb[3] = torch.clip(torch.max(ij[:,0]) + shape[0]*pad, 0, shape[0])
-        
-        return bb
-    
-    def extract_patches(self, img, bb, N=5):
-        # Calculate the dimensions of the region of interest
-        xmin, ymin, xmax, ymax = bb
-
-        width = xmax - xmin
-        height = ymax - ymin
-
-        # Calculate the dimensions of each patch
-        patch_width = torch.div(width, N, rounding_mode='floor')
-        patch_height = torch.div(height, N, rounding_mode='floor')
-        patches = []
-
-        # Slide a window over the region of interest and extract patches
-        for j in range(ymin, ymax-patch_height+1, patch_height):
-            for i in range(xmin, xmax-patch_width+1, patch_width): 
-                patch = img[:, j:j+patch_height, i:i+patch_width]
-                patches.append(patch)
-
-        return self.resize(torch.stack(patches))
-
     def forward(self, X):
         
-        x_bb = torch.stack([self.compute_bb(seg, pad=self.hparams.pad) for seg in X["seg"]])
-        X_patches = torch.stack([self.extract_patches(img, bb, N=self.hparams.num_patches) for img, bb in zip(X["img"], x_bb)])
+        x_bb = compute_bb(X["seg"], label=3, pad=self.hparams.pad)
+        X_patches = extract_patches(X["img"], x_bb, self.hparams.num_patches, self.hparams.num_patches, self.hparams.patch_size)
 
         x_f = self.F(self.normalize(X_patches))
         x_v = self.V(x_f)
@@ -1722,11 +1658,11 @@ class SEResNext101YOLT(pl.LightningModule):
         if hasattr(self.hparams, "class_weights"):
             class_weights = torch.tensor(self.hparams.class_weights).to(torch.float32)
             
-        self.loss = nn.CrossEntropyLoss(weight=class_weights)
+        self.loss = float32_loss(nn.CrossEntropyLoss(weight=class_weights))
         self.accuracy = torchmetrics.Accuracy(task='multiclass', num_classes=self.hparams.out_features)
 
 
-        feat = monai.networks.nets.SEResNext101(spatial_dims=2, in_channels=3, pretrained=True)
+        feat = monai.networks.nets.SEResNext101(spatial_dims=2, in_channels=3, pretrained=bool(pretrained(True)))
 
         model_feat = nn.Sequential(
             feat.layer0,
@@ -1748,8 +1684,6 @@ class SEResNext101YOLT(pl.LightningModule):
         
         self.softmax = nn.Softmax(dim=1)
 
-        self.resize = transforms.Resize(self.hparams.patch_size)
-
         self.train_transform = transforms.Compose(
             [
                 RandomRotate(degrees=90, keys=["img", "seg"], interpolation=[transforms.functional.InterpolationMode.NEAREST, transforms.functional.InterpolationMode.NEAREST], prob=0.5), 
@@ -1762,45 +1696,10 @@ class SEResNext101YOLT(pl.LightningModule):
         optimizer = torch.optim.AdamW(self.parameters(), lr=self.hparams.lr)
         return optimizer
     
-    def compute_bb(self, seg, label=3, pad=0):
-    
-        shape = seg.shape[1:]
-        
-        ij = torch.argwhere(seg.squeeze() == label)
-
-        bb = torch.tensor([0, 0, 0, 0])# xmin, ymin, xmax, ymax
-
-        bb[0] = torch.clip(torch.min(ij[:,1]) - shape[1]*pad, 0, shape[1])
-        bb[1] = torch.clip(torch.min(ij[:,0]) - shape[0]*pad, 0, shape[0])
-        bb[2] = torch.clip(torch.max(ij[:,1]) + shape[1]*pad, 0, shape[1])
-        bb[3] = torch.clip(torch.max(ij[:,0]) + shape[0]*pad, 0, shape[0])
-        
-        return bb
-    
-    def extract_patches(self, img, bb, N=3):
-        # Calculate the dimensions of the region of interest
-        xmin, ymin, xmax, ymax = bb
-
-        width = xmax - xmin
-        height = ymax - ymin
-
-        # Calculate the dimensions of each patch
-        patch_width = torch.div(width, N, rounding_mode='floor')
-        patch_height = torch.div(height, N, rounding_mode='floor')
-        patches = []
-
-        # Slide a window over the region of interest and extract patches
-        for j in range(ymin, ymax-patch_height+1, patch_height):
-            for i in range(xmin, xmax-patch_width+1, patch_width): 
-                patch = img[:, j:j+patch_height, i:i+patch_width]
-                patches.append(patch)
-
-        return self.resize(torch.stack(patches))
-
     def forward(self, X):
         
-        x_bb = torch.stack([self.compute_bb(seg, pad=self.hparams.pad) for seg in X["seg"]])
-        X_patches = torch.stack([self.extract_patches(img, bb, N=self.hparams.num_patches) for img, bb in zip(X["img"], x_bb)])
+        x_bb = compute_bb(X["seg"], label=3, pad=self.hparams.pad)
+        X_patches = extract_patches(X["img"], x_bb, self.hparams.num_patches, self.hparams.num_patches, self.hparams.patch_size)
 
         x_f = self.F(X_patches)
         x_v = self.V(x_f)
@@ -1859,11 +1758,11 @@ class SEResNext101YOLTv2(pl.LightningModule):
         if hasattr(self.hparams, "class_weights"):
             class_weights = torch.tensor(self.hparams.class_weights).to(torch.float32)
             
-        self.loss = nn.CrossEntropyLoss(weight=class_weights)
+        self.loss = float32_loss(nn.CrossEntropyLoss(weight=class_weights))
         self.accuracy = torchmetrics.Accuracy(task='multiclass', num_classes=self.hparams.out_features)
 
 
-        feat = monai.networks.nets.SEResNext101(spatial_dims=2, in_channels=3, pretrained=True)
+        feat = monai.networks.nets.SEResNext101(spatial_dims=2, in_channels=3, pretrained=bool(pretrained(True)))
 
         model_feat = nn.Sequential(
             feat.layer0,
@@ -1885,8 +1784,6 @@ class SEResNext101YOLTv2(pl.LightningModule):
         
         self.softmax = nn.Softmax(dim=1)
 
-        self.resize = transforms.Resize(self.hparams.patch_size)
-
         self.train_transform = transforms.Compose(
             [
                 RandomRotate(degrees=90, keys=["img", "seg"], interpolation=[transforms.functional.InterpolationMode.NEAREST, transforms.functional.InterpolationMode.NEAREST], prob=0.5), 
@@ -1899,45 +1796,10 @@ class SEResNext101YOLTv2(pl.LightningModule):
         optimizer = torch.optim.AdamW(self.parameters(), lr=self.hparams.lr)
         return optimizer
     
-    def compute_bb(self, seg, label=3, pad=0):
-    
-        shape = seg.shape[1:]
-        
-        ij = torch.argwhere(seg.squeeze() == label)
-
-        bb = torch.tensor([0, 0, 0, 0])# xmin, ymin, xmax, ymax
-
-        bb[0] = torch.clip(torch.min(ij[:,1]) - shape[1]*pad, 0, shape[1])
-        bb[1] = torch.clip(torch.min(ij[:,0]) - shape[0]*pad, 0, shape[0])
-        bb[2] = torch.clip(torch.max(ij[:,1]) + shape[1]*pad, 0, shape[1])
-        bb[3] = torch.clip(torch.max(ij[:,0]) + shape[0]*pad, 0, shape[0])
-        
-        return bb
-    
-    def extract_patches(self, img, bb, N=3):
-        # Calculate the dimensions of the region of interest
-        xmin, ymin, xmax, ymax = bb
-
-        width = xmax - xmin
-        height = ymax - ymin
-
-        # Calculate the dimensions of each patch
-        patch_width = torch.div(width, N, rounding_mode='floor')
-        patch_height = torch.div(height, N, rounding_mode='floor')
-        patches = []
-
-        # Slide a window over the region of interest and extract patches
-        for j in range(ymin, ymax-patch_height+1, patch_height):
-            for i in range(xmin, xmax-patch_width+1, patch_width): 
-                patch = img[:, j:j+patch_height, i:i+patch_width]
-                patches.append(patch)
-
-        return self.resize(torch.stack(patches))
-
     def forward(self, X):
         
-        x_bb = torch.stack([self.compute_bb(seg, pad=self.hparams.pad) for seg in X["seg"]])
-        X_patches = torch.stack([self.extract_patches(img, bb, N=self.hparams.num_patches) for img, bb in zip(X["img"], x_bb)])
+        x_bb = compute_bb(X["seg"], label=3, pad=self.hparams.pad)
+        X_patches = extract_patches(X["img"], x_bb, self.hparams.num_patches, self.hparams.num_patches, self.hparams.patch_size)
 
         x = self.F(X_patches)
         x = self.V(x)
@@ -1995,12 +1857,12 @@ class EfficientNetV2SYOLTv2(pl.LightningModule):
         if hasattr(self.hparams, "class_weights"):
             class_weights = torch.tensor(self.hparams.class_weights).to(torch.float32)
             
-        self.loss = nn.CrossEntropyLoss(weight=class_weights)
+        self.loss = float32_loss(nn.CrossEntropyLoss(weight=class_weights))
         self.accuracy = torchmetrics.Accuracy(task='multiclass', num_classes=self.hparams.out_features)
 
 
         model_feat = nn.Sequential(
-            models.efficientnet_v2_s(pretrained=True).features,
+            models.efficientnet_v2_s(weights=pretrained(models.EfficientNet_V2_S_Weights.IMAGENET1K_V1)).features,
             ops.Conv2dNormActivation(1280, 1536),
             nn.AdaptiveAvgPool2d(1),
             nn.Flatten(start_dim=1)
@@ -2019,8 +1881,12 @@ class EfficientNetV2SYOLTv2(pl.LightningModule):
         
         self.P = nn.Linear(in_features=1024, out_features=self.hparams.out_features)        
 
-        self.resize = transforms.Resize(self.hparams.patch_size)
-        self.resize_img = transforms.Resize(1536)
+        # LRU of the resize sample positions, one entry per output size and device
+        self.base_grids = OrderedDict()
+        self.max_base_grids = 16
+
+        # Submodules and methods compiled by utils.compile_regions, they have no graph breaks
+        self.compiled_regions = ["head"]
 
         self.train_transform = transforms.Compose(
             [
@@ -2034,52 +1900,67 @@ class EfficientNetV2SYOLTv2(pl.LightningModule):
         optimizer = torch.optim.AdamW(self.parameters(), lr=self.hparams.lr)
         return optimizer
     
-    def compute_bb(self, seg, pad=0):
-    
-        shape = seg.shape[1:]
-        
-        ij = torch.argwhere(seg.squeeze() != 0)
+    def get_base_grid(self, size, device):
+        # Bilinear resize (align_corners=False) sample positions normalized by the output size, cached by (size, device)
+        key = (size, device)
+        if key in self.base_grids:
+            self.base_grids.move_to_end(key)
+        else:
+            self.base_grids[key] = [(torch.arange(s, dtype=torch.float64, device=device) + 0.5)/s for s in size]
+            while len(self.base_grids) > self.max_base_grids:
+                self.base_grids.popitem(last=False)
+        return self.base_grids[key]
 
-        bb = torch.tensor([0, 0, 0, 0])# xmin, ymin, xmax, ymax
+    def compute_pad_size(self, bb):
+        # Size of the padded crop and number of patch rows for every sample
+        H = bb[:, 3] - bb[:, 1]
+        W = bb[:, 2] - bb[:, 0]
 
-        bb[0] = torch.clip(torch.min(ij[:,1]) - shape[1]*pad, 0, shape[1])
-        bb[1] = torch.clip(torch.min(ij[:,0]) - shape[0]*pad, 0, shape[0])
-        bb[2] = torch.clip(torch.max(ij[:,1]) + shape[1]*pad, 0, shape[1])
-        bb[3] = torch.clip(torch.max(ij[:,0]) + shape[0]*pad, 0, shape[0])
-        
-        return bb
-    
-    def extract_patches(self, img, N=3):
-        # Calculate the dimensions of the region of interest
-        # xmin, ymin, xmax, ymax = 0,0, img.shape[2], img.shape[2]
-        xmin, ymin, xmax, ymax = 0,0, img.shape[2], img.shape[1]
+        if self.hparams.square_pad:
+            new_size = torch.maximum(H, W)
+            return new_size, new_size, torch.full_like(H, self.hparams.num_patches)
 
-        width = xmax - xmin
-        height = ymax - ymin
+        patch_size = torch.div(W, self.hparams.num_patches, rounding_mode='floor')
+        n_patch_height = torch.div(H, patch_size, rounding_mode='floor') + 1
 
-        # Calculate the dimensions of each patch
-        patch_width = torch.div(width, self.n_patch_width, rounding_mode='floor')
-        patch_height = torch.div(height, self.n_patch_height, rounding_mode='floor')
-        patches = []
+        return n_patch_height*patch_size, torch.full_like(W, self.hparams.num_patches)*patch_size, n_patch_height
 
-        # Slide a window over the region of interest and extract patches
-        for j in range(ymin, ymax-patch_height+1, patch_height):
-            for i in range(xmin, xmax-patch_width+1, patch_width): 
-                patch = img[:, j:j+patch_height, i:i+patch_width]
-                patches.append(patch)
+    def compute_resize_img_size(self, n_patch_height):
+        # Same output size as transforms.Resize(1536), the shorter side of the padded crop goes to 1536
+        n_patch_width = self.hparams.num_patches
+        if n_patch_height == n_patch_width:
+            return (1536, 1536)
+        if n_patch_height < n_patch_width:
+            return (1536, int(1536*n_patch_width/n_patch_height))
+        return (int(1536*n_patch_height/n_patch_width), 1536)
 
-        return self.resize(torch.stack(patches)) ## here we're streching the patches
+    def compute_pad(self, img, bb, new_height, new_width, size):
+        # Crop the bounding boxes, center pad them to (new_height, new_width) and resize to size in one grid_sample.
+        # The image is zeroed outside the bounding box so the bilinear samples see the same zero border as the padded crop.
+        B, _, H, W = img.shape
 
-    def forward(self, X):
+        rows, cols = self.get_base_grid(size, img.device)
 
-        x_bb = torch.stack([self.compute_bb(seg, pad=self.hparams.pad) for seg in X["seg"]])
-        if self.hparams.square_pad:
-            X_padded = torch.stack([self.compute_square_pad(img, bb) for img, bb in zip(X["img"], x_bb)])
-        else:
-            X_padded = [self.compute_height_based_pad(img, bb) for img, bb in zip(X["img"], x_bb)] ## removed the stack because different images size
+        # Source position in the padded crop (resize), clamped to the padded crop like F.interpolate does
+        y = torch.minimum(torch.clamp(rows[None, :]*new_height[:, None] - 0.5, min=0), (new_height - 1)[:, None])
+        x = torch.minimum(torch.clamp(cols[None, :]*new_width[:, None] - 0.5, min=0), (new_width - 1)[:, None])
+
+        # Padded crop to image
+        y = y - torch.div(new_height - (bb[:, 3] - bb[:, 1]), 2, rounding_mode='floor')[:, None] + bb[:, 1:2]
+        x = x - torch.div(new_width - (bb[:, 2] - bb[:, 0]), 2, rounding_mode='floor')[:, None] + bb[:, 0:1]
+
+        grid = torch.stack([
+            (2*x/(W - 1) - 1)[:, None, :].expand(B, size[0], size[1]),
+            (2*y/(H - 1) - 1)[:, :, None].expand(B, size[0], size[1])
+            ], dim=-1).to(img.dtype)
+
+        i = torch.arange(H, device=img.device)
+        j = torch.arange(W, device=img.device)
+        mask = ((i[None, :] >= bb[:, 1:2]) & (i[None, :] < bb[:, 3:4]))[:, None, :, None] & ((j[None, :] >= bb[:, 0:1]) & (j[None, :] < bb[:, 2:3]))[:, None, None, :]
 
-        X_patches = [self.extract_patches(img_padded, N=self.hparams.num_patches) for img_padded in X_padded]
-        X_patches = torch.stack(X_patches)
+        return F.grid_sample(img*mask, grid, mode='bilinear', padding_mode='zeros', align_corners=True)
+
+    def head(self, X_patches):
 
         x_f = self.F(X_patches)
         x_v = self.V(x_f)
@@ -2104,7 +1985,51 @@ class EfficientNetV2SYOLTv2(pl.LightningModule):
         # x_a = self.A(x_v)
 
         x = self.P(x_a)
-        return x, X_patches, x_a, x_v,
+        return x, x_a, x_v
+
+    def forward(self, X):
+
+        x_bb = compute_bb(X["seg"], pad=self.hparams.pad)
+        new_height, new_width, n_patch_height = self.compute_pad_size(x_bb)
+
+        # The height based padding gives a different number of patch rows per image, the batch is split in buckets with the same number of rows
+        if self.hparams.square_pad:
+            buckets = {self.hparams.num_patches: list(range(len(x_bb)))}
+        else:
+            buckets = {}
+            for idx, n in enumerate(n_patch_height.tolist()):
+                buckets.setdefault(n, []).append(idx)
+
+        outputs = []
+        for n, idx in buckets.items():
+            size = self.compute_resize_img_size(n)
+
+            if len(buckets) == 1:
+                img, bb, h, w = X["img"], x_bb, new_height, new_width
+            else:
+                idx_t = torch.tensor(idx, device=x_bb.device)
+                img, bb, h, w = X["img"][idx_t], x_bb[idx_t], new_height[idx_t], new_width[idx_t]
+
+            X_padded = self.compute_pad(img, bb, h, w, size)
+
+            bb_padded = torch.tensor([0, 0, size[1], size[0]], device=X_padded.device).expand(len(idx), 4)
+            X_patches = extract_patches(X_padded, bb_padded, n, self.hparams.num_patches, self.hparams.patch_size)
+
+            outputs.append((idx, X_patches) + self.head(X_patches))
+
+        if len(outputs) == 1:
+            _, X_patches, x, x_a, x_v = outputs[0]
+            return x, X_patches, x_a, x_v,
+
+        # Back to the batch order, the patches and values are lists since the number of patches changes between buckets
+        inverse = torch.argsort(torch.tensor([i for o in outputs for i in o[0]], device=x_bb.device))
+        x = torch.cat([o[2] for o in outputs])[inverse]
+        x_a = torch.cat([o[3] for o in outputs])[inverse]
+        X_patches = [p for o in outputs for p in o[1]]
+        x_v = [v for o in outputs for v in o[4]]
+        inverse = inverse.tolist()
+
+        return x, [X_patches[i] for i in inverse], x_a, [x_v[i] for i in inverse],
 
     def training_step(self, train_batch, batch_idx):
 
@@ -2114,7 +2039,7 @@ class EfficientNetV2SYOLTv2(pl.LightningModule):
         x, X_patches, x_a, x_v, = self(batch)
         yhot = nn.functional.one_hot(batch['class'], num_classes=2).float() # not use if mixup
         
-        loss = self.loss(x.float(), batch['class'])
+        loss = self.loss(x, batch['class'])
         
         self.log('train_loss', loss, sync_dist=True)
 
@@ -2131,7 +2056,7 @@ class EfficientNetV2SYOLTv2(pl.LightningModule):
         yhot = nn.functional.one_hot(Y, num_classes=2).float()
         
         # pred = torch.argmax(x,dim=1)
-        loss = self.loss(x.float(), yhot)
+        loss = self.loss(x, yhot)
         
         self.log('val_loss', loss, sync_dist=True)
 
@@ -2149,61 +2074,3 @@ class EfficientNetV2SYOLTv2(pl.LightningModule):
 
         self.accuracy(x, Y)
         self.log("test_acc", self.accuracy, sync_dist=True)
-
-
-    def compute_square_pad(self, img, bb):
-
-        img_cropped = img[:, bb[1]:bb[3], bb[0]:bb[2]].unsqueeze(0)
-        
-        self.n_patch_width = self.hparams.num_patches
-        self.n_patch_height = self.hparams.num_patches
-
-        H, W = img_cropped.shape[2], img_cropped.shape[3]
-        new_size = max(H,W)
-
-        x = torch.linspace(0, new_size - 1, new_size)
-        y = torch.linspace(0, new_size - 1, new_size)
-        grid_x, grid_y = torch.meshgrid(x, y, indexing='ij')
-
-        y_start = (new_size - W) // 2
-        x_start = (new_size - H) // 2
-
-        grid_y = (grid_y - y_start) / (W - 1) * 2 - 1
-        grid_x = (grid_x - x_start) / (H - 1) * 2 - 1
-
-        grid = torch.stack((grid_y, grid_x), dim=-1).unsqueeze(0).cuda()
-
-        img_padded = F.grid_sample(img_cropped, grid, mode='bilinear', padding_mode='zeros', align_corners=True)
-
-        return self.resize_img(img_padded[0])
-
-    def compute_height_based_pad(self, img, bb):
-
-        img_cropped = img[:, bb[1]:bb[3], bb[0]:bb[2]].unsqueeze(0)
-
-        H, W = img_cropped.shape[2], img_cropped.shape[3]
-
-        self.n_patch_width = self.hparams.num_patches
-        patch_size = int(W/self.n_patch_width) 
-        self.n_patch_height = int(np.trunc(H/patch_size))+1
-
-        print(self.n_patch_height, self.n_patch_width)
-
-        new_height = self.n_patch_height * patch_size
-        new_width = self.n_patch_width * patch_size
-
-        x = torch.linspace(0, new_height - 1, new_height)
-        y = torch.linspace(0, new_width - 1, new_width)
-        grid_x, grid_y = torch.meshgrid(x, y, indexing='ij')
-
-        x_start = (new_height - H) // 2
-        y_start = (new_width - W) // 2
-
-        grid_y = (grid_y - y_start) / (W - 1) * 2 - 1
-        grid_x = (grid_x - x_start) / (H - 1) * 2 - 1
-
-
-        grid = torch.stack((grid_y, grid_x), dim=-1).unsqueeze(0).cuda()
-        img_padded = F.grid_sample(img_cropped, grid, mode='bilinear', padding_mode='zeros', align_corners=True)
-
-        return self.resize_img(img_padded[0])
\ No newline at end of file
@@ -20,6 +20,8 @@ from monai.transforms import (
 
 import lightning.pytorch as pl
 
+from utils import compute_bb, float32_loss, pretrained
+
 # from pl_bolts.transforms.dataset_normalizations import (
 #     imagenet_normalization
 # )
@@ -57,9 +59,9 @@ class TTUNet(pl.LightningModule):
         self.save_hyperparameters()
 
         if hasattr(self.hparams, "ce_weight"):
-            self.loss = monai.losses.DiceCELoss(include_background=False, to_onehot_y=True, softmax=True, ce_weight=torch.tensor(self.hparams.ce_weight), lambda_dice=1.0, lambda_ce=1.0)
+            self.loss = float32_loss(monai.losses.DiceCELoss(include_background=False, to_onehot_y=True, softmax=True, ce_weight=torch.tensor(self.hparams.ce_weight), lambda_dice=1.0, lambda_ce=1.0))
         else:
-            self.loss = monai.losses.DiceLoss(include_background=False, softmax=True, to_onehot_y=True)
+            self.loss = float32_loss(monai.losses.DiceLoss(include_background=False, softmax=True, to_onehot_y=True))
         
 
         self.accuracy = torchmetrics.Accuracy(task='multiclass', num_classes=self.hparams.out_channels)
@@ -68,6 +70,9 @@ class TTUNet(pl.LightningModule):
 
         self.metric = DiceMetric(include_background=True, reduction="mean")   
 
+        # Submodules compiled by utils.compile_regions, they have no graph breaks
+        self.compiled_regions = ["model"]
+
     def configure_optimizers(self):
         optimizer = torch.optim.Adam(self.parameters(), lr=self.hparams.lr)
         return optimizer
@@ -122,7 +127,7 @@ class TTRCNN(pl.LightningModule):
         
         self.save_hyperparameters()
         
-        self.model = models.detection.maskrcnn_resnet50_fpn(weights=models.detection.MaskRCNN_ResNet50_FPN_Weights.DEFAULT)
+        self.model = models.detection.maskrcnn_resnet50_fpn(weights=pretrained(models.detection.MaskRCNN_ResNet50_FPN_Weights.DEFAULT), weights_backbone=None)
 
         self.num_classes = num_classes
         in_features = self.model.roi_heads.box_predictor.cls_score.in_features
@@ -132,6 +137,9 @@ class TTRCNN(pl.LightningModule):
         hidden_layer = 256
         self.model.roi_heads.mask_predictor = models.detection.mask_rcnn.MaskRCNNPredictor(in_features_mask, hidden_layer, num_classes)
 
+        # Submodules compiled by utils.compile_regions, the detection heads have data dependent shapes and stay eager
+        self.compiled_regions = ["model.backbone"]
+
     def configure_optimizers(self):
         optimizer = torch.optim.Adam(self.parameters(), lr=self.hparams.lr)
         return optimizer
@@ -306,7 +314,7 @@ class MobileYOLO(pl.LightningModule):
         self.save_hyperparameters()
 
         self.model = nn.Sequential(
-            models.mobilenet_v2(weights=models.MobileNet_V2_Weights.IMAGENET1K_V1).features,            
+            models.mobilenet_v2(weights=pretrained(models.MobileNet_V2_Weights.IMAGENET1K_V1)).features,            
             nn.AdaptiveAvgPool2d(1),
             nn.Flatten(start_dim=1),
             ProjectionHead(input_dim=1280, hidden_dim=1280, output_dim=4)#h,w,i,j
@@ -329,29 +337,12 @@ class MobileYOLO(pl.LightningModule):
             ]
         )
 
-        self.loss_fn = torch.nn.SmoothL1Loss()
+        self.loss_fn = float32_loss(torch.nn.SmoothL1Loss())
 
     def configure_optimizers(self):
         optimizer = torch.optim.AdamW(self.parameters(), lr=self.hparams.lr)
         return optimizer
 
-    def compute_bb(self, seg, label=3, pad=0):
-    
-        shape = seg.shape[1:]
-        
-        ij = torch.argwhere(seg.squeeze() == label)
-
-        bb = torch.tensor([0, 0, 0, 0])# xmin, ymin, xmax, ymax
-
-        if len(ij) > 0:
-
-            bb[0] = torch.clip(torch.min(ij[:,1]) - shape[1]*pad, 0, shape[1])
-            bb[1] = torch.clip(torch.min(ij[:,0]) - shape[0]*pad, 0, shape[0])
-            bb[2] = torch.clip(torch.max(ij[:,1]) + shape[1]*pad, 0, shape[1])
-            bb[3] = torch.clip(torch.max(ij[:,0]) + shape[0]*pad, 0, shape[0])
-        
-        return bb
-    
     def forward(self, X):        
         return self.model(self.resize_bb(X).detach().clone())
 
@@ -359,7 +350,7 @@ class MobileYOLO(pl.LightningModule):
 
         train_batch = self.spatial_train_transform(train_batch)
         
-        Y_bb = torch.stack([self.compute_bb(seg, pad=self.hparams.pad) for seg in train_batch["seg"]]).to(self.device)
+        Y_bb = compute_bb(train_batch["seg"], label=3, pad=self.hparams.pad)
         
         x_bb = self(self.train_transform(train_batch["img"]))
 
@@ -371,7 +362,7 @@ class MobileYOLO(pl.LightningModule):
 
     def validation_step(self, val_batch, batch_idx):
 
-        Y_bb = torch.stack([self.compute_bb(seg, pad=self.hparams.pad) for seg in val_batch["seg"]]).to(self.device)
+        Y_bb = compute_bb(val_batch["seg"], label=3, pad=self.hparams.pad)
 
         x_bb = self(val_batch["img"])
 
@@ -381,7 +372,7 @@ class MobileYOLO(pl.LightningModule):
         
 
     def test_step(self, test_batch, batch_idx):
-        Y_bb = torch.stack([self.compute_bb(seg, pad=self.hparams.pad) for seg in test_batch["seg"]]).to(self.device)
+        Y_bb = compute_bb(test_batch["seg"], label=3, pad=self.hparams.pad)
 
         x_bb = self(test_batch["img"])
 
@@ -0,0 +1,71 @@
+import numpy as np
+import torch
+from torch import nn
+
+# ONNX Runtime inference backend for the graphs written by export_onnx.py.
+# OnnxModule is called like the torch module it replaces, the inputs are torch tensors and the outputs are returned
+# as torch tensors on the device of the first input. onnxruntime is only imported when a session is created.
+
+class OnnxModule:
+    def __init__(self, onnx_path, transform=None, threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+
+        self.session = ort.InferenceSession(onnx_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        # Torch preprocessing that is not part of the graph, e.g. the center crop of the stack classifiers
+        self.transform = transform
+
+    def __call__(self, *inputs):
+        device = inputs[0].device
+
+        if self.transform is not None:
+            inputs = (self.transform(inputs[0]),) + tuple(inputs[1:])
+
+        feed = {name: np.ascontiguousarray(x.detach().to(torch.float32).cpu().numpy()) for name, x in zip(self.input_names, inputs)}
+        outputs = [torch.from_numpy(o).to(device) for o in self.session.run(None, feed)]
+
+        if len(outputs) == 1:
+            return outputs[0]
+        return tuple(outputs)
+
+    def eval(self):
+        return self
+
+class StacksExport(nn.Module):
+    # Stack classifier without its test_transform, the crop depends on the input size and is applied in torch
+    def __init__(self, model):
+        super(StacksExport, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        x_f = self.model.F(x)
+        x_v = self.model.V(x_f)
+        x_a, x_s = self.model.A(x_f, x_v)
+        x = self.model.softmax(self.model.P(x_a))
+        x_v_p = self.model.P(x_v)
+        return x, x_a, x_s, x_v, x_v_p
+
+class HeadExport(nn.Module):
+    # Feature extractor, attention and prediction head of the YOLT models, the bounding box crop and patch extraction stay in torch
+    def __init__(self, model):
+        super(HeadExport, self).__init__()
+        self.model = model
+
+    def forward(self, X_patches):
+        return self.model.head(X_patches)
+
+def get_backend(model, args, transform=None):
+    # Returns the module to call for inference, the torch model itself or an ONNX Runtime session
+    if args.backend == "onnx":
+        return OnnxModule(args.onnx, transform=transform, threads=args.onnx_threads)
+    return model
+
+def get_device(args):
+    if args.backend == "torch" and torch.cuda.is_available():
+        return torch.device("cuda")
+    return torch.device("cpu")
@@ -0,0 +1,96 @@
+import argparse
+
+import os
+import pandas as pd
+import numpy as np
+
+import nrrd
+import torch
+
+from loaders.tt_dataset import TTDatasetStacks, TTDatasetStacksPacked, stack_to_float
+
+from tqdm import tqdm
+
+# Packs the nrrd stacks of a split into one contiguous, uncompressed uint8 file.
+# The output csv is the input csv plus the offset and shape of every stack in the packed file,
+# it is read by loaders.tt_dataset.TTDatasetStacksPacked. --check compares every packed sample with the TTDatasetStacks sample.
+
+def check(df, df_packed, args):
+    ds = TTDatasetStacks(df, mount_point=args.mount_point, img_column=args.img_column)
+    ds_packed = TTDatasetStacksPacked(df_packed)
+
+    max_diff = 0.0
+    for idx in tqdm(range(len(ds)), total=len(ds)):
+        img = ds[idx]
+        img_packed = stack_to_float(ds_packed[idx])
+        if img.shape != img_packed.shape:
+            print("Different shape:", df.iloc[idx][args.img_column], tuple(img.shape), tuple(img_packed.shape))
+            max_diff = float("inf")
+            continue
+        max_diff = max(max_diff, torch.max(torch.abs(img - img_packed)).item())
+
+    print("Stacks:", len(ds), "max abs diff:", max_diff)
+    return max_diff
+
+def main(args):
+
+    df = pd.read_csv(args.csv)
+
+    if args.out is None:
+        out = os.path.splitext(args.csv)[0] + "_packed"
+    else:
+        out = os.path.splitext(args.out)[0]
+
+    out_dir = os.path.dirname(out)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    pack_fn = out + ".u8"
+
+    offsets = []
+    shapes = []
+    offset = 0
+
+    with open(pack_fn, "wb") as f:
+        for idx, row in tqdm(df.iterrows(), total=len(df)):
+            img_path = os.path.join(args.mount_point, row[args.img_column])
+            img, head = nrrd.read(img_path, index_order="C")
+
+            if img.dtype != np.uint8:
+                img = np.clip(img, 0, 255).astype(np.uint8)
+
+            img = np.ascontiguousarray(img)
+            f.write(img.tobytes())
+
+            offsets.append(offset)
+            shapes.append(img.shape)
+            offset += img.nbytes
+
+    shapes = np.array(shapes)
+
+    df["pack"] = pack_fn
+    df["pack_offset"] = offsets
+    df["pack_frames"] = shapes[:, 0]
+    df["pack_height"] = shapes[:, 1]
+    df["pack_width"] = shapes[:, 2]
+    df["pack_channels"] = shapes[:, 3]
+
+    print("Writing:", out + ".csv", pack_fn)
+    df.to_csv(out + ".csv", index=False)
+
+    if args.check:
+        check(pd.read_csv(args.csv), df, args)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Pack the stacks of a split into a contiguous uint8 file')
+    parser.add_argument('--csv', help='CSV file with the stacks', type=str, required=True)
+    parser.add_argument('--img_column', help='Image column name', type=str, default="image")
+    parser.add_argument('--mount_point', help='Dataset mount directory', type=str, default="./")
+    parser.add_argument('--check', help='Compare the packed stacks with the stacks read by TTDatasetStacks', type=int, default=0)
+    parser.add_argument('--out', help='Output name for the packed file and csv index, defaults to <csv>_packed', type=str, default=None)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -1,5 +1,6 @@
 import SimpleITK as sitk
 import numpy as np
+import torch
 import argparse
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap
@@ -17,54 +18,61 @@ def main(args):
 	sitk.WriteImage(out_img, args.out)
 	
 
-def poly_fit(img_np, seg_np, label_num=3, size=256, num_samples=64, view=False):
-	
-	neigborhood = int(size/2)
+def poly_fit_coords(seg_np, label_num=3, size=256, num_samples=64):
+	# Fits the cubic and computes the origins of all the crops at once. The fit is done in the coordinates of the image
+	# padded by size/2, as the original loop did, and the origins are then shifted back to the unpadded image (they can be negative).
 
-	img_np = np.pad(img_np, ((neigborhood, neigborhood), (neigborhood, neigborhood), (0, 0)))
-	seg_np = np.pad(seg_np, ((neigborhood, neigborhood), (neigborhood, neigborhood)))
+	neigborhood = int(size/2)
 
-	y, x = np.where(seg_np == label_num)	
+	y, x = np.where(seg_np == label_num)
+	x = x + neigborhood
+	y = y + neigborhood
 
 	z = np.polyfit(x, y, 3)
 	poly = np.poly1d(z)
-	
 
-	# min_x = np.min(x) + neigborhood
-	# max_x = np.max(x) - neigborhood
-	# max_y = np.max(y) - neigborhood
 	min_x = np.min(x)
 	max_x = np.max(x)
 	max_y = np.max(y)
 
 	dx = (max_x - min_x)/num_samples
 
-	out_stack = []
+	x_values = min_x + np.arange(num_samples)*dx
+	y_values = poly(x_values)
+
+	start_x = np.maximum(np.minimum(np.maximum(np.trunc(x_values).astype(np.int64) - neigborhood, 0), max_x - neigborhood), 0)
+	start_y = np.maximum(np.minimum(np.maximum(np.trunc(y_values).astype(np.int64) - neigborhood, 0), max_y - neigborhood), 0)
 
-	x_values = []
-	y_values = []
-	for i in range(num_samples):
-		x = min_x + i*dx
-		y = poly(x)
+	return start_x - neigborhood, start_y - neigborhood, x_values - neigborhood, y_values - neigborhood
 
-		x_values.append(x)
-		y_values.append(y)
 
-		start_x = min(max(int(x) - neigborhood, 0), max_x  - neigborhood)
-		if start_x < 0:
-			start_x = 0
-		start_y = min(max(int(y) - neigborhood, 0), max_y  - neigborhood)
-		if(start_y < 0):
-			start_y = 0
+def extract_stack(img_np, start_x, start_y, size=256):
+	# Single gather of all the crops. Pixels outside the image are zero, same as cropping from the padded image.
 
-		end_x = start_x + size
-		end_y = start_y + size
+	rows = start_y[:, None] + np.arange(size)
+	cols = start_x[:, None] + np.arange(size)
 
-		crop_np = img_np[start_y:end_y,start_x:end_x,:]
+	rows_outside = (rows < 0) | (rows >= img_np.shape[0])
+	cols_outside = (cols < 0) | (cols >= img_np.shape[1])
 
-		out_stack.append(crop_np)
+	rows = np.clip(rows, 0, img_np.shape[0] - 1)
+	cols = np.clip(cols, 0, img_np.shape[1] - 1)
 
-	out_stack = np.array(out_stack)
+	out_stack = img_np[rows[:, :, None], cols[:, None, :]]
+
+	if np.any(rows_outside):
+		out_stack[rows_outside] = 0
+	if np.any(cols_outside):
+		out_stack[np.broadcast_to(cols_outside[:, None, :], out_stack.shape[:3])] = 0
+
+	return out_stack
+
+
+def poly_fit(img_np, seg_np, label_num=3, size=256, num_samples=64, view=False):
+
+	start_x, start_y, x_values, y_values = poly_fit_coords(seg_np, label_num, size, num_samples)
+
+	out_stack = extract_stack(img_np, start_x, start_y, size)
 
 	if view:
 
@@ -74,12 +82,56 @@ def poly_fit(img_np, seg_np, label_num=3, size=256, num_samples=64, view=False):
 		plt.imshow(seg_np, cmap=cmap, interpolation='nearest', alpha=0.4)
 
 		plt.plot(x_values, y_values, linewidth=2, color="red")
-		plt.plot(x, y)
 		plt.show()
 
 	return out_stack
 
 
+def poly_fit_torch(img_t, seg_t, label_num=3, size=256, num_samples=64):
+	# Same as poly_fit for tensors that are already on the device, img_t [H, W, C] and seg_t [H, W].
+	# The least squares fit runs in float64 with the column scaling used by np.polyfit.
+
+	neigborhood = int(size/2)
+
+	ij = torch.nonzero(seg_t == label_num)
+	y = ij[:, 0].to(torch.float64) + neigborhood
+	x = ij[:, 1].to(torch.float64) + neigborhood
+
+	A = torch.stack([x**3, x**2, x, torch.ones_like(x)], dim=1)
+	scale = torch.sqrt(torch.sum(A*A, dim=0))
+	z = torch.linalg.lstsq(A/scale, y.unsqueeze(1)).solution.squeeze(1)/scale
+
+	min_x = torch.min(x)
+	max_x = torch.max(x).to(torch.int64)
+	max_y = torch.max(y).to(torch.int64)
+
+	dx = (torch.max(x) - min_x)/num_samples
+
+	x_values = min_x + torch.arange(num_samples, dtype=torch.float64, device=x.device)*dx
+	y_values = ((z[0]*x_values + z[1])*x_values + z[2])*x_values + z[3]
+
+	start_x = torch.clamp(torch.minimum(torch.clamp(torch.trunc(x_values).to(torch.int64) - neigborhood, min=0), max_x - neigborhood), min=0) - neigborhood
+	start_y = torch.clamp(torch.minimum(torch.clamp(torch.trunc(y_values).to(torch.int64) - neigborhood, min=0), max_y - neigborhood), min=0) - neigborhood
+
+	offsets = torch.arange(size, device=img_t.device)
+	rows = start_y[:, None] + offsets
+	cols = start_x[:, None] + offsets
+
+	rows_inside = (rows >= 0) & (rows < img_t.shape[0])
+	cols_inside = (cols >= 0) & (cols < img_t.shape[1])
+
+	rows = torch.clamp(rows, 0, img_t.shape[0] - 1)
+	cols = torch.clamp(cols, 0, img_t.shape[1] - 1)
+
+	out_stack = img_t[rows[:, :, None], cols[:, None, :]]
+
+	outside = ~(rows_inside[:, :, None] & cols_inside[:, None, :])
+	if out_stack.dim() == 4:
+		outside = outside.unsqueeze(-1)
+
+	return out_stack.masked_fill_(outside, 0)
+
+
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='Predict an input with a trained neural network', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 	parser.add_argument('--img', type=str, help='Input rgb image', required=True)
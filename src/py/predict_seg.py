@@ -16,6 +16,7 @@ from monai.transforms import (
     Compose
 )
 from nets.segmentation import TTUNet,TTRCNN
+from slim_checkpoint import load_model
 from loaders.tt_dataset import InTransformsSeg, OutTransformsSeg
 
 import resample
@@ -94,9 +95,9 @@ def main(args):
     device = torch.device("cuda:0")
 
     if args.seg_nn == 'TTUNet':
-        model_seg = TTUNet.load_from_checkpoint(args.seg_model, strict=False)
+        model_seg = load_model(TTUNet, args.seg_model, strict=False)
     elif args.seg_nn == 'TTRCNN':
-        model_seg = TTRCNN.load_from_checkpoint(args.seg_model, strict=False)
+        model_seg = load_model(TTRCNN, args.seg_model, strict=False)
 
     model_seg.cuda()
     model_seg.eval()
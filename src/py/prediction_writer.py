@@ -0,0 +1,114 @@
+import os
+import glob
+
+import numpy as np
+import pandas as pd
+
+# Streams the predictions to disk while they are computed.
+# <out>_parts/part-*.parquet  row, pred, prob_* and the offset/number of rows of the per sample features
+# <out>_features.npy          fixed size features, memory mapped and indexed by the csv row
+# <out>_features_v.f32        per sample features with a variable number of rows, appended as raw float32
+# An interrupted run resumes from the flushed parts, the rows in the parts are skipped and anything written after the last flush is dropped
+
+class PredictionWriter:
+    def __init__(self, out_name, num_rows, flush_every=1024):
+        self.out_name = out_name
+        self.num_rows = num_rows
+        self.flush_every = flush_every
+
+        self.parts_dir = out_name + "_parts"
+        self.features_fn = out_name + "_features.npy"
+        self.features_v_fn = out_name + "_features_v.f32"
+
+        if not os.path.exists(self.parts_dir):
+            os.makedirs(self.parts_dir)
+
+        parts = self.get_parts()
+        self.num_parts = len(parts)
+        self.features_v_bytes = 0
+        if len(parts) > 0:
+            df = pd.concat([pd.read_parquet(p, columns=["features_v_offset", "features_v_count"]) for p in parts])
+            self.features_v_bytes = int(max(0, (df["features_v_offset"] + 4*df["features_v_count"]).max()))
+
+        # Drop what was appended after the last flush of an interrupted run
+        if os.path.exists(self.features_v_fn):
+            with open(self.features_v_fn, "r+b") as f:
+                f.truncate(self.features_v_bytes)
+
+        self.features_v_file = open(self.features_v_fn, "ab")
+        self.features = None
+        self.records = []
+
+    def get_parts(self):
+        return sorted(glob.glob(os.path.join(self.parts_dir, "part-*.parquet")))
+
+    def written_rows(self):
+        parts = self.get_parts()
+        if len(parts) == 0:
+            return np.array([], dtype=np.int64)
+        return pd.concat([pd.read_parquet(p, columns=["row"]) for p in parts])["row"].values
+
+    def get_features(self, shape):
+        if self.features is None:
+            if os.path.exists(self.features_fn):
+                self.features = np.lib.format.open_memmap(self.features_fn, mode="r+")
+            else:
+                self.features = np.lib.format.open_memmap(self.features_fn, mode="w+", dtype=np.float32, shape=(self.num_rows,) + tuple(shape))
+        return self.features
+
+    def write(self, rows, pred, probs, features=None, features_v=None):
+        # rows are the csv rows of the batch, the other arguments are numpy arrays or lists in the same order
+
+        if features is not None:
+            self.get_features(features.shape[1:])[rows] = features
+
+        offset = self.features_v_bytes + sum(r["features_v_count"]*4 for r in self.records)
+
+        for idx, row in enumerate(rows):
+            record = {"row": int(row), "pred": int(pred[idx]), "features_v_offset": -1, "features_v_count": 0}
+            for c, p in enumerate(probs[idx]):
+                record["prob_" + str(c)] = float(p)
+
+            if features_v is not None:
+                v = np.ascontiguousarray(features_v[idx], dtype=np.float32)
+                self.features_v_file.write(v.tobytes())
+                record["features_v_offset"] = offset
+                record["features_v_count"] = v.size
+                offset += v.nbytes
+
+            self.records.append(record)
+
+        if len(self.records) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if len(self.records) == 0:
+            return
+
+        if self.features is not None:
+            self.features.flush()
+        self.features_v_file.flush()
+        os.fsync(self.features_v_file.fileno())
+
+        part_fn = os.path.join(self.parts_dir, "part-{:05d}.parquet".format(self.num_parts))
+        pd.DataFrame(self.records).to_parquet(part_fn + ".tmp", index=False)
+        os.replace(part_fn + ".tmp", part_fn)
+
+        self.num_parts += 1
+        self.features_v_bytes += sum(r["features_v_count"]*4 for r in self.records)
+        self.records = []
+
+    def close(self):
+        self.flush()
+        self.features_v_file.close()
+        self.features = None
+
+    def read(self):
+        # All the flushed predictions sorted by row
+        df = pd.concat([pd.read_parquet(p) for p in self.get_parts()])
+        return df.drop_duplicates("row", keep="last").sort_values("row").reset_index(drop=True)
+
+def read_features_v(out_name, offset, count, dim):
+    # Features of one row written by PredictionWriter
+    v = np.memmap(out_name + "_features_v.f32", dtype=np.float32, mode="r", offset=int(offset), shape=(int(count),))
+    return np.array(v).reshape(-1, dim)
@@ -0,0 +1,181 @@
+import argparse
+
+import copy
+import os
+import time
+import pandas as pd
+import numpy as np
+
+import torch
+from torch.ao.quantization import QConfig, HistogramObserver, default_per_channel_weight_observer, get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from nets.classification import EfficientnetV2s
+from nets.segmentation import TTUNet
+from slim_checkpoint import load_model
+from loaders.tt_dataset import TTDataModule, TTDataModuleSeg, EvalTransforms, EvalTransformsSeg
+
+from sklearn.metrics import roc_auc_score
+
+from tqdm import tqdm
+
+# Post training static INT8 quantization (FX graph mode, per channel weights) of the patch classifier and TTUNet for CPU inference.
+# The observers are calibrated with batches of the eval split, then the float and quantized models are evaluated on
+# the test split (accuracy/AUC or Dice) and timed on the CPU in the same run.
+
+def read_csv(fn):
+    if os.path.splitext(fn)[1] == ".csv":
+        return pd.read_csv(fn)
+    return pd.read_parquet(fn)
+
+def get_data(args):
+    df_calib = read_csv(args.csv_calib)
+    df_test = read_csv(args.csv_test)
+
+    if args.nn == "TTUNet":
+        ttdata = TTDataModuleSeg(df_calib, df_calib, df_test, mount_point=args.mount_point, batch_size=args.batch_size, num_workers=args.num_workers, img_column=args.img_column, seg_column=args.seg_column, valid_transform=EvalTransformsSeg(), test_transform=EvalTransformsSeg())
+    else:
+        ttdata = TTDataModule(df_calib, df_calib, df_test, mount_point=args.mount_point, batch_size=args.batch_size, num_workers=args.num_workers, img_column=args.img_column, class_column=args.class_column, valid_transform=EvalTransforms(args.size))
+    ttdata.setup()
+
+    return ttdata.val_dataloader(), ttdata.test_dataloader()
+
+def get_model(args):
+    # Float module to quantize, it returns the logits
+    if args.nn == "TTUNet":
+        return load_model(TTUNet, args.model, strict=False).model.eval()
+    return load_model(EfficientnetV2s, args.model).model.eval()
+
+def get_input(batch):
+    if isinstance(batch, dict):
+        return batch["img"], batch["seg"]
+    return batch[0], batch[1]
+
+def get_qconfig_mapping(args):
+    # Histogram observer for the activations and per channel symmetric weights, the fbgemm/x86 kernels need the reduced range
+    qconfig = QConfig(activation=HistogramObserver.with_args(reduce_range=args.qbackend != "qnnpack"), weight=default_per_channel_weight_observer)
+    return get_default_qconfig_mapping(args.qbackend).set_global(qconfig)
+
+def quantize(model, calib_loader, args):
+    x, _ = get_input(next(iter(calib_loader)))
+
+    model_prepared = prepare_fx(copy.deepcopy(model), get_qconfig_mapping(args), (x,))
+
+    with torch.no_grad():
+        for idx, batch in tqdm(enumerate(calib_loader), total=min(len(calib_loader), args.calib_batches), desc="Calibration"):
+            if idx >= args.calib_batches:
+                break
+            x, _ = get_input(batch)
+            model_prepared(x)
+
+    return convert_fx(model_prepared)
+
+def evaluate(model, test_loader, args):
+    # Accuracy and AUC of the classifier or mean Dice of the foreground classes of the segmentation
+    probs, labels = [], []
+    intersection, total = 0, 0
+
+    with torch.no_grad():
+        for idx, batch in tqdm(enumerate(test_loader), total=len(test_loader) if args.test_batches < 0 else min(len(test_loader), args.test_batches), desc="Evaluation"):
+            if idx == args.test_batches:
+                break
+            x, y = get_input(batch)
+            out = model(x)
+
+            if args.nn == "TTUNet":
+                num_classes = out.shape[1]
+                pred = torch.argmax(out, dim=1).reshape(-1)
+                y = y.reshape(-1).to(torch.int64)
+                intersection = intersection + torch.bincount(y[pred == y], minlength=num_classes)
+                total = total + torch.bincount(pred, minlength=num_classes) + torch.bincount(y, minlength=num_classes)
+            else:
+                probs.append(torch.softmax(out, dim=1))
+                labels.append(y)
+
+    if args.nn == "TTUNet":
+        dice = (2.0*intersection/torch.clamp(total, min=1))[1:]
+        return {"dice": dice.mean().item()}
+
+    probs = torch.cat(probs).numpy()
+    labels = torch.cat(labels).numpy()
+
+    metrics = {"accuracy": float(np.mean(np.argmax(probs, axis=1) == labels))}
+    if len(np.unique(labels)) > 1:
+        if probs.shape[1] == 2:
+            metrics["auc"] = roc_auc_score(labels, probs[:, 1])
+        else:
+            metrics["auc"] = roc_auc_score(labels, probs, multi_class="ovr", labels=np.arange(probs.shape[1]))
+    return metrics
+
+def latency(model, x, args):
+    # Mean seconds per batch on the CPU
+    with torch.no_grad():
+        for _ in range(args.warmup):
+            model(x)
+        start = time.perf_counter()
+        for _ in range(args.iters):
+            model(x)
+    return (time.perf_counter() - start)/args.iters
+
+def main(args):
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    torch.backends.quantized.engine = args.qbackend
+
+    calib_loader, test_loader = get_data(args)
+
+    model = get_model(args)
+    model_q = quantize(model, calib_loader, args)
+
+    metrics = evaluate(model, test_loader, args)
+    metrics_q = evaluate(model_q, test_loader, args)
+
+    x, _ = get_input(next(iter(test_loader)))
+    t = latency(model, x, args)
+    t_q = latency(model_q, x, args)
+
+    print("{:<12}{:>12}{:>12}{:>12}".format("", "float32", "int8", "delta"))
+    for k in metrics:
+        print("{:<12}{:>12.4f}{:>12.4f}{:>12.4f}".format(k, metrics[k], metrics_q[k], metrics_q[k] - metrics[k]))
+    print("{:<12}{:>12.4f}{:>12.4f}{:>11.2f}x".format("latency (s)", t, t_q, t/t_q))
+
+    out = args.out
+    if out is None:
+        out = os.path.splitext(args.model)[0] + "_int8.pt"
+
+    print("Writing:", out)
+    torch.jit.save(torch.jit.trace(model_q, x), out)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Post training INT8 quantization of the patch classifier and TTUNet')
+
+    input_group = parser.add_argument_group('Input')
+    input_group.add_argument('--model', help='Model checkpoint', type=str, required=True)
+    input_group.add_argument('--nn', help='Type of neural network', type=str, default="EfficientnetV2s", choices=["EfficientnetV2s", "TTUNet"])
+    input_group.add_argument('--csv_calib', help='CSV with the calibration images, e.g., the eval split', type=str, required=True)
+    input_group.add_argument('--csv_test', help='CSV with the test images', type=str, required=True)
+    input_group.add_argument('--mount_point', help='Dataset mount directory', type=str, default="./")
+    input_group.add_argument('--img_column', help='Image column name', type=str, default="img_path")
+    input_group.add_argument('--seg_column', help='Segmentation column name', type=str, default="seg_path")
+    input_group.add_argument('--class_column', help='Class column name', type=str, default="class")
+    input_group.add_argument('--size', help='Center crop of the patches', type=int, default=448)
+    input_group.add_argument('--batch_size', help='Batch size', type=int, default=16)
+    input_group.add_argument('--num_workers', help='Number of workers for loading', type=int, default=4)
+
+    quant_group = parser.add_argument_group('Quantization')
+    quant_group.add_argument('--qbackend', help='Quantized kernels, x86/fbgemm for intel/amd and qnnpack for arm', type=str, default="x86", choices=["x86", "fbgemm", "qnnpack"])
+    quant_group.add_argument('--calib_batches', help='Number of calibration batches', type=int, default=32)
+    quant_group.add_argument('--test_batches', help='Number of test batches to evaluate, -1 for all', type=int, default=-1)
+    quant_group.add_argument('--threads', help='CPU threads, 0 keeps the torch default', type=int, default=0)
+    quant_group.add_argument('--warmup', help='Warm up iterations before timing', type=int, default=2)
+    quant_group.add_argument('--iters', help='Timed iterations', type=int, default=10)
+
+    output_group = parser.add_argument_group('Output')
+    output_group.add_argument('--out', help='Output TorchScript file, defaults to <model>_int8.pt', type=str, default=None)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,103 @@
+import numpy as np
+import torch
+
+# Torch version of resample.resample_fn for images that are already on the device.
+# The images are channel first tensors [..., H, W] with an identity direction, size, spacing and origin
+# follow the SimpleITK (x, y) order.
+# The interpolation reproduces itk::ResampleImageFilter: continuous indices outside [-0.5, size - 0.5) get 0,
+# linear interpolation clamps the neighbors to the border and nearest rounds half up.
+# Integer images are truncated back to their pixel type like the SimpleITK filter does.
+
+def resample_params(size, spacing, origin, args):
+    # Output size, spacing and origin computed with the same rules as resample.resample_fn
+    output_size = [si if o_si == -1 else o_si for si, o_si in zip(size, args.size)]
+    output_origin = origin
+
+    if(args.fit_spacing):
+        output_spacing = [sp*si/o_si for sp, si, o_si in zip(spacing, size, output_size)]
+    else:
+        output_spacing = spacing
+
+    if(args.iso_spacing):
+        output_spacing_filtered = [sp for si, sp in zip(args.size, output_spacing) if si != -1]
+        max_spacing = np.max(output_spacing_filtered)
+        output_spacing = [sp if si == -1 else max_spacing for si, sp in zip(args.size, output_spacing)]
+
+    if(args.spacing is not None):
+        output_spacing = args.spacing
+
+    if(args.origin is not None):
+        output_origin = args.origin
+
+    if(args.center):
+        output_physical_size = np.array(output_size)*np.array(output_spacing)
+        input_physical_size = np.array(size)*np.array(spacing)
+        output_origin = np.array(output_origin) - (output_physical_size - input_physical_size)/2.0
+
+    return [int(si) for si in output_size], [float(sp) for sp in output_spacing], [float(o) for o in output_origin]
+
+def continuous_index(out_size, out_spacing, out_origin, spacing, origin, device):
+    # Continuous index in the input image of every output row/column
+    return [(out_origin[d] + torch.arange(out_size[d], dtype=torch.float64, device=device)*out_spacing[d] - origin[d])/spacing[d] for d in range(2)]
+
+def interpolate_nearest(img_t, cx, cy):
+    H, W = img_t.shape[-2:]
+
+    inside = ((cy >= -0.5) & (cy < H - 0.5))[:, None] & ((cx >= -0.5) & (cx < W - 0.5))[None, :]
+
+    x = torch.clamp(torch.floor(cx + 0.5).to(torch.int64), 0, W - 1)
+    y = torch.clamp(torch.floor(cy + 0.5).to(torch.int64), 0, H - 1)
+
+    out = img_t[..., y, :][..., x]
+
+    return out.masked_fill_(~inside, 0)
+
+def interpolate_linear(img_t, cx, cy):
+    H, W = img_t.shape[-2:]
+
+    inside = ((cy >= -0.5) & (cy < H - 0.5))[:, None] & ((cx >= -0.5) & (cx < W - 0.5))[None, :]
+
+    x0 = torch.clamp(torch.floor(cx), 0, W - 1)
+    y0 = torch.clamp(torch.floor(cy), 0, H - 1)
+    dx = torch.clamp(cx - x0, min=0)
+    dy = torch.clamp(cy - y0, min=0)
+
+    x0 = x0.to(torch.int64)
+    y0 = y0.to(torch.int64)
+    x1 = torch.clamp(x0 + 1, max=W - 1)
+    y1 = torch.clamp(y0 + 1, max=H - 1)
+
+    rows0 = img_t[..., y0, :].to(torch.float64)
+    rows1 = img_t[..., y1, :].to(torch.float64)
+
+    # Same operation order as itk::LinearInterpolateImageFunction, first along x then along y
+    val_x0 = rows0[..., x0] + (rows0[..., x1] - rows0[..., x0])*dx
+    val_x1 = rows1[..., x0] + (rows1[..., x1] - rows1[..., x0])*dx
+    out = val_x0 + (val_x1 - val_x0)*dy[:, None]
+
+    return out.masked_fill_(~inside, 0)
+
+def resample_fn(img_t, args, spacing=None, origin=None):
+    # Returns the resampled tensor and its spacing and origin
+    size = [img_t.shape[-1], img_t.shape[-2]]
+
+    if spacing is None:
+        spacing = [1.0, 1.0]
+    if origin is None:
+        origin = [0.0, 0.0]
+
+    output_size, output_spacing, output_origin = resample_params(size, spacing, origin, args)
+
+    cx, cy = continuous_index(output_size, output_spacing, output_origin, spacing, origin, img_t.device)
+
+    if args.linear:
+        out = interpolate_linear(img_t, cx, cy)
+        if img_t.dtype.is_floating_point:
+            out = out.to(img_t.dtype)
+        else:
+            info = torch.iinfo(img_t.dtype)
+            out = torch.clamp(torch.trunc(out), info.min, info.max).to(img_t.dtype)
+    else:
+        out = interpolate_nearest(img_t, cx, cy)
+
+    return out, output_spacing, output_origin
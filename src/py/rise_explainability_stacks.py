@@ -0,0 +1,154 @@
+import argparse
+
+import os
+import pandas as pd
+import numpy as np
+
+import SimpleITK as sitk
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+from nets.classification import EfficientnetV2sStacks, EfficientnetV2sStacksDot, MobileNetV2Stacks
+from slim_checkpoint import load_model
+from loaders.tt_dataset import TTDatasetStacks
+
+from tqdm import tqdm
+
+# RISE saliency of the frames of the torch stack classifiers, torch version of rise_explainability_softmax.py.
+# Each frame is scored by the frame level prediction softmax(P(V(F(frame)))). The masks are generated from --seed in chunks of --chunk
+# masks (bilinear upsampling of the random grids and random shifts), stored in fp16 and the saliency is accumulated as a running
+# weighted sum, only one chunk of masks is on the device at a time. test_rise_stacks.py checks it against the RISE formula.
+
+class RISE:
+    def __init__(self, model, num_masks=2000, s=16, p1=0.5, chunk=4, seed=0, amp=False):
+        self.model = model
+        self.num_masks = num_masks
+        self.s = s
+        self.p1 = p1
+        self.chunk = chunk
+        self.seed = seed
+        self.amp = amp
+
+    def predict_frames(self, x):
+        # x [N, 3, H, W] -> [N, C]
+        x = self.model.V(self.model.F.module(x))
+        return torch.softmax(self.model.P(x).to(torch.float32), dim=1)
+
+    def grids(self, size, device):
+        # Binary grids and shifts of all the masks, a few KB, the same for every stack
+        g = torch.Generator(device="cpu").manual_seed(self.seed)
+        cell_size = [int(np.ceil(sz/self.s)) for sz in size]
+
+        grid = (torch.rand(self.num_masks, 1, self.s, self.s, generator=g) < self.p1).to(torch.float16)
+        shift_y = torch.randint(0, cell_size[0], (self.num_masks,), generator=g)
+        shift_x = torch.randint(0, cell_size[1], (self.num_masks,), generator=g)
+
+        return grid.to(device), shift_y.to(device), shift_x.to(device), cell_size
+
+    def masks(self, grid, shift_y, shift_x, cell_size, size):
+        # Linear upsampling and cropping of a chunk of grids -> [n, H, W] fp16
+        up_size = [(self.s + 1)*c for c in cell_size]
+        up = F.interpolate(grid.to(torch.float32), size=up_size, mode="bilinear", align_corners=False)[:, 0]
+
+        rows = shift_y[:, None] + torch.arange(size[0], device=grid.device)
+        cols = shift_x[:, None] + torch.arange(size[1], device=grid.device)
+        idx = torch.arange(grid.shape[0], device=grid.device)[:, None, None]
+
+        return up[idx, rows[:, :, None], cols[:, None, :]].to(torch.float16)
+
+    @torch.no_grad()
+    def __call__(self, X):
+        # X [T, 3, H, W] frames after the test transform -> saliency [T, C, H, W]
+        T = X.shape[0]
+        size = list(X.shape[-2:])
+        grid, shift_y, shift_x, cell_size = self.grids(size, X.device)
+
+        saliency = 0
+
+        for start in range(0, self.num_masks, self.chunk):
+            end = min(start + self.chunk, self.num_masks)
+            masks = self.masks(grid[start:end], shift_y[start:end], shift_x[start:end], cell_size, size)
+
+            # All the frames against the chunk of masks in one forward, [T*n, 3, H, W] -> [T, n, C]
+            with torch.autocast(device_type=X.device.type, enabled=self.amp):
+                p = self.predict_frames((X[:, None]*masks[None, :, None].to(X.dtype)).flatten(0, 1))
+            p = p.reshape(T, end - start, -1)
+
+            # Running weighted sum of the masks, the weights are the frame probabilities
+            saliency = saliency + torch.einsum('tnc,nk->tck', p, masks.reshape(end - start, -1).to(torch.float32))
+
+        return (saliency/self.num_masks/self.p1).reshape(T, -1, *size)
+
+def main(args):
+
+    df_test = pd.read_csv(os.path.join(args.mount_point, args.csv))
+
+    test_ds = TTDatasetStacks(df_test, mount_point=args.mount_point, img_column=args.img_column)
+    test_data = DataLoader(test_ds, shuffle=False, batch_size=1, num_workers=args.num_workers, persistent_workers=True, pin_memory=True)
+
+    if args.nn == "efficientnet_v2s_stacks":
+        model = load_model(EfficientnetV2sStacks, args.model)
+    elif args.nn == "efficientnet_v2s_stacks_dot":
+        model = load_model(EfficientnetV2sStacksDot, args.model)
+    elif args.nn == "mobilenet_v2_stacks":
+        model = load_model(MobileNetV2Stacks, args.model)
+
+    if torch.cuda.is_available():
+        device = torch.device("cuda")
+    else:
+        device = torch.device("cpu")
+
+    model.eval()
+    model.to(device)
+
+    rise = RISE(model, num_masks=args.num_masks, s=args.s, p1=args.p1, chunk=args.chunk, seed=args.seed, amp=args.amp)
+
+    for idx, X in enumerate(tqdm(test_data, total=len(test_data))):
+
+        out_fn = os.path.join(args.out, df_test.loc[idx][args.img_column])
+
+        if os.path.exists(out_fn):
+            continue
+
+        with torch.no_grad():
+            X = model.test_transform(X.to(device, non_blocking=True))
+
+        saliency = rise(X[0])
+
+        out_dir = os.path.dirname(out_fn)
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+        # [T, H, W, C] like rise_explainability_softmax.py
+        saliency = saliency.permute(0, 2, 3, 1).cpu().numpy()
+        sitk.WriteImage(sitk.GetImageFromArray(saliency, isVector=True), out_fn, True)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='RISE explainability of the TT stack classifiers')
+
+    input_group = parser.add_argument_group('Input')
+    input_group.add_argument('--csv', help='CSV file with the stacks', type=str, required=True)
+    input_group.add_argument('--img_column', help='Image column name', type=str, default="image")
+    input_group.add_argument('--mount_point', help='Dataset mount directory', type=str, default="./")
+    input_group.add_argument('--num_workers', help='Number of workers for loading', type=int, default=4)
+    input_group.add_argument('--model', help='Model checkpoint', type=str, required=True)
+    input_group.add_argument('--nn', help='Type of neural network', type=str, default="efficientnet_v2s_stacks_dot", choices=["efficientnet_v2s_stacks", "efficientnet_v2s_stacks_dot", "mobilenet_v2_stacks"])
+
+    rise_group = parser.add_argument_group('RISE')
+    rise_group.add_argument('--num_masks', help='Number of masks', type=int, default=2000)
+    rise_group.add_argument('--s', help='Size of the random grids', type=int, default=16)
+    rise_group.add_argument('--p1', help='Probability of keeping a grid cell', type=float, default=0.5)
+    rise_group.add_argument('--chunk', help='Number of masks generated and evaluated at once for all the frames of a stack, the forward batch is frames*chunk', type=int, default=4)
+    rise_group.add_argument('--seed', help='Seed of the masks', type=int, default=0)
+    rise_group.add_argument('--amp', help='Run the model under autocast', type=int, default=0)
+
+    output_group = parser.add_argument_group('Output')
+    output_group.add_argument('--out', help='Output directory', type=str, default="./rise")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -8,6 +8,7 @@ import numpy as np
 import torch
 
 from nets.segmentation import TTUNet
+from slim_checkpoint import load_model
 from loaders.tt_dataset import TTDatasetSeg, InTransformsSeg, OutTransformsSeg
 from callbacks.logger import SegImageLogger
 
@@ -26,7 +27,7 @@ def main(args):
     resize_transform = Resize(spatial_size=[512, 512], mode='nearest')
     out_transform = OutTransformsSeg()
     
-    model = TTUNet(args, out_channels=4).load_from_checkpoint(args.model)
+    model = load_model(TTUNet, args.model)
 
     for idx, img in tqdm(enumerate(test_ds), total=len(test_ds)):
         img = resize_transform(img)
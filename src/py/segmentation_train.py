@@ -9,8 +9,9 @@ import numpy as np
 import torch
 
 from nets.segmentation import TTUNet,TTRCNN
-from loaders.tt_dataset import TTDataModuleSeg, TrainTransformsSeg, EvalTransformsSeg
+from loaders.tt_dataset import TTDataModuleSeg, TrainTransformsSeg, TrainTransformsSegGPU, EvalTransformsSeg
 from callbacks.logger import SegImageLoggerNeptune, MaskRCNNImageLoggerNeptune
+from utils import compile_regions
 
 from lightning import Trainer
 from lightning.pytorch.callbacks.early_stopping import EarlyStopping
@@ -30,10 +31,13 @@ def main(args):
     df_val = pd.read_csv(args.csv_valid)
     df_test = pd.read_csv(args.csv_test)
     
-    train_transform = TrainTransformsSeg()
+    if args.gpu_aug:
+        train_transform = TrainTransformsSegGPU()
+    else:
+        train_transform = TrainTransformsSeg()
     eval_transform = EvalTransformsSeg()
 
-    ttdata = TTDataModuleSeg(df_train, df_val, df_test, batch_size=args.batch_size, num_workers=args.num_workers, img_column=args.img_column, seg_column=args.seg_column, mount_point=args.mount_point, train_transform=train_transform, valid_transform=eval_transform, test_transform=eval_transform)
+    ttdata = TTDataModuleSeg(df_train, df_val, df_test, batch_size=args.batch_size, num_workers=args.num_workers, img_column=args.img_column, seg_column=args.seg_column, mount_point=args.mount_point, train_transform=train_transform, valid_transform=eval_transform, test_transform=eval_transform, cache=args.cache, cache_dir=args.cache_dir)
 
 
     checkpoint_callback = ModelCheckpoint(
@@ -52,6 +56,12 @@ def main(args):
     else:
         # model = TTUNet(out_channels=4, **vars(args))
         model = TTRCNN(num_classes=4,  **vars(args))
+
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+
+    if args.compile:
+        compile_regions(model)
     
     early_stop_callback = EarlyStopping(monitor="val_loss", min_delta=0.00, patience=args.patience, verbose=True, mode="min")
     logger = None
@@ -67,10 +77,11 @@ def main(args):
         logger=logger,
         max_epochs=args.epochs,
         callbacks=[early_stop_callback, checkpoint_callback, image_logger],
-        devices=torch.cuda.device_count(), 
-        accelerator="gpu", 
+        devices=torch.cuda.device_count() if args.accelerator == "gpu" else 1, 
+        accelerator=args.accelerator, 
         strategy=DDPStrategy(find_unused_parameters=False),
-        log_every_n_steps=args.log_every_n_steps
+        log_every_n_steps=args.log_every_n_steps,
+        precision=args.precision
     )
     trainer.fit(model, datamodule=ttdata, ckpt_path=args.model)
 
@@ -89,6 +100,8 @@ if __name__ == '__main__':
     input_group.add_argument('--csv_test', required=True, type=str, help='Test CSV')
     input_group.add_argument('--img_column', type=str, default="img_path", help='Name of image column in csv')
     input_group.add_argument('--seg_column', type=str, default="seg_path", help='Name of segmentation column in csv')
+    input_group.add_argument('--cache', type=str, default="off", choices=["off", "ram", "disk"], help='Cache the decoded images and segmentations as memory mapped shards')
+    input_group.add_argument('--cache_dir', type=str, default=None, help='Cache directory, defaults to /dev/shm for ram and the temp directory for disk')
 
     hparams_group = parser.add_argument_group('Hyperparameters')
     hparams_group.add_argument('--lr', '--learning-rate', default=1e-4, type=float, help='Learning rate')
@@ -96,6 +109,11 @@ if __name__ == '__main__':
     hparams_group.add_argument('--patience', help='Max number of patience steps for EarlyStopping', type=int, default=30)
     hparams_group.add_argument('--steps', help='Max number of steps per epoch', type=int, default=-1)    
     hparams_group.add_argument('--batch_size', help='Batch size', type=int, default=256)
+    hparams_group.add_argument('--gpu_aug', help='Run the zoom, rotation, flip and color augmentation on the device for the whole batch', type=int, default=0)
+    hparams_group.add_argument('--precision', type=str, default="32", choices=["32", "16-mixed", "bf16-mixed"], help='Trainer precision, the mixed modes run the forward under autocast and keep the losses in float32')
+    hparams_group.add_argument('--channels_last', type=int, default=0, help='Train with the channels last memory format')
+    hparams_group.add_argument('--accelerator', type=str, default="gpu", choices=["gpu", "cpu"], help='Trainer accelerator, cpu runs a single device, e.g., to check --precision bf16-mixed')
+    hparams_group.add_argument('--compile', type=int, default=0, help='Compile the backbone of the model with torch.compile')
     
     logger_group = parser.add_argument_group('Logger')
     logger_group.add_argument('--log_every_n_steps', help='Log every n steps', type=int, default=10)
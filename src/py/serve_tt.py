@@ -0,0 +1,272 @@
+import argparse
+
+import io
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import torch
+from PIL import Image
+
+from nets.segmentation import TTUNet
+from nets.classification import EfficientnetV2sStacksDot
+from slim_checkpoint import load_model
+from create_stack_torch_pl import create_stacks_torch
+
+# Local inference service for the full TT pipeline, the segmentation and stack classifier stay loaded.
+# POST /predict with the jpg/png bytes as body
+#   default            npz with probs [C], pred, seg [H, W] uint8 label map and stack [stack_samples, stack_size, stack_size, 3] uint8
+#   ?format=json       {"probs": [...], "pred": int}
+# GET /metrics         latency percentiles, throughput, batch sizes and queue depth
+# GET /health
+# Concurrent requests are grouped in batches of up to --max_batch_size images, waiting at most --max_wait seconds for the batch to fill.
+
+class MicroBatcher:
+    def __init__(self, fn, metrics, max_batch_size=8, max_wait=0.01):
+        self.fn = fn
+        self.metrics = metrics
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self.queue.put((item, future))
+        return future.result()
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            start = time.perf_counter()
+            try:
+                results = self.fn([item for item, _ in batch])
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                # Retry the items one by one so only the requests that fail on their own get the error
+                for item, future in batch:
+                    if len(batch) == 1:
+                        future.set_exception(e)
+                        continue
+                    try:
+                        future.set_result(self.fn([item])[0])
+                    except Exception as e_item:
+                        future.set_exception(e_item)
+            self.metrics.record_batch(len(batch), time.perf_counter() - start, self.queue.qsize())
+
+class ServiceMetrics:
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.images = 0
+        self.batches = 0
+        self.queue_depth = 0
+        self.latencies = deque(maxlen=window)
+        self.finished = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.batch_times = deque(maxlen=window)
+
+    def record_request(self, latency, ok):
+        with self.lock:
+            self.requests += 1
+            if ok:
+                self.latencies.append(latency)
+                self.finished.append(time.time())
+            else:
+                self.errors += 1
+
+    def record_batch(self, size, seconds, queue_depth):
+        with self.lock:
+            self.batches += 1
+            self.images += size
+            self.queue_depth = queue_depth
+            self.batch_sizes.append(size)
+            self.batch_times.append(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            finished = np.array(self.finished)
+            uptime = time.time() - self.start
+
+            out = {
+                "uptime_s": uptime,
+                "requests": self.requests,
+                "errors": self.errors,
+                "images": self.images,
+                "batches": self.batches,
+                "queue_depth": self.queue_depth,
+                "throughput_rps": self.images/uptime if uptime > 0 else 0.0,
+                "mean_batch_size": float(np.mean(self.batch_sizes)) if len(self.batch_sizes) > 0 else 0.0,
+                "mean_batch_s": float(np.mean(self.batch_times)) if len(self.batch_times) > 0 else 0.0
+            }
+
+            if len(latencies) > 0:
+                for q in [50, 90, 95, 99]:
+                    out["latency_p" + str(q) + "_s"] = float(np.percentile(latencies, q))
+                out["latency_mean_s"] = float(np.mean(latencies))
+
+            # Throughput over the requests in the window
+            if len(finished) > 1 and finished[-1] > finished[0]:
+                out["recent_throughput_rps"] = (len(finished) - 1)/(finished[-1] - finished[0])
+
+            return out
+
+class TTPipeline:
+    # Segmentation, poly fit stacks and stack classification for a batch of [H, W, 3] uint8 images
+    def __init__(self, args, device):
+        self.args = args
+        self.device = device
+
+        self.model_seg = load_model(TTUNet, args.seg_model, strict=False)
+        self.model_seg.eval()
+        self.model_seg.to(device)
+
+        self.model_predict = load_model(EfficientnetV2sStacksDot, args.predict_model)
+        self.model_predict.eval()
+        self.model_predict.to(device)
+
+        self.autocast_dtype = torch.float16 if device.type == "cuda" else torch.bfloat16
+
+    def __call__(self, imgs_np):
+        imgs_t = [torch.from_numpy(img_np).to(self.device, non_blocking=True) for img_np in imgs_np]
+
+        # JPEG/PNG images have unit spacing and zero origin like sitk.ReadImage
+        spacings = [(1.0, 1.0)]*len(imgs_t)
+        origins = [(0.0, 0.0)]*len(imgs_t)
+
+        with torch.inference_mode(), torch.autocast(device_type=self.device.type, dtype=self.autocast_dtype, enabled=bool(self.args.amp)):
+            out_stacks, segs = create_stacks_torch(imgs_t, spacings, origins, self.model_seg, self.args)
+
+            x = torch.stack(out_stacks).permute(0, 1, 4, 2, 3).to(torch.float32)/255.0
+            probs = self.model_predict(x).to(torch.float32)
+
+        return [{"probs": p.cpu().numpy(), "seg": s.cpu().numpy(), "stack": st.cpu().numpy()} for p, s, st in zip(probs, segs, out_stacks)]
+
+class TTRequestHandler(BaseHTTPRequestHandler):
+
+    def send_body(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, code, obj):
+        self.send_body(code, json.dumps(obj).encode("utf-8"), "application/json")
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            self.send_json(200, self.server.metrics.snapshot())
+        elif path == "/health":
+            self.send_json(200, {"status": "ok"})
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/predict":
+            self.send_json(404, {"error": "not found"})
+            return
+
+        start = time.perf_counter()
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            img_np = np.array(Image.open(io.BytesIO(body)).convert("RGB"))
+        except Exception as e:
+            self.server.metrics.record_request(time.perf_counter() - start, False)
+            self.send_json(400, {"error": "could not decode the image: " + str(e)})
+            return
+
+        try:
+            result = self.server.batcher.submit(img_np)
+        except Exception as e:
+            self.server.metrics.record_request(time.perf_counter() - start, False)
+            self.send_json(500, {"error": str(e)})
+            return
+
+        pred = int(np.argmax(result["probs"]))
+
+        if parse_qs(url.query).get("format", ["npz"])[0] == "json":
+            self.send_json(200, {"probs": result["probs"].tolist(), "pred": pred})
+        else:
+            buf = io.BytesIO()
+            np.savez(buf, probs=result["probs"], pred=pred, seg=result["seg"], stack=result["stack"])
+            self.send_body(200, buf.getvalue(), "application/octet-stream")
+
+        self.server.metrics.record_request(time.perf_counter() - start, True)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+def main(args):
+
+    if torch.cuda.is_available():
+        device = torch.device("cuda")
+    else:
+        device = torch.device("cpu")
+
+    metrics = ServiceMetrics(window=args.metrics_window)
+    pipeline = TTPipeline(args, device)
+
+    server = ThreadingHTTPServer((args.host, args.port), TTRequestHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    server.batcher = MicroBatcher(pipeline, metrics, max_batch_size=args.max_batch_size, max_wait=args.max_wait)
+    server.verbose = args.verbose
+
+    print("Serving on", "http://" + args.host + ":" + str(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='TT inference service, segmentation + stacks + classification over HTTP')
+
+    model_group = parser.add_argument_group('Models')
+    model_group.add_argument('--seg_model', type=str, help='Segmentation model', required=True)
+    model_group.add_argument('--predict_model', type=str, help='Stack classification model', required=True)
+    model_group.add_argument('--stack_size', type=int, help='Size w/h of the image stacks/frames', default=768)
+    model_group.add_argument('--stack_samples', type=int, help='Stack samples', default=16)
+    model_group.add_argument('--amp', type=int, help='Run the models under autocast', default=0)
+
+    service_group = parser.add_argument_group('Service')
+    service_group.add_argument('--host', type=str, help='Address to bind, the service is local by default', default="127.0.0.1")
+    service_group.add_argument('--port', type=int, help='Port', default=8008)
+    service_group.add_argument('--max_batch_size', type=int, help='Maximum number of images per batch', default=8)
+    service_group.add_argument('--max_wait', type=float, help='Maximum seconds to wait for a batch to fill after its first image', default=0.01)
+    service_group.add_argument('--metrics_window', type=int, help='Number of recent requests/batches used for the metrics', default=1000)
+    service_group.add_argument('--verbose', type=int, help='Log every request', default=0)
+
+    args = parser.parse_args()
+
+    main(args)
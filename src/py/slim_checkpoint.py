@@ -0,0 +1,113 @@
+import argparse
+import importlib
+import inspect
+import json
+import os
+
+import numpy as np
+import torch
+from torch import nn
+
+from utils import no_pretrained
+
+# Weights only checkpoints for inference, written by export_slim.py from the lightning .ckpt files.
+# <out>.json  module/class of the model, hparams and the name, dtype, shape and byte offset of every tensor of the state_dict
+# <out>.bin   raw tensor bytes, 64 byte aligned, memory mapped when loading
+# load_model builds the architecture without the ImageNet weights and loads the mapped tensors, pages are only read when they are used.
+
+ALIGN = 64
+
+def to_json(v):
+    if isinstance(v, argparse.Namespace):
+        return {"__namespace__": to_json(vars(v))}
+    if isinstance(v, dict):
+        return {str(k): to_json(x) for k, x in v.items()}
+    if isinstance(v, (list, tuple)):
+        return [to_json(x) for x in v]
+    if isinstance(v, (torch.Tensor, np.ndarray)):
+        return v.tolist()
+    if isinstance(v, np.generic):
+        return v.item()
+    if v is None or isinstance(v, (bool, int, float, str)):
+        return v
+    return str(v)
+
+def from_json(v):
+    if isinstance(v, dict):
+        if "__namespace__" in v:
+            return argparse.Namespace(**from_json(v["__namespace__"]))
+        return {k: from_json(x) for k, x in v.items()}
+    if isinstance(v, list):
+        return [from_json(x) for x in v]
+    return v
+
+def save_slim(NN, hparams, state_dict, out):
+    # out is the name without extension
+    tensors = []
+    offset = 0
+
+    with open(out + ".bin", "wb") as f:
+        for name, t in state_dict.items():
+            t = t.detach().cpu().contiguous()
+            b = t.reshape(-1).view(torch.uint8).numpy()
+
+            pad = (-offset) % ALIGN
+            f.write(b"\0"*pad)
+            offset += pad
+
+            tensors.append({"name": name, "dtype": str(t.dtype).replace("torch.", ""), "shape": list(t.shape), "offset": offset, "nbytes": int(b.nbytes)})
+            f.write(b.tobytes())
+            offset += b.nbytes
+
+    meta = {
+        "module": NN.__module__,
+        "nn": NN.__name__,
+        "hparams": to_json(dict(hparams)),
+        "weights": os.path.basename(out) + ".bin",
+        "tensors": tensors
+    }
+
+    with open(out + ".json", "w") as f:
+        json.dump(meta, f, indent=2)
+
+def read_slim(fn):
+    # hparams and a state_dict whose tensors are views of the memory mapped weights file
+    with open(fn) as f:
+        meta = json.load(f)
+
+    weights_fn = os.path.join(os.path.dirname(fn), meta["weights"])
+    # Copy on write, the tensors stay writable without touching the file
+    mm = np.memmap(weights_fn, dtype=np.uint8, mode="c") if os.path.getsize(weights_fn) > 0 else np.zeros(0, dtype=np.uint8)
+
+    state_dict = {}
+    for t in meta["tensors"]:
+        b = torch.from_numpy(mm[t["offset"]:t["offset"] + t["nbytes"]])
+        state_dict[t["name"]] = b.view(getattr(torch, t["dtype"])).reshape(t["shape"])
+
+    return meta, from_json(meta["hparams"]), state_dict
+
+def load_slim(fn, NN=None, strict=True, **kwargs):
+    meta, hparams, state_dict = read_slim(fn)
+
+    if NN is None:
+        NN = getattr(importlib.import_module(meta["module"]), meta["nn"])
+
+    # kwargs override the saved hparams like in load_from_checkpoint
+    hparams.update(kwargs)
+
+    with no_pretrained():
+        model = NN(**hparams)
+
+    if "assign" in inspect.signature(nn.Module.load_state_dict).parameters:
+        # torch >= 2.1, the parameters become the mapped tensors instead of copies
+        model.load_state_dict(state_dict, strict=strict, assign=True)
+    else:
+        model.load_state_dict(state_dict, strict=strict)
+
+    return model
+
+def load_model(NN, fn, **kwargs):
+    # Model factory of the prediction scripts, slim checkpoints (.json) or lightning checkpoints
+    if os.path.splitext(fn)[1] == ".json":
+        return load_slim(fn, NN, **kwargs)
+    return NN.load_from_checkpoint(fn, **kwargs)
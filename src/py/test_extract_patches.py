@@ -0,0 +1,106 @@
+import argparse
+
+import torch
+from torchvision import transforms
+
+from utils import extract_patches
+
+# Parity of the batched utils.extract_patches against the loop version of the YOLT models (slicing every patch and transforms.Resize).
+# The boxes are at least num_patches^2 pixels per side, below that the loop gives more than num_patches patches per row.
+# An int patch size resizes the shorter side of the patches and keeps the aspect ratio, the boxes of a batch are then drawn with
+# the same patch aspect ratio and a batch with different ratios must raise a ValueError.
+
+def extract_patches_loop(img, bb, nh, nw, size):
+    # No antialias like transforms.Resize of tensors in torchvision 0.15
+    resize = transforms.Resize(size, antialias=False)
+
+    xmin, ymin, xmax, ymax = bb
+
+    width = xmax - xmin
+    height = ymax - ymin
+
+    patch_width = torch.div(width, nw, rounding_mode='floor')
+    patch_height = torch.div(height, nh, rounding_mode='floor')
+    patches = []
+
+    for j in range(ymin, ymax-patch_height+1, patch_height):
+        for i in range(xmin, xmax-patch_width+1, patch_width):
+            patch = img[:, j:j+patch_height, i:i+patch_width]
+            patches.append(patch)
+
+    return resize(torch.stack(patches))
+
+def random_boxes(B, H, W, min_size, generator):
+    xmin = torch.randint(0, W - min_size, (B,), generator=generator)
+    ymin = torch.randint(0, H - min_size, (B,), generator=generator)
+    xmax = xmin + min_size + (torch.rand(B, generator=generator)*(W - min_size - xmin)).to(torch.int64)
+    ymax = ymin + min_size + (torch.rand(B, generator=generator)*(H - min_size - ymin)).to(torch.int64)
+    return torch.stack([xmin, ymin, xmax, ymax], dim=1)
+
+def random_boxes_ratio(B, H, W, N, patch_min, generator):
+    # Patches of (k*ph, k*pw) pixels with the same (ph, pw) for the whole batch, the box sizes are not multiples of N
+    ph, pw = torch.randint(2, 6, (2,), generator=generator).tolist()
+    k_max = min((H - N)//(N*ph), (W - N)//(N*pw))
+    k = torch.randint(max(1, patch_min//min(ph, pw)), k_max + 1, (B,), generator=generator)
+    height = N*k*ph + torch.randint(0, N, (B,), generator=generator)
+    width = N*k*pw + torch.randint(0, N, (B,), generator=generator)
+    xmin = (torch.rand(B, generator=generator)*(W - width + 1)).to(torch.int64)
+    ymin = (torch.rand(B, generator=generator)*(H - height + 1)).to(torch.int64)
+    return torch.stack([xmin, ymin, xmin + width, ymin + height], dim=1)
+
+def main(args):
+
+    g = torch.Generator().manual_seed(args.seed)
+
+    ok = True
+    for N in args.num_patches:
+        for size in [tuple(args.patch_size), (args.patch_size[0]//4, args.patch_size[1]//8)]:
+            img = torch.rand(args.batch_size, 3, args.height, args.width, generator=g)
+            bb = random_boxes(args.batch_size, args.height, args.width, N*N, g)
+
+            X_loop = torch.stack([extract_patches_loop(i, b, N, N, size) for i, b in zip(img, bb)])
+            X_patches = extract_patches(img, bb, N, N, size)
+
+            diff = torch.max(torch.abs(X_loop - X_patches)).item() if X_loop.shape == X_patches.shape else float("inf")
+            print("N:", N, "size:", size, "shape:", tuple(X_patches.shape), "max abs diff:", diff)
+            ok = ok and diff < args.tol
+
+        # int and length 1 sizes, the shorter side of the patches goes to the size
+        for size in [args.patch_size[0], [args.patch_size[0]//4]]:
+            img = torch.rand(args.batch_size, 3, args.height, args.width, generator=g)
+            bb = random_boxes_ratio(args.batch_size, args.height, args.width, N, N, g)
+
+            X_loop = torch.stack([extract_patches_loop(i, b, N, N, size) for i, b in zip(img, bb)])
+            X_patches = extract_patches(img, bb, N, N, size)
+
+            diff = torch.max(torch.abs(X_loop - X_patches)).item() if X_loop.shape == X_patches.shape else float("inf")
+            print("N:", N, "size:", size, "shape:", tuple(X_patches.shape), "max abs diff:", diff)
+            ok = ok and diff < args.tol
+
+        bb = torch.tensor([[0, 0, N*N*2, N*N], [0, 0, N*N, N*N*2]])
+        try:
+            extract_patches(torch.rand(2, 3, args.height, args.width, generator=g), bb, N, N, args.patch_size[0])
+            print("N:", N, "different patch aspect ratios did not raise")
+            ok = False
+        except ValueError as e:
+            print("N:", N, "different patch aspect ratios:", e)
+
+    print("OK" if ok else "FAILED")
+    if not ok:
+        exit(1)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='TT test batched patch extraction against the loop version')
+    parser.add_argument('--batch_size', help='Batch size', type=int, default=4)
+    parser.add_argument('--height', help='Height of the random images', type=int, default=512)
+    parser.add_argument('--width', help='Width of the random images', type=int, default=768)
+    parser.add_argument('--num_patches', help='Number of patches per side', type=int, nargs='+', default=[3, 5, 6])
+    parser.add_argument('--patch_size', help='Size of the patch, also checked with a smaller size that downsamples the patches', type=int, nargs=2, default=[256, 256])
+    parser.add_argument('--seed', help='Seed of the images and boxes', type=int, default=0)
+    parser.add_argument('--tol', help='Maximum absolute difference', type=float, default=1e-4)
+
+    args = parser.parse_args()
+
+    main(args)
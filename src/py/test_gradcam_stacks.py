@@ -0,0 +1,69 @@
+import argparse
+
+import copy
+import numpy as np
+
+import torch
+import torch.nn as nn
+
+from torchvision import models
+from torchvision import ops
+
+from nets.classification import EfficientnetV2sStacks
+from slim_checkpoint import load_model
+from gradcam_classification_predict_stacks import BatchGradCAM, SignedGradCAM, grad_cam_stack
+
+# Parity of the batched Grad-CAM engine against the frame by frame pytorch_grad_cam engine (main_grad_cam) of gradcam_classification_predict_stacks.py.
+# Without --model the model_patches of EfficientnetV2sStacks are randomly initialized.
+
+def main(args):
+
+    torch.manual_seed(args.seed)
+
+    if args.model:
+        model_patches = load_model(EfficientnetV2sStacks, args.model).model_patches
+    else:
+        model_patches = nn.Sequential(
+            models.efficientnet_v2_s().features,
+            ops.Conv2dNormActivation(1280, 1536),
+            nn.AdaptiveAvgPool2d(1),
+            nn.Flatten(start_dim=1))
+    model_patches.eval()
+
+    X = torch.rand(args.frames, 3, args.size, args.size)
+
+    # grad_cam engine
+    model_ref = copy.deepcopy(model_patches)
+    cam_ref = SignedGradCAM(model=model_ref, target_layers=[model_ref[1]])
+    tt_cam_ref = grad_cam_stack(cam_ref, X)[..., 0]
+
+    # batched engine, frozen parameters like main
+    for param in model_patches.parameters():
+        param.requires_grad = False
+    cam = BatchGradCAM(model_patches, model_patches[1])
+    tt_cam = cam(X).cpu().numpy()
+
+    ok = True
+    for t in range(args.frames):
+        diff = np.max(np.abs(tt_cam[t] - tt_cam_ref[t]))
+        corr = np.corrcoef(tt_cam[t].flatten(), tt_cam_ref[t].flatten())[0, 1]
+        print("Frame:", t, "max abs diff:", diff, "correlation:", corr)
+        ok = ok and diff < args.tol
+
+    print("OK" if ok else "FAILED")
+    if not ok:
+        exit(1)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='TT test batched Grad-CAM against pytorch_grad_cam')
+    parser.add_argument('--model', help='EfficientnetV2sStacks checkpoint, random weights if not set', type=str, default=None)
+    parser.add_argument('--frames', help='Number of frames', type=int, default=6)
+    parser.add_argument('--size', help='Size of the frames', type=int, default=224)
+    parser.add_argument('--seed', help='Seed of the weights and frames', type=int, default=0)
+    parser.add_argument('--tol', help='Maximum absolute difference', type=float, default=1e-4)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,84 @@
+import argparse
+
+import numpy as np
+import SimpleITK as sitk
+
+import torch
+
+import resample
+import resample_torch
+from create_stack_torch_pl import get_resample_in_args, get_resample_out_args
+
+# Parity of resample_torch.resample_fn against the SimpleITK resample.resample_fn with the arguments of create_stack_torch_pl,
+# the linear downsample of the photo to 512x512 and the nearest upsample of the label map back to the photo.
+# Without --img the photo is random, --spacing/--origin set its spacing and origin.
+
+def main(args):
+
+    if args.img:
+        img = sitk.ReadImage(args.img)
+    else:
+        rng = np.random.default_rng(args.seed)
+        img = sitk.GetImageFromArray(rng.integers(0, 256, size=(args.height, args.width, 3), dtype=np.uint8), isVector=True)
+        img.SetSpacing(args.spacing)
+        img.SetOrigin(args.origin)
+
+    device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
+
+    img_np = sitk.GetArrayFromImage(img)
+    img_t = torch.from_numpy(img_np).to(device)
+    spacing, origin = img.GetSpacing(), img.GetOrigin()
+
+    # Photo -> 512x512, linear
+    img_resampled = resample.resample_fn(img, get_resample_in_args())
+    img_resampled_np = sitk.GetArrayFromImage(img_resampled)
+
+    x_t, x_spacing, x_origin = resample_torch.resample_fn(img_t.permute(2, 0, 1).unsqueeze(0), get_resample_in_args(), spacing, origin)
+    x_np = x_t[0].permute(1, 2, 0).cpu().numpy()
+
+    diff = np.abs(x_np.astype(np.int32) - img_resampled_np.astype(np.int32))
+    print("Linear downsample:", x_np.shape, img_resampled_np.shape, "max abs diff:", diff.max(), "pixels different:", np.count_nonzero(diff))
+    print("Spacing:", x_spacing, img_resampled.GetSpacing(), "origin:", x_origin, img_resampled.GetOrigin())
+
+    ok = x_np.shape == img_resampled_np.shape and diff.max() <= args.tol
+    ok = ok and np.allclose(x_spacing, img_resampled.GetSpacing()) and np.allclose(x_origin, img_resampled.GetOrigin())
+
+    # Label map 512x512 -> photo, nearest
+    rng = np.random.default_rng(args.seed + 1)
+    seg_np = rng.integers(0, args.num_labels, size=img_resampled_np.shape[0:2], dtype=np.uint8)
+
+    seg_resampled = sitk.GetImageFromArray(seg_np)
+    seg_resampled.SetSpacing(img_resampled.GetSpacing())
+    seg_resampled.SetOrigin(img_resampled.GetOrigin())
+
+    size = [img_np.shape[1], img_np.shape[0]]
+    seg = sitk.GetArrayFromImage(resample.resample_fn(seg_resampled, get_resample_out_args(img.GetSize(), spacing, origin)))
+
+    seg_t, _, _ = resample_torch.resample_fn(torch.from_numpy(seg_np).to(device).unsqueeze(0), get_resample_out_args(size, spacing, origin), x_spacing, x_origin)
+    seg_t = seg_t[0].cpu().numpy()
+
+    print("Nearest upsample:", seg_t.shape, seg.shape, "pixels different:", np.count_nonzero(seg_t != seg))
+
+    ok = ok and seg_t.shape == seg.shape and np.count_nonzero(seg_t != seg) == 0
+
+    print("OK" if ok else "FAILED")
+    if not ok:
+        exit(1)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='TT test torch resample against SimpleITK')
+    parser.add_argument('--img', help='Photo, random if not set', type=str, default=None)
+    parser.add_argument('--width', help='Width of the random photo', type=int, default=1280)
+    parser.add_argument('--height', help='Height of the random photo', type=int, default=960)
+    parser.add_argument('--spacing', help='Spacing of the random photo', type=float, nargs=2, default=[1.0, 1.0])
+    parser.add_argument('--origin', help='Origin of the random photo', type=float, nargs=2, default=[0.0, 0.0])
+    parser.add_argument('--num_labels', help='Number of labels of the random label map', type=int, default=4)
+    parser.add_argument('--seed', help='Seed of the random photo and label map', type=int, default=0)
+    parser.add_argument('--tol', help='Maximum absolute difference of the linear downsample, the label maps must be identical', type=int, default=0)
+    parser.add_argument('--cuda', help='Resample with torch on the GPU if available', type=int, default=1)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,84 @@
+import argparse
+
+import torch
+import torch.nn as nn
+
+from nets.classification import TimeDistributed
+from rise_explainability_stacks import RISE
+
+# Checks of the torch RISE of rise_explainability_stacks.py on a small random stack classifier:
+# the same --seed gives the same saliency, the saliency does not depend on --chunk and it matches the RISE formula
+# sum_i softmax(P(V(F(frame*M_i))))*M_i/(num_masks*p1) computed mask by mask and frame by frame.
+
+class ToyStacks(nn.Module):
+    # Same attributes as the stack classifiers used by RISE.predict_frames
+    def __init__(self, out_features=2):
+        super().__init__()
+        self.F = TimeDistributed(nn.Sequential(
+            nn.Conv2d(3, 8, kernel_size=3, stride=2, padding=1),
+            nn.ReLU(),
+            nn.AdaptiveAvgPool2d(1),
+            nn.Flatten(start_dim=1)))
+        self.V = nn.Linear(8, 16)
+        self.P = nn.Linear(16, out_features)
+
+def rise_reference(rise, X):
+    T = X.shape[0]
+    size = list(X.shape[-2:])
+    grid, shift_y, shift_x, cell_size = rise.grids(size, X.device)
+    masks = rise.masks(grid, shift_y, shift_x, cell_size, size).to(torch.float32)
+
+    saliency = torch.zeros(T, rise.model.P.out_features, *size)
+    with torch.no_grad():
+        for t in range(T):
+            for m in masks:
+                p = rise.predict_frames((X[t]*m).unsqueeze(0))[0]
+                saliency[t] += p[:, None, None]*m
+    return saliency/rise.num_masks/rise.p1
+
+def main(args):
+
+    torch.manual_seed(args.seed)
+
+    model = ToyStacks()
+    model.eval()
+
+    X = torch.rand(args.frames, 3, args.size, args.size)
+
+    saliency = RISE(model, num_masks=args.num_masks, chunk=args.chunk, seed=args.seed)(X)
+    saliency_seed = RISE(model, num_masks=args.num_masks, chunk=args.chunk, seed=args.seed)(X)
+    saliency_chunk = RISE(model, num_masks=args.num_masks, chunk=args.num_masks, seed=args.seed)(X)
+    saliency_other = RISE(model, num_masks=args.num_masks, chunk=args.chunk, seed=args.seed + 1)(X)
+    saliency_ref = rise_reference(RISE(model, num_masks=args.num_masks, seed=args.seed), X)
+
+    diff_seed = torch.max(torch.abs(saliency - saliency_seed)).item()
+    diff_chunk = torch.max(torch.abs(saliency - saliency_chunk)).item()
+    diff_other = torch.max(torch.abs(saliency - saliency_other)).item()
+    diff_ref = torch.max(torch.abs(saliency - saliency_ref)).item()
+
+    print("Shape:", tuple(saliency.shape))
+    print("Same seed max abs diff:", diff_seed)
+    print("Chunk", args.chunk, "vs", args.num_masks, "max abs diff:", diff_chunk)
+    print("Other seed max abs diff:", diff_other)
+    print("Reference max abs diff:", diff_ref)
+
+    ok = diff_seed == 0 and diff_chunk < args.tol and diff_ref < args.tol and diff_other > 0
+
+    print("OK" if ok else "FAILED")
+    if not ok:
+        exit(1)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='TT test torch RISE of the stacks')
+    parser.add_argument('--frames', help='Number of frames', type=int, default=4)
+    parser.add_argument('--size', help='Size of the frames', type=int, default=32)
+    parser.add_argument('--num_masks', help='Number of masks', type=int, default=50)
+    parser.add_argument('--chunk', help='Chunk of masks', type=int, default=7)
+    parser.add_argument('--seed', help='Seed of the model, frames and masks', type=int, default=0)
+    parser.add_argument('--tol', help='Maximum absolute difference', type=float, default=1e-5)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -1,6 +1,8 @@
 import numpy as np
 import torch 
 import torch.nn as nn
+import torch.nn.functional as F
+from contextlib import contextmanager
 
 def GetImage(img_np, ctype = 'float'):
 	img_np_shape = np.shape(img_np)
@@ -54,10 +56,10 @@ def mixup_img(x,y,alpha=0.5, num_classes=4):
 	lam = np.random.beta(alpha, alpha, (batch_size,)).astype(dtype=np.float32)
 	lam = torch.from_numpy(lam).to(x.device)
 
-	index = torch.randperm(batch_size)
+	index = torch.randperm(batch_size, device=x.device)
 	lam = lam.view(batch_size, *[1]*x[0].dim())
 
-	x_perm = torch.stack([x[idx,...] for idx in index])
+	x_perm = x[index]
 	
 	mixed_x = lam * x + (1 - lam) * x_perm
 
@@ -75,11 +77,11 @@ def mixup_img_seg(x, seg, y, num_classes=4, alpha=0.5):
 	lam = np.random.beta(alpha, alpha, (batch_size,)).astype(dtype=np.float32)
 	lam = torch.from_numpy(lam).to(x.device)
 
-	index = torch.randperm(batch_size)
+	index = torch.randperm(batch_size, device=x.device)
 	lam = lam.view(batch_size, *[1]*x[0].dim())
 
-	x_perm = torch.stack([x[idx,...] for idx in index])
-	seg_perm = torch.stack([seg[idx,...] for idx in index])
+	x_perm = x[index]
+	seg_perm = seg[index]
 	
 	mixed_x = lam * x + (1 - lam) * x_perm
 	mixed_seg = lam * seg + (1 - lam) * seg_perm
@@ -91,6 +93,98 @@ def mixup_img_seg(x, seg, y, num_classes=4, alpha=0.5):
 	return  {"img":mixed_x, "seg":mixed_seg, "class":mixed_y}
 
 
+class Float32Forward:
+	# Forward of a module in float32 with autocast disabled. It keeps a reference to the module instead of its bound forward,
+	# so pickle/torch.save and copy.deepcopy of the module copy it along and the copy calls the forward of the copied module
+	def __init__(self, module):
+		self.module = module
+
+	def __call__(self, *args, **kwargs):
+		args = [a.float() if torch.is_tensor(a) and a.is_floating_point() else a for a in args]
+		kwargs = {k: v.float() if torch.is_tensor(v) and v.is_floating_point() else v for k, v in kwargs.items()}
+		with torch.autocast("cuda", enabled=False), torch.autocast("cpu", enabled=False):
+			return type(self.module).forward(self.module, *args, **kwargs)
+
+def float32_loss(loss_fn):
+	# Evaluates the loss module in float32 with autocast disabled so it can be used with mixed precision,
+	# the forward is replaced in place and the state dict keys (e.g. the class weights) stay the same
+	loss_fn.forward = Float32Forward(loss_fn)
+	return loss_fn
+
+
+def get_region(model, name):
+	# Owner, attribute and value of a dotted submodule or method name
+	parent, _, attr = name.rpartition(".")
+	owner = model.get_submodule(parent) if parent else model
+	return owner, attr, getattr(owner, attr)
+
+def compile_regions(model, regions=None, **kwargs):
+	# Compiles the submodules or methods listed in model.compiled_regions in place, torch.compile(model) would wrap
+	# the module and prefix the state dict keys with _orig_mod
+	if regions is None:
+		regions = getattr(model, "compiled_regions", [])
+
+	for name in regions:
+		owner, attr, region = get_region(model, name)
+		if isinstance(region, nn.Module):
+			region.forward = torch.compile(region.forward, **kwargs)
+		else:
+			setattr(owner, attr, torch.compile(region, **kwargs))
+
+	return model
+
+def graph_breaks(fn, *args):
+	# Number of graph breaks of fn(*args) under torch.compile and their reasons
+	import torch._dynamo
+
+	torch._dynamo.reset()
+	if torch.__version__ >= (2, 1):
+		out = torch._dynamo.explain(fn)(*args)
+		return out.graph_break_count, out.break_reasons
+
+	break_reasons = torch._dynamo.explain(fn, *args)[4]
+	return len(break_reasons), break_reasons
+
+def explain_regions(model, run, regions=None):
+	# Calls run() once to capture the inputs of every region and returns {region: (number of graph breaks, reasons)}
+	if regions is None:
+		regions = getattr(model, "compiled_regions", [])
+
+	inputs = {}
+	restore = []
+	for name in regions:
+		owner, attr, region = get_region(model, name)
+		if isinstance(region, nn.Module):
+			owner, attr = region, "forward"
+		fn = getattr(owner, attr)
+
+		def capture(*args, name=name, fn=fn):
+			inputs.setdefault(name, (fn, args))
+			return fn(*args)
+
+		restore.append((owner, attr, owner.__dict__.get(attr)))
+		setattr(owner, attr, capture)
+
+	try:
+		with torch.no_grad():
+			run()
+	finally:
+		for owner, attr, value in reversed(restore):
+			if value is None:
+				delattr(owner, attr)
+			else:
+				setattr(owner, attr, value)
+
+	report = {}
+	for name in regions:
+		if name not in inputs:
+			raise ValueError("The region " + name + " was not called")
+		fn, args = inputs[name]
+		with torch.no_grad():
+			report[name] = graph_breaks(fn, *args)
+	return report
+
+
 class FocalLoss(nn.Module):
 	def __init__(self, alpha=1, gamma=2, reduction='mean', weights =None):
 		super(FocalLoss, self).__init__()
@@ -109,4 +203,276 @@ class FocalLoss(nn.Module):
 		elif self.reduction == 'sum':
 			return F_loss.sum()
 		else:
-			return F_loss
\ No newline at end of file
+			return F_loss
+
+def compute_bb(seg, label=None, pad=0):
+	# Bounding boxes [B, 4] (xmin, ymin, xmax, ymax) of a batch of masks [B, 1, H, W] without leaving the device.
+	# label=None uses every non zero pixel, empty masks give a zero box.
+	H, W = seg.shape[-2:]
+	seg = seg.reshape(-1, H, W)
+
+	if label is None:
+		mask = seg != 0
+	else:
+		mask = seg == label
+
+	rows = torch.any(mask, dim=2)
+	cols = torch.any(mask, dim=1)
+
+	i = torch.arange(H, device=seg.device)
+	j = torch.arange(W, device=seg.device)
+
+	xmin = torch.where(cols, j, W).amin(dim=1).to(torch.float32) - W*pad
+	ymin = torch.where(rows, i, H).amin(dim=1).to(torch.float32) - H*pad
+	xmax = torch.where(cols, j, -1).amax(dim=1).to(torch.float32) + W*pad
+	ymax = torch.where(rows, i, -1).amax(dim=1).to(torch.float32) + H*pad
+
+	bb = torch.stack([xmin.clamp(0, W), ymin.clamp(0, H), xmax.clamp(0, W), ymax.clamp(0, H)], dim=1).to(torch.int64)
+
+	return bb.masked_fill_(~torch.any(cols, dim=1, keepdim=True), 0)
+
+
+def resize_indices(start, length, out_size, device):
+	# Source indices and weights of a bilinear resize (align_corners=False, no antialias) of the
+	# windows [start, start + length) to out_size, start and length are [B, n] and [B] tensors.
+	scale = length.to(torch.float32)/out_size
+	k = torch.arange(out_size, dtype=torch.float32, device=device)
+
+	src = torch.clamp(scale[:, None]*(k + 0.5) - 0.5, min=0)
+	idx0 = torch.minimum(torch.floor(src).to(torch.int64), torch.clamp(length[:, None] - 1, min=0))
+	w1 = torch.clamp(src - idx0, 0, 1)
+	idx1 = idx0 + (idx0 < length[:, None] - 1).to(torch.int64)
+
+	idx0 = start[:, :, None] + idx0[:, None, :]
+	idx1 = start[:, :, None] + idx1[:, None, :]
+
+	return idx0, idx1, w1[:, None, :]
+
+def resize_output_size(height, width, size):
+	# Output (h, w) of transforms.Resize with an int size, the shorter side goes to size and the aspect ratio is kept
+	short, long = (width, height) if width <= height else (height, width)
+	new_long = int(size*long/short)
+	return (new_long, size) if width <= height else (size, new_long)
+
+def extract_patches(img, bb, nh, nw, size):
+	# Cuts the boxes bb [B, 4] (xmin, ymin, xmax, ymax) of img [B, C, H, W] in a grid of nh x nw patches and resizes them to size (h, w).
+	# Same as slicing every patch and calling transforms.Resize on the stack, in one batched gather.
+	# An int size (or a sequence of length 1) resizes the shorter side of the patches like transforms.Resize, the patches of all the
+	# boxes must then have the same output size.
+	# Returns [B, nh*nw, C, h, w]
+	B = img.shape[0]
+	device = img.device
+
+	bb = bb.to(device)
+	patch_width = torch.div(bb[:, 2] - bb[:, 0], nw, rounding_mode='floor')
+	patch_height = torch.div(bb[:, 3] - bb[:, 1], nh, rounding_mode='floor')
+
+	if isinstance(size, int) or len(size) == 1:
+		size = size if isinstance(size, int) else size[0]
+		# Empty boxes (no segmentation) have no aspect ratio
+		sizes = set(resize_output_size(h, w, size) for h, w in zip(patch_height.tolist(), patch_width.tolist()) if h > 0 and w > 0)
+		if len(sizes) > 1:
+			raise ValueError("The patches of the batch resize to different sizes {sizes} with patch_size {size}, use a (h, w) patch_size".format(sizes=sorted(sizes), size=size))
+		size = sizes.pop() if len(sizes) == 1 else (size, size)
+
+	x_start = bb[:, 0:1] + torch.arange(nw, device=device)*patch_width[:, None]
+	y_start = bb[:, 1:2] + torch.arange(nh, device=device)*patch_height[:, None]
+
+	x0, x1, wx = resize_indices(x_start, patch_width, size[1], device)
+	y0, y1, wy = resize_indices(y_start, patch_height, size[0], device)
+
+	img = img.permute(0, 2, 3, 1)
+	b = torch.arange(B, device=device).view(B, 1, 1, 1, 1)
+
+	def gather(rows, cols):
+		return img[b, rows[:, :, None, :, None], cols[:, None, :, None, :]]
+
+	wx = wx[:, None, :, None, :, None].to(img.dtype)
+	wy = wy[:, :, None, :, None, None].to(img.dtype)
+
+	patches = (1 - wy)*((1 - wx)*gather(y0, x0) + wx*gather(y0, x1)) + wy*((1 - wx)*gather(y1, x0) + wx*gather(y1, x1))
+
+	return patches.permute(0, 1, 2, 5, 3, 4).reshape(B, nh*nw, img.shape[-1], size[0], size[1])
+
+
+# Batched augmentation ops, images are [N, C, H, W] in [0, 1] and the random parameters are drawn per sample
+
+def sample_uniform(n, low, high, device):
+	return torch.empty(n, device=device).uniform_(low, high)
+
+def sample_mask(n, prob, device):
+	return torch.rand(n, device=device) < prob
+
+def where_samples(mask, x, y):
+	return torch.where(mask.view(-1, *[1]*(x.dim() - 1)), x, y)
+
+def random_affine_theta(n, device, zoom=None, zoom_prob=0, rotate=0, rotate_prob=0, hflip_prob=0, vflip_prob=0):
+	# affine_grid matrices [N, 2, 3] (output to input normalized coordinates) with zoom, rotation and flips
+	ones = torch.ones(n, device=device)
+
+	scale = ones
+	if zoom is not None:
+		scale = torch.where(sample_mask(n, zoom_prob, device), 1.0/sample_uniform(n, zoom[0], zoom[1], device), ones)
+
+	angle = torch.where(sample_mask(n, rotate_prob, device), sample_uniform(n, -rotate, rotate, device), torch.zeros_like(ones))
+	flip_x = torch.where(sample_mask(n, hflip_prob, device), -ones, ones)
+	flip_y = torch.where(sample_mask(n, vflip_prob, device), -ones, ones)
+
+	cos = torch.cos(angle)*scale
+	sin = torch.sin(angle)*scale
+	zeros = torch.zeros_like(ones)
+
+	return torch.stack([
+		torch.stack([cos*flip_x, -sin*flip_y, zeros], dim=1),
+		torch.stack([sin*flip_x, cos*flip_y, zeros], dim=1)
+		], dim=1)
+
+def random_resized_crop_theta(n, device, in_size, scale=(0.08, 1.0), ratio=(3.0/4.0, 4.0/3.0)):
+	# affine_grid matrices [N, 2, 3] of a crop with the area and aspect ratio sampling of transforms.RandomResizedCrop,
+	# the crop is clamped to the image instead of retrying the sampling
+	H, W = in_size
+
+	area = sample_uniform(n, scale[0], scale[1], device)*H*W
+	log_ratio = sample_uniform(n, np.log(ratio[0]), np.log(ratio[1]), device)
+	w = torch.clamp(torch.sqrt(area*torch.exp(log_ratio)), max=W)
+	h = torch.clamp(torch.sqrt(area/torch.exp(log_ratio)), max=H)
+
+	x0 = torch.rand(n, device=device)*(W - w)
+	y0 = torch.rand(n, device=device)*(H - h)
+
+	zeros = torch.zeros_like(w)
+
+	return torch.stack([
+		torch.stack([w/W, zeros, (2.0*x0 + w)/W - 1.0], dim=1),
+		torch.stack([zeros, h/H, (2.0*y0 + h)/H - 1.0], dim=1)
+		], dim=1)
+
+def compose_theta(theta_a, theta_b):
+	# affine_grid matrix that applies theta_b to the output coordinates and then theta_a, elementwise so it stays in float32 under autocast
+	linear = torch.sum(theta_a[:, :, :2, None]*theta_b[:, None, :, :], dim=2)
+	return torch.cat([linear[:, :, :2], linear[:, :, 2:] + theta_a[:, :, 2:]], dim=2)
+
+def affine_transform(x, theta, mode="bilinear", size=None):
+	# size is the (height, width) of the output, defaults to the input size
+	# The grid is computed outside autocast, a half precision grid is off by several pixels
+	out_shape = list(x.shape) if size is None else list(x.shape[:-2]) + list(size)
+	with torch.autocast(x.device.type, enabled=False):
+		grid = F.affine_grid(theta.to(x.dtype), out_shape, align_corners=False)
+		return F.grid_sample(x, grid, mode=mode, padding_mode="zeros", align_corners=False)
+
+def rgb_to_grayscale(img):
+	r, g, b = img.unbind(dim=-3)
+	return (0.2989*r + 0.587*g + 0.114*b).unsqueeze(dim=-3)
+
+def blend(img1, img2, ratio):
+	ratio = ratio.view(-1, *[1]*(img1.dim() - 1)).to(img1.dtype)
+	return (ratio*img1 + (1.0 - ratio)*img2).clamp(0, 1)
+
+def adjust_brightness(img, factor):
+	return blend(img, torch.zeros_like(img), factor)
+
+def adjust_contrast(img, factor):
+	return blend(img, torch.mean(rgb_to_grayscale(img), dim=(-3, -2, -1), keepdim=True), factor)
+
+def adjust_saturation(img, factor):
+	return blend(img, rgb_to_grayscale(img), factor)
+
+def rgb_to_hsv(img):
+	r, g, b = img.unbind(dim=-3)
+	maxc = torch.max(img, dim=-3).values
+	minc = torch.min(img, dim=-3).values
+
+	eqc = maxc == minc
+	cr = maxc - minc
+	ones = torch.ones_like(maxc)
+	s = cr/torch.where(eqc, ones, maxc)
+	cr_divisor = torch.where(eqc, ones, cr)
+	rc = (maxc - r)/cr_divisor
+	gc = (maxc - g)/cr_divisor
+	bc = (maxc - b)/cr_divisor
+
+	hr = (maxc == r)*(bc - gc)
+	hg = ((maxc == g) & (maxc != r))*(2.0 + rc - bc)
+	hb = ((maxc != g) & (maxc != r))*(4.0 + gc - rc)
+	h = torch.fmod((hr + hg + hb)/6.0 + 1.0, 1.0)
+
+	return torch.stack((h, s, maxc), dim=-3)
+
+def hsv_to_rgb(img):
+	h, s, v = img.unbind(dim=-3)
+	i = torch.floor(h*6.0)
+	f = h*6.0 - i
+	i = i.to(torch.int32) % 6
+
+	p = torch.clamp(v*(1.0 - s), 0.0, 1.0)
+	q = torch.clamp(v*(1.0 - s*f), 0.0, 1.0)
+	t = torch.clamp(v*(1.0 - s*(1.0 - f)), 0.0, 1.0)
+
+	mask = (i.unsqueeze(dim=-3) == torch.arange(6, device=i.device).view(-1, 1, 1)).to(img.dtype)
+
+	a1 = torch.stack((v, q, p, p, t, v), dim=-3)
+	a2 = torch.stack((t, v, v, q, p, p), dim=-3)
+	a3 = torch.stack((p, p, t, v, v, q), dim=-3)
+
+	return torch.einsum("...ijk, ...xijk -> ...xjk", mask, torch.stack((a1, a2, a3), dim=-4))
+
+def adjust_hue(img, factor):
+	hsv = rgb_to_hsv(img)
+	h = (hsv[:, 0] + factor.view(-1, 1, 1).to(img.dtype)) % 1.0
+	return hsv_to_rgb(torch.stack((h, hsv[:, 1], hsv[:, 2]), dim=1))
+
+def color_jitter(img, brightness=None, contrast=None, saturation=None, hue=None, prob=1.0):
+	# Same ops as transforms.ColorJitter with (min, max) ranges, applied in a fixed order with independent factors per sample
+	n = img.shape[0]
+	out = img
+	if brightness is not None:
+		out = adjust_brightness(out, sample_uniform(n, brightness[0], brightness[1], img.device))
+	if contrast is not None:
+		out = adjust_contrast(out, sample_uniform(n, contrast[0], contrast[1], img.device))
+	if saturation is not None:
+		out = adjust_saturation(out, sample_uniform(n, saturation[0], saturation[1], img.device))
+	if hue is not None:
+		out = adjust_hue(out, sample_uniform(n, hue[0], hue[1], img.device))
+	if prob < 1.0:
+		out = where_samples(sample_mask(n, prob, img.device), out, img)
+	return out
+
+def random_grayscale(img, prob):
+	return where_samples(sample_mask(img.shape[0], prob, img.device), rgb_to_grayscale(img).expand_as(img), img)
+
+def gaussian_blur(img, sigma, kernel_size=5):
+	# Separable gaussian blur with one sigma per sample, reflect padding like transforms.GaussianBlur
+	N, C, H, W = img.shape
+
+	x = torch.linspace(-(kernel_size - 1)/2.0, (kernel_size - 1)/2.0, kernel_size, device=img.device, dtype=img.dtype)
+	kernel = torch.exp(-0.5*(x[None, :]/sigma[:, None].to(img.dtype))**2)
+	kernel = (kernel/torch.sum(kernel, dim=1, keepdim=True)).repeat_interleave(C, dim=0)
+
+	pad = kernel_size//2
+	out = F.pad(img.reshape(1, N*C, H, W), (pad, pad, pad, pad), mode="reflect")
+	out = F.conv2d(out, kernel[:, None, None, :], groups=N*C)
+	out = F.conv2d(out, kernel[:, None, :, None], groups=N*C)
+
+	return out.reshape(N, C, H, W)
+
+def random_gaussian_blur(img, sigma, prob, kernel_size=5):
+	n = img.shape[0]
+	return where_samples(sample_mask(n, prob, img.device), gaussian_blur(img, sample_uniform(n, sigma[0], sigma[1], img.device), kernel_size), img)
+
+_pretrained_weights = True
+
+def pretrained(weights):
+	# ImageNet weights of the backbones, None inside no_pretrained() when the checkpoint weights are loaded right after
+	if _pretrained_weights:
+		return weights
+	return None
+
+@contextmanager
+def no_pretrained():
+	global _pretrained_weights
+	enabled = _pretrained_weights
+	_pretrained_weights = False
+	try:
+		yield
+	finally:
+		_pretrained_weights = enabled